@@ -0,0 +1,154 @@
+"""
+Compare the /ebms/items/ query strategies (EBMS_ITEM_QUERY_STRATEGY) on synthetic data.
+
+    cd backend && python -m benchmarks.item_query_strategies --orders 20000 --lines 8
+
+The data is loaded into an in-memory SQLite database shaped like the EBMS tables, the same statements the service
+builds are planned with EXPLAIN QUERY PLAN and timed. SQLite only stands in for SQL Server, compare the plan shapes
+(a temp B-tree for GROUP BY or not) and the relative timings, not the absolute numbers.
+The index strategy is timed with an already loaded inventory index, as it is between refreshes.
+"""
+import argparse
+import random
+import statistics
+import string
+import time
+import warnings
+from datetime import datetime, timedelta, date
+
+from sqlalchemy import create_engine, insert, Index, select
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.orm import Session
+
+from common.models import EBMSBase
+from origin_db.models import Arinv, Arinvdet, Inventry
+from origin_db.inventory_index import InventoryIndex
+from origin_db.queries import ITEM_QUERY_STRATEGIES, ITEM_RELATED_COLUMNS, ITEM_QUERY_INDEX, build_items_query
+from origin_db.staging import inline_staged_keys
+
+PROD_TYPES = ("Trim", "Panels", "Roll", "Flashing", "Vents", "")
+
+
+def random_id(length: int = 16) -> str:
+    return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def with_defaults(model, row: dict) -> dict:
+    """ The mapped EBMS columns are NOT NULL, fill the ones the benchmark doesn't care about """
+    defaults = {str: "", int: 0, float: 0, bool: False}
+    for attribute in model.__mapper__.column_attrs:
+        if attribute.key not in row:
+            python_type = attribute.columns[0].type.python_type
+            row[attribute.key] = defaults.get(python_type, datetime(2023, 1, 1) if python_type in (datetime, date) else 0)
+    return row
+
+
+def load_data(engine, orders: int, lines: int, inventory: int) -> None:
+    tables = [Arinv.__table__, Arinvdet.__table__, Inventry.__table__]
+    EBMSBase.metadata.create_all(engine, tables=tables)
+    # the lookups EBMS has indexes for
+    Index("ix_bench_arinv_autoid", Arinv.__table__.c.AUTOID).create(engine)
+    Index("ix_bench_arinvdet_doc_aid", Arinvdet.__table__.c.DOC_AID).create(engine)
+    Index("ix_bench_arinvdet_recno5", Arinvdet.__table__.c.RECNO5).create(engine)
+    Index("ix_bench_inventry_id", Inventry.__table__.c.ID).create(engine)
+
+    inventory_rows = [
+        with_defaults(Inventry, {
+            "inventry_guid": random_id(36), "recno5": index, "id": f"INV{index}", "prod_type": random.choice(PROD_TYPES),
+            "rol_profil": random.choice(("R", "PBR", "")), "rol_color": random.choice(("Red", "White", "Black")),
+        })
+        for index in range(inventory)
+    ]
+    start_date = datetime(2023, 1, 1)
+    order_rows, line_rows = [], []
+    for index in range(orders):
+        autoid = random_id()
+        inv_date = start_date + timedelta(days=random.randint(-60, 500))
+        order_rows.append(with_defaults(Arinv, {
+            "arinv_guid": random_id(36), "recno5": index, "autoid": autoid, "invoice": f"{index:08d}",
+            "name": f"Customer {index % 500}", "status": random.choice(("U", "U", "U", "P")), "inv_date": inv_date,
+        }))
+        for _ in range(random.randint(1, lines * 2)):
+            line_rows.append(with_defaults(Arinvdet, {
+                "arinvdet_guid": random_id(36), "recno5": len(line_rows), "autoid": random_id(), "doc_aid": autoid,
+                "invoice": f"{index:08d}", "inv_date": inv_date, "par_time": random.choice(("", "", "", "X")),
+                "inven": random.choice(inventory_rows)["id"], "quan": random.randint(1, 50), "descr": "synthetic line",
+                "widthd": random.randint(1, 48), "heightd": random.randint(1, 240), "demd": random.randint(0, 6),
+            }))
+    # ORM bulk inserts, the rows are keyed by attribute names
+    with Session(engine) as session, session.begin():
+        session.execute(insert(Inventry), inventory_rows)
+        session.execute(insert(Arinv), order_rows)
+        session.execute(insert(Arinvdet), line_rows)
+    print(f"loaded {len(order_rows)} orders, {len(line_rows)} lines, {len(inventory_rows)} inventory rows")
+
+
+def load_inventory_index(engine) -> InventoryIndex:
+    index = InventoryIndex()
+    with engine.connect() as connection:
+        rows = connection.execute(
+            select(Inventry.recno5, Inventry.id, Inventry.prod_type, Inventry.rol_profil, Inventry.rol_color)
+        ).all()
+    index.apply(rows, {})
+    return index
+
+
+def fill_from_index(index: InventoryIndex, row) -> dict:
+    """ What OriginItemService.prepare_objects adds to an index strategy row """
+    values = dict(row._mapping)
+    attributes = index.get(values["INVEN"])
+    for name, column in ITEM_RELATED_COLUMNS.items():
+        if column.class_ is Inventry:
+            values[name] = getattr(attributes, column.key) if attributes else None
+    return values
+
+
+def run(engine, strategy: str, limit: int, offset: int, repeat: int) -> list:
+    index = load_inventory_index(engine) if strategy == ITEM_QUERY_INDEX else None
+    listed_condition = index.listed_condition(Arinvdet.inven) if index else None
+    query = build_items_query(strategy, [Arinvdet], ITEM_RELATED_COLUMNS, listed_condition)
+    # SQLite has no #temp tables, a long id set is sent inline
+    query = inline_staged_keys(query.order_by(Arinvdet.recno5).limit(limit).offset(offset))
+    sql = str(query.compile(engine, compile_kwargs={"literal_binds": True}))
+    with engine.connect() as connection:
+        plan = connection.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}").all()
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = connection.execute(query).all()
+            timings.append(time.perf_counter() - start)
+    print(f"\n== {strategy}")
+    for row in plan:
+        print("   ", row[-1])
+    print(f"    median {statistics.median(timings) * 1000:.1f} ms, min {min(timings) * 1000:.1f} ms over {repeat} runs")
+    if index:
+        return [fill_from_index(index, row) for row in rows]
+    return [dict(row._mapping) for row in rows]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=20000)
+    parser.add_argument("--lines", type=int, default=8, help="average lines per order")
+    parser.add_argument("--inventory", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--offset", type=int, default=5000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    # the EBMS models use DECIMAL, which SQLite stores as float
+    warnings.filterwarnings("ignore", category=sa_exc.SAWarning)
+    engine = create_engine("sqlite://")
+    load_data(engine, orders=args.orders, lines=args.lines, inventory=args.inventory)
+    results = {
+        strategy: run(engine, strategy, limit=args.limit, offset=args.offset, repeat=args.repeat)
+        for strategy in ITEM_QUERY_STRATEGIES
+    }
+    pages = list(results.values())
+    print("\nsame page for every strategy:", all(page == pages[0] for page in pages))
+
+
+if __name__ == "__main__":
+    main()
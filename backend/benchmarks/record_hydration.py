@@ -0,0 +1,101 @@
+"""
+Rows/sec of turning an EBMS items page into response objects, mapped Arinvdet instances vs slot records.
+
+    cd backend && python -m benchmarks.record_hydration --rows 20000 --repeat 5
+
+The rows are synthetic tuples shaped like the /ebms/items/ page (every ARINVDET column plus the related ones),
+"hydrate" only builds the objects, "serialize" also validates them with ArinvDetSchema as the response does.
+"""
+import argparse
+import random
+import statistics
+import string
+import time
+from datetime import datetime, timedelta, date
+from decimal import Decimal
+
+from origin_db.models import Arinvdet
+from origin_db.queries import ITEM_RELATED_COLUMNS
+from origin_db.records import RowHydrator, record_type
+from origin_db.schemas import ArinvDetSchema
+
+
+def random_id(length: int = 16) -> str:
+    return "".join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+
+def make_rows(count: int) -> tuple[list[tuple], list[tuple]]:
+    """ Cursor description and rows, with the upper case column names EBMS returns """
+    columns = list(Arinvdet.__table__.columns)
+    description = [(column.name,) for column in columns] + [(name,) for name in ITEM_RELATED_COLUMNS]
+    rows = []
+    for index in range(count):
+        row = []
+        for column in columns:
+            python_type = column.type.python_type
+            if python_type is str:
+                row.append(random_id(8))
+            elif python_type is datetime:
+                row.append(datetime(2023, 1, 1) + timedelta(days=index % 500))
+            elif python_type is date:
+                row.append(date(2023, 1, 1) + timedelta(days=index % 500))
+            elif python_type is Decimal:
+                row.append(Decimal(random.randint(0, 10000)) / 100)
+            elif python_type is bool:
+                row.append(bool(index % 2))
+            else:
+                row.append(random.randint(0, 1000))
+        row += ["Trim", "R", "White", f"Customer {index % 500}", "U"]
+        rows.append(tuple(row))
+    return description, rows
+
+
+def hydrate_models(description: list[tuple], rows: list[tuple]) -> list:
+    # what the services did before: one dict per row and a mapped instance
+    columns = [column[0].lower() for column in description]
+    return [Arinvdet(**dict(zip(columns, row))) for row in rows]
+
+
+def hydrate_records(description: list[tuple], rows: list[tuple]) -> list:
+    hydrate = RowHydrator(record_type(Arinvdet, ArinvDetSchema), description)
+    return [hydrate(row) for row in rows]
+
+
+def measure(name: str, function, repeat: int, rows_count: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    median = statistics.median(timings)
+    print(f"{name:<28} median {median * 1000:8.1f} ms  {rows_count / median:12,.0f} rows/sec")
+    return median
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    description, rows = make_rows(args.rows)
+    serialize = lambda objs: [ArinvDetSchema.model_validate(obj).model_dump(by_alias=True) for obj in objs]
+
+    models = measure("hydrate models", lambda: hydrate_models(description, rows), args.repeat, args.rows)
+    records = measure("hydrate records", lambda: hydrate_records(description, rows), args.repeat, args.rows)
+    models_total = measure(
+        "hydrate + serialize models", lambda: serialize(hydrate_models(description, rows)), args.repeat, args.rows
+    )
+    records_total = measure(
+        "hydrate + serialize records", lambda: serialize(hydrate_records(description, rows)), args.repeat, args.rows
+    )
+    print(f"\nhydration {models / records:.1f}x faster, with serialization {models_total / records_total:.1f}x faster")
+
+    same = serialize(hydrate_models(description, rows[:100])) == serialize(hydrate_records(description, rows[:100]))
+    print("same serialized output:", same)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """ Small in-process cache with per entry expiry, the least recently used entries are dropped above maxsize """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    @staticmethod
+    def fingerprint(*parts: Any) -> str:
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key: Hashable, allow_stale: bool = False) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.monotonic() and not allow_stale:
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def is_fresh(self, key: Hashable) -> bool:
+        item = self._data.get(key)
+        return item is not None and item[0] >= time.monotonic()
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, namespace: Optional[Hashable] = None) -> None:
+        """ Drop every entry, or only the entries whose key is a tuple starting with `namespace` """
+        if namespace is None:
+            self._data.clear()
+            return
+        for key in [key for key in self._data if isinstance(key, tuple) and key and key[0] == namespace]:
+            del self._data[key]
@@ -9,6 +9,7 @@ from common.models import DefaultBase, EBMSBase
 ModelType = TypeVar("ModelType", bound=DefaultBase)
 OriginModelType = TypeVar("OriginModelType", bound=EBMSBase)
 InputSchemaType = TypeVar("InputSchemaType", bound=BaseModel)
+SchemaType = TypeVar("SchemaType", bound=BaseModel)
 
 IncEx: typing_extensions.TypeAlias = 'set[int] | set[str] | dict[int, Any] | dict[str, Any] | None'
 
@@ -29,3 +30,14 @@ class RoleModel(str, Enum):
     admin: str = "admin"
     manager: str = "manager"
     worker: str = "worker"
+
+
+class CountMode(str, Enum):
+    exact: str = "exact"  # cached while fresh, otherwise counted
+    estimate: str = "estimate"  # last known total, refreshed in the background
+    none: str = "none"  # only has_more
+
+
+class ExportFormat(str, Enum):
+    csv: str = "csv"
+    ndjson: str = "ndjson"  # one JSON object per line
@@ -2,7 +2,7 @@ from collections import defaultdict
 from typing import Union, Optional, List, Any
 
 from fastapi_filter.contrib.sqlalchemy.filter import _backward_compatible_value_for_like_and_ilike, Filter
-from pydantic import field_validator
+from pydantic import field_validator, PrivateAttr
 from pydantic_core.core_schema import ValidationInfo
 from sqlalchemy import Select, or_
 from sqlalchemy.orm import Query
@@ -27,6 +27,8 @@ _orm_operator_transformer = {
 
 class RenameFieldFilter(Filter):
     order_by: Optional[List[str]] = None
+    _annotations: dict = PrivateAttr(default_factory=dict)
+    _search_condition: Any = PrivateAttr(default=None)
 
     class Constants(Filter.Constants):
         extra = 'allow'
@@ -49,12 +51,29 @@ class RenameFieldFilter(Filter):
     def ordered(self):
         return self.Constants.do_ordering
 
+    def annotate(self, **expressions: Any) -> None:
+        """ Sort by expressions the service query computes (e.g. a joined aggregate) instead of the model attributes """
+        self._annotations.update(expressions)
+
+    def resolve_search(self, condition: Any) -> None:
+        """ Condition which answers `search` (e.g. autoids found by an index), used instead of the LIKE chain """
+        self._search_condition = condition
+
+    @property
+    def search_resolved(self) -> bool:
+        return self._search_condition is not None
+
+    def is_ordering_by(self, field_name: str) -> bool:
+        return any(value.replace("-", "").replace("+", "") == field_name for value in self.ordering_values or ())
+
     def get_join_table(self, field_name: str) -> Optional[ModelType | OriginModelType]:
         join_tables = getattr(self.Constants, "join_tables", None)
         if join_tables is not None:
             return join_tables.get(field_name, None)
 
     def get_search_query(self, query, value) -> Optional[Union[Select, Query]]:
+        if self._search_condition is not None:
+            return query.filter(self._search_condition)
         search_filters = []
         for model, fields in self.Constants.search_fields_by_models.items():
             for field in fields:
@@ -145,6 +164,9 @@ class RenameFieldFilter(Filter):
             return order_by_related_fields.get(order_by_field, order_by_field)
         return order_by_field
 
+    def get_condition(self, model_field: Any, operator: str, value: Any) -> Any:
+        return getattr(model_field, operator)(value)
+
     def filter(self, query: Union[Query, Select], **kwargs: Optional[dict]):
         for field_name, value in self.filtering_fields:
             field_value = getattr(self, field_name, None)
@@ -170,7 +192,7 @@ class RenameFieldFilter(Filter):
                     query = self.get_search_query(query, value)
                 else:
                     model_field = getattr(self.Constants.model, field_name)
-                    query = query.where(getattr(model_field, operator)(value))
+                    query = query.where(self.get_condition(model_field, operator, value))
         # print(query.compile(compile_kwargs={"literal_binds": True}))
         extra_ordering = kwargs.get("extra_ordering")
         if extra_ordering is not None:
@@ -199,7 +221,9 @@ class RenameFieldFilter(Filter):
             field_name = field_name.replace("-", "").replace("+", "")
             need_join_table = self.get_join_table(field_name)
             ordering_field_name = self.order_by_related_field(field_name)
-            if not need_join_table:
+            if field_name in self._annotations:
+                order_by_field = self._annotations[field_name]
+            elif not need_join_table:
                 order_by_field = getattr(self.Constants.model, ordering_field_name)
             else:
                 if need_join_table and not need_join_table in self.Constants.joins:
@@ -209,6 +233,25 @@ class RenameFieldFilter(Filter):
             query = query.order_by(getattr(order_by_field, direction)())
         return query
 
+    def get_ordering_expressions(self, **kwargs: Optional[dict]) -> List[tuple[Any, bool]]:
+        """ (expression, descending) pairs in the same order as filter() and sort() apply them """
+        expressions = []
+        extra_ordering = kwargs.get("extra_ordering")
+        if extra_ordering is not None:
+            expressions.append((extra_ordering, False))
+        fields = self.ordering_values or ()
+        if not fields and extra_ordering is None:
+            fields = self.Constants.default_ordering
+        for field_name in fields:
+            descending = field_name.startswith("-")
+            field_name = field_name.replace("-", "").replace("+", "")
+            if field_name in self._annotations:
+                expressions.append((self._annotations[field_name], descending))
+                continue
+            table = self.get_join_table(field_name) or self.Constants.model
+            expressions.append((getattr(table, self.order_by_related_field(field_name)), descending))
+        return expressions
+
     @field_validator("*", mode="before", check_fields=False)
     def validate_order_by(cls, value, field: ValidationInfo):
         if field.field_name != cls.Constants.ordering_field_name:
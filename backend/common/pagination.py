@@ -0,0 +1,84 @@
+import base64
+import binascii
+import json
+from datetime import date, datetime
+from decimal import Decimal
+from typing import Any, Sequence
+
+from fastapi import HTTPException
+from sqlalchemy import and_, or_, false
+from sqlalchemy.sql.elements import ColumnElement
+
+KEYSET_COLUMN_PREFIX = "keyset_"
+
+
+class KeysetCursor:
+    """ Opaque cursor holding the ordering values of the last row of a page """
+
+    @staticmethod
+    def _dump_value(value: Any) -> Any:
+        if isinstance(value, datetime):
+            return {"dt": value.isoformat()}
+        if isinstance(value, date):
+            return {"d": value.isoformat()}
+        if isinstance(value, Decimal):
+            return {"n": str(value)}
+        return value
+
+    @staticmethod
+    def _load_value(value: Any) -> Any:
+        if not isinstance(value, dict):
+            return value
+        if "dt" in value:
+            return datetime.fromisoformat(value["dt"])
+        if "d" in value:
+            return date.fromisoformat(value["d"])
+        if "n" in value:
+            return Decimal(value["n"])
+        raise ValueError(f"Unknown cursor value {value}")
+
+    @classmethod
+    def encode(cls, values: Sequence[Any]) -> str:
+        data = json.dumps([cls._dump_value(value) for value in values], separators=(",", ":"))
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii").rstrip("=")
+
+    @classmethod
+    def decode(cls, cursor: str, size: int) -> list:
+        try:
+            data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            values = [cls._load_value(value) for value in json.loads(data)]
+        except (binascii.Error, ValueError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if len(values) != size:
+            raise HTTPException(status_code=400, detail="Cursor doesn't match the requested ordering")
+        return values
+
+
+def _after(expression: ColumnElement, value: Any, descending: bool) -> ColumnElement:
+    # SQL Server sorts NULL as the lowest value
+    if value is None:
+        return false() if descending else expression.is_not(None)
+    if descending:
+        return or_(expression < value, expression.is_(None))
+    return expression > value
+
+
+def _equal(expression: ColumnElement, value: Any) -> ColumnElement:
+    return expression.is_(None) if value is None else expression == value
+
+
+def keyset_predicate(ordering: Sequence[tuple[ColumnElement, bool]], values: Sequence[Any]) -> ColumnElement:
+    """
+    Rows strictly after `values` for the (expression, descending) ordering:
+    (a > x) OR (a = x AND b > y) OR (a = x AND b = y AND c > z) ...
+    """
+    conditions = []
+    for index, (expression, descending) in enumerate(ordering):
+        equals = [_equal(previous, values[position]) for position, (previous, _) in enumerate(ordering[:index])]
+        conditions.append(and_(*equals, _after(expression, values[index], descending)))
+    return or_(*conditions)
+
+
+def split_keyset_values(obj: dict, size: int) -> list:
+    """ Pop the keyset_N helper columns out of a row dict """
+    return [obj.pop(f"{KEYSET_COLUMN_PREFIX}{index}") for index in range(size)]
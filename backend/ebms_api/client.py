@@ -1,19 +1,169 @@
+import asyncio
+import email
+import email.policy
 import json
+import random
+import re
+import uuid
 from base64 import b64encode
+from typing import Optional, NamedTuple, Dict, Any, List
+from urllib.parse import urlsplit
 
-import requests
+import httpx
 
-from settings import EBMS_API_PASSWORD, EBMS_API_LOGIN, EBMS_API_URL
+from settings import (
+    EBMS_API_PASSWORD, EBMS_API_LOGIN, EBMS_API_URL, EBMS_API_TIMEOUT, EBMS_API_MAX_CONNECTIONS,
+    EBMS_API_HOST_CONCURRENCY, EBMS_API_RETRIES, EBMS_API_RETRY_BACKOFF, EBMS_API_BATCH_SIZE,
+)
+
+# answers worth another attempt, the EBMS API or its proxy is overloaded or restarting
+RETRY_STATUS_CODES = frozenset({429, 502, 503, 504})
+
+
+class EBMSHttpPool:
+    """
+    One keep-alive httpx client per process, with at most EBMS_API_HOST_CONCURRENCY requests in flight per host.
+
+    Connection errors and RETRY_STATUS_CODES are retried EBMS_API_RETRIES times, waiting
+    EBMS_API_RETRY_BACKOFF * 2 ** attempt seconds (with jitter) in between.
+    """
+
+    def __init__(
+            self, timeout: float = EBMS_API_TIMEOUT, max_connections: int = EBMS_API_MAX_CONNECTIONS,
+            host_concurrency: int = EBMS_API_HOST_CONCURRENCY, retries: int = EBMS_API_RETRIES,
+            backoff: float = EBMS_API_RETRY_BACKOFF,
+    ):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.host_concurrency = host_concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self._client: Optional[httpx.AsyncClient] = None
+        self._host_limits: Dict[str, asyncio.Semaphore] = {}
+
+    def get_client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            )
+        return self._client
+
+    def get_host_limit(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self._host_limits:
+            self._host_limits[host] = asyncio.Semaphore(self.host_concurrency)
+        return self._host_limits[host]
+
+    def get_delay(self, attempt: int) -> float:
+        return self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+
+    async def request(self, method: str, url: str, **kwargs: Any) -> httpx.Response:
+        for attempt in range(self.retries + 1):
+            last_attempt = attempt == self.retries
+            try:
+                # the host slot is released while waiting for the next attempt
+                async with self.get_host_limit(url):
+                    response = await self.get_client().request(method, url, **kwargs)
+            except httpx.TransportError as e:
+                if last_attempt:
+                    raise
+                print(f"EBMS API {method} {url} failed {e!r}, retrying")
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or last_attempt:
+                    return response
+                print(f"EBMS API {method} {url} answered {response.status_code}, retrying")
+            await asyncio.sleep(self.get_delay(attempt))
+
+    async def close(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+ebms_http_pool = EBMSHttpPool()
+
+
+class WriteResult(NamedTuple):
+    autoid: str
+    ok: bool
+    status_code: Optional[int] = None
+    detail: Optional[str] = None
+
+
+class BatchPartResponse(NamedTuple):
+    content_id: Optional[str]
+    status_code: int
+    body: str
+
+
+def is_success(status_code: int) -> bool:
+    return 200 <= status_code < 300
+
+
+class ODataBatch:
+    """
+    OData $batch body of PATCH requests, each one in its own change set so they succeed or fail one by one.
+
+    Requests are written relative to the service root and numbered with Content-ID, the responses are
+    matched back by the echoed Content-ID, or by their position when the server doesn't echo it.
+    """
+
+    def __init__(self):
+        self.boundary = f"batch_{uuid.uuid4()}"
+        self.parts: List[bytes] = []
+
+    @property
+    def content_type(self) -> str:
+        return f"multipart/mixed; boundary={self.boundary}"
+
+    def add_patch(self, url: str, data: Any, headers: Optional[Dict[str, str]] = None) -> str:
+        content_id = str(len(self.parts) + 1)
+        changeset = f"changeset_{uuid.uuid4()}"
+        self.parts.append("\r\n".join((
+            f"Content-Type: multipart/mixed; boundary={changeset}",
+            "",
+            f"--{changeset}",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            f"Content-ID: {content_id}",
+            "",
+            f"PATCH {url} HTTP/1.1",
+            "Content-Type: application/json",
+            *(f"{name}: {value}" for name, value in (headers or {}).items()),
+            "",
+            json.dumps(data),
+            f"--{changeset}--",
+        )).encode())
+        return content_id
+
+    def get_body(self) -> bytes:
+        delimiter = f"--{self.boundary}\r\n".encode()
+        return b"".join(delimiter + part + b"\r\n" for part in self.parts) + f"--{self.boundary}--\r\n".encode()
+
+    @staticmethod
+    def parse_http_response(payload: bytes, content_id: Optional[str]) -> BatchPartResponse:
+        head, *body = re.split(rb"\r?\n\r?\n", payload.lstrip(), maxsplit=1)
+        status_line = head.splitlines()[0].decode()
+        return BatchPartResponse(content_id, int(status_line.split()[1]), body[0].decode(errors="replace") if body else "")
+
+    @classmethod
+    def parse_response(cls, content_type: str, content: bytes) -> List[BatchPartResponse]:
+        """ The application/http responses of a multipart/mixed batch response, change sets included, in order """
+        message = email.message_from_bytes(
+            f"Content-Type: {content_type}\r\n\r\n".encode() + content, policy=email.policy.HTTP,
+        )
+        return [
+            cls.parse_http_response(part.get_payload(decode=True), part.get("Content-ID"))
+            for part in message.walk() if part.get_content_type() == "application/http"
+        ]
 
 
 class BasicAUTHRequest:
     password = EBMS_API_PASSWORD
     login = EBMS_API_LOGIN
     ebms_host = EBMS_API_URL
-
-    @staticmethod
-    def get_session():
-        return requests.Session()
+    pool = ebms_http_pool
 
     def add_default_headers(self, headers=None):
         headers = headers or {}
@@ -29,26 +179,21 @@ class BasicAUTHRequest:
         token = b64encode(f"{username}:{password}".encode('utf-8')).decode("ascii")
         return f'Basic {token}'
 
-    def get(self, url, headers=None):
-        with self.get_session() as session:
-            return session.get(url, headers=self.add_default_headers(headers))
+    async def get(self, url, headers=None) -> httpx.Response:
+        return await self.pool.request("GET", url, headers=self.add_default_headers(headers))
 
-    def post(self, url, data=None, headers=None):
-        with self.get_session() as session:
-            return session.post(url, data=json.dumps(data), headers=self.add_default_headers(headers))
+    async def post(self, url, data=None, headers=None) -> httpx.Response:
+        return await self.pool.request("POST", url, content=json.dumps(data), headers=self.add_default_headers(headers))
 
-    def put(self, url, data=None, headers=None):
-        with self.get_session() as session:
-            return session.put(url, data=json.dumps(data), headers=self.add_default_headers(headers))
+    async def put(self, url, data=None, headers=None) -> httpx.Response:
+        return await self.pool.request("PUT", url, content=json.dumps(data), headers=self.add_default_headers(headers))
 
-    def delete(self, url, headers=None):
-        with self.get_session() as session:
-            return session.delete(url, headers=self.add_default_headers(headers))
+    async def delete(self, url, headers=None) -> httpx.Response:
+        return await self.pool.request("DELETE", url, headers=self.add_default_headers(headers))
 
-    def patch(self, url, data=None, headers=None):
+    async def patch(self, url, data=None, headers=None) -> httpx.Response:
         print(data)
-        with self.get_session() as session:
-            return session.patch(url, data=json.dumps(data), headers=self.add_default_headers(headers))
+        return await self.pool.request("PATCH", url, content=json.dumps(data), headers=self.add_default_headers(headers))
 
 
 class ArinvClient(BasicAUTHRequest):
@@ -58,3 +203,87 @@ class ArinvClient(BasicAUTHRequest):
     def retrieve_url(self, autoid):
         print(f"{self.ebms_host}/{self.ebms_model}('{autoid}')?$select='{self.select}'")
         return f"{self.ebms_host}/{self.ebms_model}('{autoid}')?$select={self.select}"
+
+    @staticmethod
+    def get_idempotency_headers(idempotency_key: Optional[str]) -> Optional[Dict[str, str]]:
+        return {"Idempotency-Key": idempotency_key} if idempotency_key else None
+
+    async def update_ship_date(self, autoid: str, ship_date: Any, idempotency_key: Optional[str] = None) -> WriteResult:
+        try:
+            response = await self.patch(
+                self.retrieve_url(autoid), {"SHIP_DATE": ship_date}, headers=self.get_idempotency_headers(idempotency_key),
+            )
+        except httpx.HTTPError as e:
+            return WriteResult(autoid, False, detail=repr(e))
+        if not is_success(response.status_code):
+            return WriteResult(autoid, False, response.status_code, response.text)
+        return WriteResult(autoid, True, response.status_code)
+
+    def batch_url(self) -> str:
+        return f"{self.ebms_host}/$batch"
+
+    def resource_path(self, autoid: str) -> str:
+        """ URL of the order relative to the service root, as written inside a $batch """
+        return f"{self.ebms_model}('{autoid}')"
+
+    async def send_ship_date_batch(
+            self, ship_dates: Dict[str, Any], idempotency_keys: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, WriteResult]:
+        """ One $batch of ship date PATCHes, the outcome per autoid """
+        idempotency_keys = idempotency_keys or {}
+        batch = ODataBatch()
+        content_ids = {
+            batch.add_patch(
+                self.resource_path(autoid), {"SHIP_DATE": ship_date},
+                self.get_idempotency_headers(idempotency_keys.get(autoid)),
+            ): autoid
+            for autoid, ship_date in ship_dates.items()
+        }
+        try:
+            response = await self.pool.request(
+                "POST", self.batch_url(), content=batch.get_body(),
+                headers=self.add_default_headers({"Content-Type": batch.content_type}),
+            )
+        except httpx.HTTPError as e:
+            return {autoid: WriteResult(autoid, False, detail=repr(e)) for autoid in ship_dates}
+        if not is_success(response.status_code):
+            return {autoid: WriteResult(autoid, False, response.status_code, response.text) for autoid in ship_dates}
+        parts = ODataBatch.parse_response(response.headers.get("Content-Type", ""), response.content)
+        autoids = list(content_ids.values())
+        results = {}
+        for position, part in enumerate(parts):
+            autoid = content_ids.get(part.content_id)
+            if autoid is None and position < len(autoids):
+                autoid = autoids[position]
+            if autoid is None:
+                continue
+            if is_success(part.status_code):
+                results[autoid] = WriteResult(autoid, True, part.status_code)
+            else:
+                results[autoid] = WriteResult(autoid, False, part.status_code, part.body)
+        for autoid in ship_dates.keys() - results.keys():
+            results[autoid] = WriteResult(autoid, False, detail="no response in the $batch")
+        return results
+
+    async def update_ship_dates(
+            self, ship_dates: Dict[str, Any], batch_size: int = EBMS_API_BATCH_SIZE,
+            idempotency_keys: Optional[Dict[str, str]] = None,
+    ) -> Dict[str, WriteResult]:
+        """
+        PATCH the ship date of every order, the outcome per autoid.
+        Orders are grouped into $batch requests of `batch_size`, with a size of 1 each one is its own PATCH.
+        The requests run concurrently, bounded by the host limit. `idempotency_keys` are sent as Idempotency-Key.
+        """
+        idempotency_keys = idempotency_keys or {}
+        if batch_size <= 1:
+            results = await asyncio.gather(*(
+                self.update_ship_date(autoid, ship_date, idempotency_keys.get(autoid))
+                for autoid, ship_date in ship_dates.items()
+            ))
+            return {result.autoid: result for result in results}
+        items = list(ship_dates.items())
+        batches = await asyncio.gather(*(
+            self.send_ship_date_batch(dict(items[index:index + batch_size]), idempotency_keys)
+            for index in range(0, len(items), batch_size)
+        ))
+        return {autoid: result for batch in batches for autoid, result in batch.items()}
@@ -0,0 +1,26 @@
+from datetime import datetime
+
+from sqlalchemy import TIMESTAMP, String, Integer, JSON, Text, Index
+from sqlalchemy.orm import Mapped, mapped_column
+
+from common.models import DefaultBase
+
+
+class EBMSOutbox(DefaultBase):
+    """ A write to the EBMS API, kept until EBMS accepts it or it is given up and rolled back """
+    __table_args__ = (
+        Index('ix_ebmsoutbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+
+    idempotency_key: Mapped[str] = mapped_column(String(64), unique=True, nullable=False)
+    model: Mapped[str] = mapped_column(String(32), nullable=False)
+    autoid: Mapped[str] = mapped_column(String(100), nullable=False, index=True)
+    payload: Mapped[dict] = mapped_column(JSON, nullable=False)
+    previous: Mapped[dict] = mapped_column(JSON, nullable=True)  # local values to restore when the write is given up
+    status: Mapped[str] = mapped_column(String(20), nullable=False, default='pending')
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    next_attempt_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False, default=datetime.now)
+    claimed_until: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=True)  # set while a worker sends the write
+    last_error: Mapped[str] = mapped_column(Text, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=False, default=datetime.now)
+    sent_at: Mapped[datetime] = mapped_column(TIMESTAMP, nullable=True)
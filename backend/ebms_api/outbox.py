@@ -0,0 +1,278 @@
+"""
+Durable delivery of writes to the EBMS API.
+
+A ship date change is applied locally first (EBMS database, mirror, websocket) and its PATCH is written to the
+`ebmsoutbox` table, together with the values to restore if EBMS never accepts it. `drain()` claims the due writes
+with SELECT ... FOR UPDATE SKIP LOCKED, so any number of workers can drain the table without sending a write twice,
+and sends them with their Idempotency-Key. A claimed write is leased (`claimed_until`) until its outcome is recorded,
+no other write of the same order is claimed meanwhile, so EBMS receives the writes of an order in order. A failed write is retried after EBMS_OUTBOX_BACKOFF * 2 ** attempts
+seconds (at most EBMS_OUTBOX_MAX_BACKOFF). Only when it is given up (EBMS_OUTBOX_MAX_ATTEMPTS, or a 4xx answer which
+won't change) the local value is rolled back and the `orders` channel notified.
+
+A newer write of the same order supersedes the pending one and takes over its previous values. The outcome of a
+write superseded while it was sent is still stored on its row.
+"""
+import asyncio
+import logging
+import random
+import uuid
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, NamedTuple, Optional
+
+from sqlalchemy import select, update, delete, func, exists
+from sqlalchemy.orm import aliased
+
+from database import default_session_maker
+from ebms_api.client import ArinvClient, WriteResult
+from ebms_api.models import EBMSOutbox
+from origin_db.services import OriginOrderService
+from settings import (
+    EBMS_API_TIMEOUT, EBMS_API_RETRIES, EBMS_OUTBOX_POLL_INTERVAL, EBMS_OUTBOX_BATCH_SIZE, EBMS_OUTBOX_MAX_ATTEMPTS,
+    EBMS_OUTBOX_BACKOFF, EBMS_OUTBOX_MAX_BACKOFF,
+)
+from stages.utils import send_data_to_ws
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+SENT = 'sent'
+FAILED = 'failed'
+SUPERSEDED = 'superseded'
+
+# 4xx answers worth another attempt, EBMS gives the same answer to any other one
+RETRYABLE_CLIENT_ERRORS = frozenset({408, 409, 429})
+# a claimed write is hidden from the other workers while it is sent, the client gives up before that
+CLAIM_TIMEOUT = timedelta(seconds=EBMS_API_TIMEOUT * (EBMS_API_RETRIES + 1) * 2)
+# transaction advisory lock taken by every claim, a claim sees the leases of the claims before it
+CLAIM_LOCK_KEY = 0x4542_4d53  # "EBMS"
+# sent and superseded writes are kept this long
+RETENTION = timedelta(days=7)
+# sent writes counted for the drain rate
+RATE_WINDOW = timedelta(minutes=5)
+
+
+class ClaimedWrite(NamedTuple):
+    id: int
+    idempotency_key: str
+    autoid: str
+    payload: dict
+    previous: Optional[dict]
+    attempts: int
+
+
+def is_permanent(result: WriteResult) -> bool:
+    return result.status_code is not None and 400 <= result.status_code < 500 \
+        and result.status_code not in RETRYABLE_CLIENT_ERRORS
+
+
+class EBMSOutboxWorker:
+    def __init__(
+            self, batch_size: int = EBMS_OUTBOX_BATCH_SIZE, max_attempts: int = EBMS_OUTBOX_MAX_ATTEMPTS,
+            backoff: int = EBMS_OUTBOX_BACKOFF, max_backoff: int = EBMS_OUTBOX_MAX_BACKOFF,
+    ):
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._task: Optional[asyncio.Task] = None
+
+    def get_delay(self, attempts: int) -> timedelta:
+        delay = self.backoff * 2 ** (attempts - 1) * random.uniform(0.5, 1.5)
+        return timedelta(seconds=min(delay, self.max_backoff))
+
+    async def enqueue_ship_dates(self, ship_dates: Dict[str, Any], previous: Dict[str, Optional[datetime]]) -> None:
+        """ Queue the ship date PATCH of every order, `previous` are the local ship dates before the change """
+        if not ship_dates:
+            return
+        async with default_session_maker.begin() as session:
+            superseded = await session.execute(
+                update(EBMSOutbox).where(
+                    EBMSOutbox.model == ArinvClient.ebms_model,
+                    EBMSOutbox.autoid.in_(ship_dates.keys()),
+                    EBMSOutbox.status == PENDING,
+                ).values(status=SUPERSEDED).returning(EBMSOutbox.autoid, EBMSOutbox.previous)
+            )
+            # the value to restore is the one before the first write EBMS hasn't accepted yet
+            superseded_previous = dict(superseded.all())
+            session.add_all([
+                EBMSOutbox(
+                    idempotency_key=uuid.uuid4().hex,
+                    model=ArinvClient.ebms_model,
+                    autoid=autoid,
+                    payload={"SHIP_DATE": ship_date},
+                    previous=superseded_previous.get(autoid) or {"SHIP_DATE": self.dump_date(previous.get(autoid))},
+                    status=PENDING,
+                    attempts=0,
+                    next_attempt_at=datetime.now(),
+                    created_at=datetime.now(),
+                )
+                for autoid, ship_date in ship_dates.items()
+            ])
+
+    @staticmethod
+    def dump_date(value: Optional[datetime]) -> Optional[str]:
+        return value.isoformat() if value else None
+
+    @staticmethod
+    def load_date(value: Optional[str]) -> Optional[datetime]:
+        return datetime.fromisoformat(value) if value else None
+
+    async def claim(self) -> List[ClaimedWrite]:
+        """ The due writes, at most one per order and none of an order whose previous write is still being sent """
+        now = datetime.now()
+        leased = aliased(EBMSOutbox)
+        async with default_session_maker.begin() as session:
+            # claims run one at a time, FOR UPDATE SKIP LOCKED only keeps them from waiting on an enqueue
+            await session.execute(select(func.pg_advisory_xact_lock(CLAIM_LOCK_KEY)))
+            result = await session.execute(
+                select(
+                    EBMSOutbox.id, EBMSOutbox.idempotency_key, EBMSOutbox.autoid, EBMSOutbox.payload,
+                    EBMSOutbox.previous, EBMSOutbox.attempts,
+                ).where(
+                    EBMSOutbox.status == PENDING, EBMSOutbox.next_attempt_at <= now,
+                    ~exists().where(
+                        leased.model == EBMSOutbox.model, leased.autoid == EBMSOutbox.autoid,
+                        leased.id != EBMSOutbox.id, leased.claimed_until > now,
+                    ),
+                ).order_by(
+                    EBMSOutbox.next_attempt_at, EBMSOutbox.id
+                ).limit(self.batch_size).with_for_update(of=EBMSOutbox, skip_locked=True)
+            )
+            claimed = {}
+            for row in result.all():
+                # the oldest one, should two writes of the order be pending
+                claimed.setdefault(row.autoid, ClaimedWrite(*row))
+            claimed = list(claimed.values())
+            if claimed:
+                await session.execute(
+                    update(EBMSOutbox).where(
+                        EBMSOutbox.id.in_([write.id for write in claimed])
+                    ).values(next_attempt_at=now + CLAIM_TIMEOUT, claimed_until=now + CLAIM_TIMEOUT)
+                )
+        return claimed
+
+    async def record(self, claimed: List[ClaimedWrite], results: Dict[str, WriteResult]) -> List[ClaimedWrite]:
+        """ Store the outcome of the sent writes and end their lease, the ones given up are returned """
+        now = datetime.now()
+        given_up = []
+        async with default_session_maker.begin() as session:
+            for write in claimed:
+                result = results[write.autoid]
+                attempts = write.attempts + 1
+                error = None if result.ok else f"{result.status_code} {result.detail}"
+                if result.ok:
+                    values = dict(status=SENT, sent_at=now)
+                elif attempts >= self.max_attempts or is_permanent(result):
+                    values = dict(status=FAILED)
+                else:
+                    values = dict(next_attempt_at=now + self.get_delay(attempts))
+                updated = await session.execute(
+                    update(EBMSOutbox).where(EBMSOutbox.id == write.id, EBMSOutbox.status == PENDING).values(
+                        attempts=attempts, last_error=error, claimed_until=None, **values,
+                    )
+                )
+                if updated.rowcount:
+                    if values.get('status') == FAILED:
+                        given_up.append(write)
+                    continue
+                # superseded while it was sent, the newer write is claimed once this lease ends and sent after it
+                await session.execute(
+                    update(EBMSOutbox).where(EBMSOutbox.id == write.id).values(
+                        attempts=attempts, last_error=error, claimed_until=None,
+                        sent_at=now if result.ok else None,
+                    )
+                )
+                logger.info(
+                    "superseded ship date write of %s answered %s %s",
+                    write.autoid, result.status_code, "ok" if result.ok else result.detail,
+                )
+        return given_up
+
+    @staticmethod
+    async def roll_back(write: ClaimedWrite) -> None:
+        ship_date = EBMSOutboxWorker.load_date((write.previous or {}).get("SHIP_DATE"))
+        await OriginOrderService().update_ship_date(autoids=[write.autoid], ship_date=ship_date)
+        await send_data_to_ws('orders', autoid=write.autoid)
+
+    async def drain(self) -> int:
+        """ Send the due writes once, the number of writes sent """
+        claimed = await self.claim()
+        if not claimed:
+            return 0
+        results = await ArinvClient().update_ship_dates(
+            {write.autoid: write.payload["SHIP_DATE"] for write in claimed},
+            idempotency_keys={write.autoid: write.idempotency_key for write in claimed},
+        )
+        given_up = await self.record(claimed, results)
+        failed = sum(not result.ok for result in results.values())
+        logger.info("EBMS outbox sent %s writes, %s failed, %s given up", len(claimed), failed, len(given_up))
+        for write in given_up:
+            result = results[write.autoid]
+            logger.warning(
+                "ship date of %s was not accepted by EBMS after %s attempts: %s %s, rolled back",
+                write.autoid, write.attempts + 1, result.status_code, result.detail,
+            )
+            try:
+                await self.roll_back(write)
+            except Exception:
+                logger.exception("rollback of the ship date of %s failed", write.autoid)
+        return len(claimed)
+
+    async def purge(self) -> None:
+        async with default_session_maker.begin() as session:
+            await session.execute(
+                delete(EBMSOutbox).where(
+                    EBMSOutbox.status.in_((SENT, SUPERSEDED)), EBMSOutbox.created_at < datetime.now() - RETENTION,
+                )
+            )
+
+    async def get_metrics(self) -> dict:
+        now = datetime.now()
+        async with default_session_maker() as session:
+            counts = dict((await session.execute(
+                select(EBMSOutbox.status, func.count()).group_by(EBMSOutbox.status)
+            )).all())
+            oldest_pending = await session.scalar(
+                select(func.min(EBMSOutbox.created_at)).where(EBMSOutbox.status == PENDING)
+            )
+            retrying = await session.scalar(
+                select(func.count()).where(EBMSOutbox.status == PENDING, EBMSOutbox.attempts > 0)
+            )
+            sent = await session.scalar(
+                select(func.count()).where(EBMSOutbox.status == SENT, EBMSOutbox.sent_at >= now - RATE_WINDOW)
+            )
+        return {
+            "depth": counts.get(PENDING, 0),
+            "retrying": retrying,
+            "failed": counts.get(FAILED, 0),
+            "oldest_pending_seconds": (now - oldest_pending).total_seconds() if oldest_pending else 0,
+            "sent_per_minute": sent / (RATE_WINDOW.total_seconds() / 60),
+        }
+
+    async def run(self) -> None:
+        # every worker drains, SKIP LOCKED hands each write to one of them
+        while True:
+            try:
+                while await self.drain() == self.batch_size:
+                    pass
+                await self.purge()
+            except Exception:
+                logger.exception("EBMS outbox drain failed")
+            await asyncio.sleep(EBMS_OUTBOX_POLL_INTERVAL)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+ebms_outbox = EBMSOutboxWorker()
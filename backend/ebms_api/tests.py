@@ -0,0 +1,210 @@
+"""
+ArinvClient ship date $batch requests against a local HTTP server standing in for the EBMS API.
+
+    cd backend && python -m unittest ebms_api.tests  # with the environment of the app, settings.py reads it
+"""
+import email
+import email.policy
+import json
+import re
+import threading
+import unittest
+import uuid
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, List, NamedTuple, Optional
+
+from ebms_api.client import ArinvClient, EBMSHttpPool, WriteResult
+
+
+class SentPatch(NamedTuple):
+    content_id: Optional[str]
+    path: str
+    idempotency_key: Optional[str]
+    data: dict
+
+
+class PartAnswer(NamedTuple):
+    content_id: Optional[str]
+    status_code: int
+    body: str = ""
+
+
+class ReceivedRequest(NamedTuple):
+    method: str
+    path: str
+    content_type: str
+    body: bytes
+
+
+class Answer(NamedTuple):
+    status_code: int
+    content_type: str
+    body: bytes
+
+
+def read_batch(request: ReceivedRequest) -> List[SentPatch]:
+    """ The PATCH requests of a $batch body, in order """
+    message = email.message_from_bytes(
+        f"Content-Type: {request.content_type}\r\n\r\n".encode() + request.body, policy=email.policy.HTTP,
+    )
+    patches = []
+    for part in message.walk():
+        if part.get_content_type() != "application/http":
+            continue
+        head, body = re.split(r"\r?\n\r?\n", part.get_payload(decode=True).decode(), maxsplit=1)
+        request_line, *header_lines = head.splitlines()
+        headers = dict(line.split(": ", 1) for line in header_lines)
+        patches.append(SentPatch(
+            part.get("Content-ID"), request_line.split()[1], headers.get("Idempotency-Key"), json.loads(body),
+        ))
+    return patches
+
+
+def batch_response(answers: List[PartAnswer]) -> Answer:
+    """ A multipart/mixed $batch response, every answer in its own change set """
+    boundary = f"batchresponse_{uuid.uuid4()}"
+    content = ""
+    for answer in answers:
+        changeset = f"changesetresponse_{uuid.uuid4()}"
+        content += "\r\n".join((
+            f"--{boundary}",
+            f"Content-Type: multipart/mixed; boundary={changeset}",
+            "",
+            f"--{changeset}",
+            "Content-Type: application/http",
+            "Content-Transfer-Encoding: binary",
+            *([f"Content-ID: {answer.content_id}"] if answer.content_id else []),
+            "",
+            f"HTTP/1.1 {answer.status_code} {HTTPStatus(answer.status_code).phrase}",
+            "",
+            answer.body,
+            f"--{changeset}--",
+            "",
+        ))
+    content += f"--{boundary}--\r\n"
+    return Answer(200, f"multipart/mixed; boundary={boundary}", content.encode())
+
+
+class EBMSStandIn(ThreadingHTTPServer):
+    """ Records every request and answers it with answer(request), on a free local port """
+
+    daemon_threads = True
+
+    def __init__(self, answer: Callable[[ReceivedRequest], Answer]):
+        self.answer = answer
+        self.requests: List[ReceivedRequest] = []
+        super().__init__(("127.0.0.1", 0), EBMSStandInHandler)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class EBMSStandInHandler(BaseHTTPRequestHandler):
+    server: EBMSStandIn
+    protocol_version = "HTTP/1.1"
+
+    def handle_request(self) -> None:
+        request = ReceivedRequest(
+            self.command, self.path, self.headers.get("Content-Type", ""),
+            self.rfile.read(int(self.headers.get("Content-Length", 0))),
+        )
+        self.server.requests.append(request)
+        answer = self.server.answer(request)
+        self.send_response(answer.status_code)
+        self.send_header("Content-Type", answer.content_type)
+        self.send_header("Content-Length", str(len(answer.body)))
+        self.end_headers()
+        self.wfile.write(answer.body)
+
+    do_POST = do_PATCH = handle_request
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+
+class ShipDateBatchTest(unittest.IsolatedAsyncioTestCase):
+    ship_dates = {"A1": "2026-10-20", "B2": "2026-10-21", "C3": "2026-10-22"}
+
+    def get_client(self, answer: Callable[[List[SentPatch]], Answer]) -> ArinvClient:
+        self.server = EBMSStandIn(lambda request: answer(read_batch(request)))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        pool = EBMSHttpPool(retries=0)
+        self.addAsyncCleanup(pool.close)
+        client = ArinvClient()
+        client.pool = pool
+        client.ebms_host = self.server.url
+        return client
+
+    @property
+    def requests(self) -> List[ReceivedRequest]:
+        return self.server.requests
+
+    @staticmethod
+    def fail(autoid: str, patches: List[SentPatch], status_code: int = 400) -> List[PartAnswer]:
+        return [
+            PartAnswer(patch.content_id, status_code if autoid in patch.path else 204, "invalid SHIP_DATE")
+            for patch in patches
+        ]
+
+    async def test_one_failed_change_set(self):
+        # answered in reverse order, matched back by Content-ID
+        client = self.get_client(lambda patches: batch_response(self.fail("B2", patches)[::-1]))
+        results = await client.send_ship_date_batch(self.ship_dates, idempotency_keys={"A1": "key-a1"})
+
+        self.assertEqual(len(self.requests), 1)
+        self.assertEqual((self.requests[0].method, self.requests[0].path), ("POST", "/$batch"))
+        patches = read_batch(self.requests[0])
+        self.assertEqual([patch.path for patch in patches], ["ARINV('A1')", "ARINV('B2')", "ARINV('C3')"])
+        self.assertEqual([patch.data for patch in patches], [{"SHIP_DATE": date} for date in self.ship_dates.values()])
+        self.assertEqual([patch.idempotency_key for patch in patches], ["key-a1", None, None])
+        self.assertEqual(results, {
+            "A1": WriteResult("A1", True, 204),
+            "B2": WriteResult("B2", False, 400, "invalid SHIP_DATE"),
+            "C3": WriteResult("C3", True, 204),
+        })
+
+    async def test_positional_fallback_without_content_id(self):
+        client = self.get_client(lambda patches: batch_response([
+            answer._replace(content_id=None) for answer in self.fail("C3", patches)
+        ]))
+        results = await client.send_ship_date_batch(self.ship_dates)
+
+        self.assertEqual(results, {
+            "A1": WriteResult("A1", True, 204),
+            "B2": WriteResult("B2", True, 204),
+            "C3": WriteResult("C3", False, 400, "invalid SHIP_DATE"),
+        })
+
+    async def test_missing_part_response(self):
+        client = self.get_client(lambda patches: batch_response([
+            PartAnswer(patch.content_id, 204) for patch in patches[:2]
+        ]))
+        results = await client.send_ship_date_batch(self.ship_dates)
+
+        self.assertEqual(results["A1"], WriteResult("A1", True, 204))
+        self.assertEqual(results["B2"], WriteResult("B2", True, 204))
+        self.assertEqual(results["C3"], WriteResult("C3", False, detail="no response in the $batch"))
+
+    async def test_failed_batch_request(self):
+        client = self.get_client(lambda patches: Answer(500, "text/plain", b"server error"))
+        results = await client.send_ship_date_batch(self.ship_dates)
+
+        self.assertEqual(results, {
+            autoid: WriteResult(autoid, False, 500, "server error") for autoid in self.ship_dates
+        })
+
+    async def test_update_ship_dates_splits_batches(self):
+        client = self.get_client(lambda patches: batch_response(self.fail("C3", patches)))
+        results = await client.update_ship_dates(self.ship_dates, batch_size=2)
+
+        self.assertEqual(sorted(len(read_batch(request)) for request in self.requests), [1, 2])
+        self.assertEqual({autoid: result.ok for autoid, result in results.items()}, {"A1": True, "B2": True, "C3": False})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -10,10 +10,18 @@ from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.responses import JSONResponse
 
+from ebms_api.client import ebms_http_pool
+from ebms_api.outbox import ebms_outbox
+from mssqqlserver_database import ebms_pool
+from origin_db.change_poller import ebms_change_poller
+from origin_db.mirror import ebms_mirror
+from stages.flow_graph import flow_graph_cache
 from origin_db.routers import router as origin_router
+from origin_db.validation import AutoidValidationMiddleware
 from stages.routers import router as stages_router
 from profiles.routers import router as profiles_router
 from users.routers import router as users_router
+from settings import EBMS_MIRROR_ENABLED, EBMS_CHANGE_POLLER_ENABLED, EBMS_OUTBOX_ENABLED
 from users.auth_routers import router as auth_router
 from websockets_connection.managers import connection_manager
 from websockets_connection.routers import router as ws_router
@@ -56,13 +64,36 @@ async def startup():
     print("Connected to redis")
     print("Set default thread limiter with capacity 2")
     RunVar("_default_thread_limiter").set(CapacityLimiter(2))
+    print("Subscribing to flow graph changes")
+    flow_graph_cache.start()
+    if EBMS_MIRROR_ENABLED:
+        print("Starting EBMS mirror sync")
+        ebms_mirror.start()
+    if EBMS_CHANGE_POLLER_ENABLED:
+        print("Starting EBMS change poller")
+        ebms_change_poller.start()
+    if EBMS_OUTBOX_ENABLED:
+        print("Starting EBMS API outbox")
+        ebms_outbox.start()
 
 
 @app.on_event("shutdown")
 async def shutdown():
+    print("Unsubscribing from flow graph changes")
+    await flow_graph_cache.stop()
+    print("Stopping EBMS mirror sync")
+    await ebms_mirror.stop()
+    print("Stopping EBMS change poller")
+    await ebms_change_poller.stop()
+    print("Stopping EBMS API outbox")
+    await ebms_outbox.stop()
     print("Disconnecting from redis")
     await connection_manager.disconnect_broadcaster()
     print("Disconnected from redis")
+    print("Closing EBMS connection pool")
+    await ebms_pool.close()
+    print("Closing EBMS API connections")
+    await ebms_http_pool.close()
 
 
 origins = [
@@ -82,6 +113,8 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+app.add_middleware(AutoidValidationMiddleware)
+
 @app.middleware("http")
 async def add_process_time_header(request, call_next):
     start_time = time.time()
@@ -6,6 +6,7 @@ from sqlalchemy import pool
 from alembic import context
 
 from common.models import DefaultBase
+from ebms_api.models import EBMSOutbox
 from settings import Default_DB
 from stages.models import Capacity, Stage, Flow, Item, Comment, SalesOrder
 from users.models import User
@@ -0,0 +1,37 @@
+"""Add trigram search indexes to the EBMS mirror
+
+Revision ID: 5d8e2f4a9c61
+Revises: 7a3c5e91b2d4
+Create Date: 2026-10-17 16:41:07.302514
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from settings import EBMS_MIRROR_SCHEMA
+
+# revision identifiers, used by Alembic.
+revision: str = '5d8e2f4a9c61'
+down_revision: Union[str, None] = '7a3c5e91b2d4'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # GIN trigram indexes answer ILIKE '%value%', see origin_db/search.py
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    op.create_index(
+        'ix_arinv_name_trgm', 'ARINV', ['NAME'], schema=EBMS_MIRROR_SCHEMA,
+        postgresql_using='gin', postgresql_ops={'NAME': 'gin_trgm_ops'},
+    )
+    op.create_index(
+        'ix_arinv_invoice_trgm', 'ARINV', ['INVOICE'], schema=EBMS_MIRROR_SCHEMA,
+        postgresql_using='gin', postgresql_ops={'INVOICE': 'gin_trgm_ops'},
+    )
+
+
+def downgrade() -> None:
+    op.drop_index('ix_arinv_invoice_trgm', table_name='ARINV', schema=EBMS_MIRROR_SCHEMA)
+    op.drop_index('ix_arinv_name_trgm', table_name='ARINV', schema=EBMS_MIRROR_SCHEMA)
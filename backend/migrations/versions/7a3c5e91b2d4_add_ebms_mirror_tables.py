@@ -0,0 +1,138 @@
+"""Add EBMS mirror tables
+
+Revision ID: 7a3c5e91b2d4
+Revises: 49d1e4581096
+Create Date: 2026-10-17 10:12:40.118203
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from settings import EBMS_MIRROR_SCHEMA
+
+# revision identifiers, used by Alembic.
+revision: str = '7a3c5e91b2d4'
+down_revision: Union[str, None] = '49d1e4581096'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    # EBMS table and column names are kept as they are, the same statements run on both databases
+    op.execute(f'CREATE SCHEMA IF NOT EXISTS {EBMS_MIRROR_SCHEMA}')
+    op.create_table('ARINV',
+    sa.Column('ARINV_GUID', sa.String(), nullable=False),
+    sa.Column('RECNO5', sa.Integer(), nullable=True),
+    sa.Column('ID', sa.String(), nullable=True),
+    sa.Column('NAME', sa.String(), nullable=True),
+    sa.Column('ADDRESS1', sa.String(), nullable=True),
+    sa.Column('ADDRESS2', sa.String(), nullable=True),
+    sa.Column('CITY', sa.String(), nullable=True),
+    sa.Column('STATE', sa.String(), nullable=True),
+    sa.Column('INVOICE', sa.String(), nullable=True),
+    sa.Column('DESCR', sa.String(), nullable=True),
+    sa.Column('INV_DATE', sa.DateTime(), nullable=True),
+    sa.Column('DUE_DATE', sa.DateTime(), nullable=True),
+    sa.Column('DIS_DATE', sa.DateTime(), nullable=True),
+    sa.Column('DISCOUNT', sa.String(), nullable=True),
+    sa.Column('PO_NO', sa.String(), nullable=True),
+    sa.Column('SHIP_VIA', sa.String(), nullable=True),
+    sa.Column('E_DATE', sa.DateTime(), nullable=True),
+    sa.Column('OVERDUE', sa.Float(), nullable=True),
+    sa.Column('TAX', sa.Float(), nullable=True),
+    sa.Column('SUBTOTAL', sa.Float(), nullable=True),
+    sa.Column('TOTAL', sa.Float(), nullable=True),
+    sa.Column('STATUS', sa.String(), nullable=True),
+    sa.Column('TOTAL_PAID', sa.Float(), nullable=True),
+    sa.Column('C_NAME', sa.String(), nullable=True),
+    sa.Column('C_ADDRESS1', sa.String(), nullable=True),
+    sa.Column('C_ADDRESS2', sa.String(), nullable=True),
+    sa.Column('C_CITY', sa.String(), nullable=True),
+    sa.Column('C_STATE', sa.String(), nullable=True),
+    sa.Column('EMAIL', sa.String(), nullable=True),
+    sa.Column('BILLING_CO', sa.String(), nullable=True),
+    sa.Column('SHIP_DATE', sa.DateTime(), nullable=True),
+    sa.Column('FRGHT_AMT', sa.String(), nullable=True),
+    sa.Column('FRGHT_TYPE', sa.String(), nullable=True),
+    sa.Column('USER_NAME', sa.String(), nullable=True),
+    sa.Column('ORIG_INV', sa.String(), nullable=True),
+    sa.Column('ORIG_AID', sa.String(), nullable=True),
+    sa.Column('CREA_DATE', sa.TIMESTAMP(), nullable=True),
+    sa.Column('CREA_TIME', sa.String(), nullable=True),
+    sa.Column('AUTOID', sa.String(), nullable=True),
+    sa.Column('CSEND_DATE', sa.TIMESTAMP(), nullable=True),
+    sa.Column('CSEND_TIME', sa.String(), nullable=True),
+    sa.Column('CSEND_MES', sa.String(), nullable=True),
+    sa.Column('C_RATE', sa.String(), nullable=True),
+    sa.Column('CURR_ID', sa.String(), nullable=True),
+    sa.Column('COPIED', sa.Boolean(), nullable=True),
+    sa.Column('PREVORD', sa.String(), nullable=True),
+    sa.Column('SYNC_CHECKSUM', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('ARINV_GUID'),
+    schema=EBMS_MIRROR_SCHEMA,
+    )
+    op.create_table('ARINVDET',
+    sa.Column('ARINVDET_GUID', sa.String(), nullable=False),
+    sa.Column('RECNO5', sa.Integer(), nullable=True),
+    sa.Column('INVOICE', sa.String(), nullable=True),
+    sa.Column('ID', sa.String(), nullable=True),
+    sa.Column('DOC_AID', sa.String(), nullable=True),
+    sa.Column('INV_DATE', sa.TIMESTAMP(), nullable=True),
+    sa.Column('QUAN', sa.Numeric(), nullable=True),
+    sa.Column('INVEN', sa.String(), nullable=True),
+    sa.Column('C_TYPE', sa.Numeric(), nullable=True),
+    sa.Column('DESCR', sa.String(), nullable=True),
+    sa.Column('DISCOUNT', sa.Numeric(), nullable=True),
+    sa.Column('SODISCOUNT', sa.Numeric(), nullable=True),
+    sa.Column('PAR_TIME', sa.String(), nullable=True),
+    sa.Column('STATUS', sa.Numeric(), nullable=True),
+    sa.Column('SHIP_DATE', sa.Date(), nullable=True),
+    sa.Column('WEIGHT', sa.Numeric(), nullable=True),
+    sa.Column('AUTOID', sa.String(), nullable=True),
+    sa.Column('WIDTH', sa.String(), nullable=True),
+    sa.Column('WIDTHD', sa.Numeric(), nullable=True),
+    sa.Column('HEIGHT', sa.String(), nullable=True),
+    sa.Column('HEIGHTD', sa.Numeric(), nullable=True),
+    sa.Column('DEMD', sa.Numeric(), nullable=True),
+    sa.Column('SYNC_CHECKSUM', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('ARINVDET_GUID'),
+    schema=EBMS_MIRROR_SCHEMA,
+    )
+    op.create_table('INVENTRY',
+    sa.Column('INVENTRY_GUID', sa.String(), nullable=False),
+    sa.Column('RECNO5', sa.Integer(), nullable=True),
+    sa.Column('ID', sa.String(), nullable=True),
+    sa.Column('AUTOID', sa.String(), nullable=True),
+    sa.Column('ROL_COLOR', sa.String(), nullable=True),
+    sa.Column('ROL_PROFIL', sa.String(), nullable=True),
+    sa.Column('PROD_TYPE', sa.String(), nullable=True),
+    sa.Column('SYNC_CHECKSUM', sa.Integer(), nullable=True),
+    sa.PrimaryKeyConstraint('INVENTRY_GUID'),
+    schema=EBMS_MIRROR_SCHEMA,
+    )
+    op.create_index('ix_arinv_autoid', 'ARINV', ['AUTOID'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinv_recno5', 'ARINV', ['RECNO5'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinv_inv_date', 'ARINV', ['INV_DATE'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinvdet_autoid', 'ARINVDET', ['AUTOID'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinvdet_doc_aid', 'ARINVDET', ['DOC_AID'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinvdet_recno5', 'ARINVDET', ['RECNO5'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_arinvdet_inven', 'ARINVDET', ['INVEN'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_index('ix_inventry_id', 'INVENTRY', ['ID'], schema=EBMS_MIRROR_SCHEMA)
+    op.create_table('sync_state',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('watermark', sa.BigInteger(), nullable=False, server_default='0'),
+    sa.Column('synced_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.Column('reconciled_at', sa.TIMESTAMP(timezone=True), nullable=True),
+    sa.PrimaryKeyConstraint('table_name'),
+    schema=EBMS_MIRROR_SCHEMA,
+    )
+
+
+def downgrade() -> None:
+    op.drop_table('sync_state', schema=EBMS_MIRROR_SCHEMA)
+    op.drop_table('INVENTRY', schema=EBMS_MIRROR_SCHEMA)
+    op.drop_table('ARINVDET', schema=EBMS_MIRROR_SCHEMA)
+    op.drop_table('ARINV', schema=EBMS_MIRROR_SCHEMA)
+    op.execute(f'DROP SCHEMA IF EXISTS {EBMS_MIRROR_SCHEMA}')
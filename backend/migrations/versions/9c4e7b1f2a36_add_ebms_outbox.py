@@ -0,0 +1,46 @@
+"""Add EBMS API outbox
+
+Revision ID: 9c4e7b1f2a36
+Revises: 5d8e2f4a9c61
+Create Date: 2026-10-17 19:02:51.640218
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9c4e7b1f2a36'
+down_revision: Union[str, None] = '5d8e2f4a9c61'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('ebmsoutbox',
+    sa.Column('idempotency_key', sa.String(length=64), nullable=False),
+    sa.Column('model', sa.String(length=32), nullable=False),
+    sa.Column('autoid', sa.String(length=100), nullable=False),
+    sa.Column('payload', sa.JSON(), nullable=False),
+    sa.Column('previous', sa.JSON(), nullable=True),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('next_attempt_at', sa.TIMESTAMP(), nullable=False),
+    sa.Column('claimed_until', sa.TIMESTAMP(), nullable=True),
+    sa.Column('last_error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.TIMESTAMP(), nullable=False),
+    sa.Column('sent_at', sa.TIMESTAMP(), nullable=True),
+    sa.Column('id', sa.Integer(), autoincrement=True, nullable=False),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('idempotency_key')
+    )
+    op.create_index(op.f('ix_ebmsoutbox_autoid'), 'ebmsoutbox', ['autoid'], unique=False)
+    op.create_index('ix_ebmsoutbox_status_next_attempt_at', 'ebmsoutbox', ['status', 'next_attempt_at'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_ebmsoutbox_status_next_attempt_at', table_name='ebmsoutbox')
+    op.drop_index(op.f('ix_ebmsoutbox_autoid'), table_name='ebmsoutbox')
+    op.drop_table('ebmsoutbox')
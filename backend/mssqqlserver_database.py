@@ -1,26 +1,129 @@
-from typing import List
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from typing import AsyncGenerator, Optional
 
 import aioodbc
+from aioodbc import Pool
+from aioodbc.connection import Connection
 from aioodbc.cursor import Cursor
 from fastapi import HTTPException
-from pyodbc import OperationalError
-from concurrent.futures import ThreadPoolExecutor
-import asyncio
+from pyodbc import Error, OperationalError
 from starlette import status
-from fastapi import APIRouter, Depends, Query
 
 from settings import EBMS_DB
 
-loop = asyncio.get_event_loop()
+EBMS_DSN = (
+    f'Driver={{ODBC Driver 17 for SQL Server}};Server={EBMS_DB.DB_HOST},{EBMS_DB.DB_PORT};Database={EBMS_DB.DB_NAME};'
+    f'UID={EBMS_DB.DB_USER};PWD={EBMS_DB.DB_PASS};Trusted_Connection=no;'
+)
+
+# pyodbc is blocking, every pooled connection runs its calls on this one bounded executor
+ebms_executor = ThreadPoolExecutor(max_workers=EBMS_DB.EXECUTOR_MAX_WORKERS, thread_name_prefix="ebms-odbc")
+
+
+class EBMSConnectionPool:
+    """ Process wide aioodbc pool for the EBMS database, created lazily inside the running event loop """
+
+    def __init__(
+            self, dsn: str, minsize: int, maxsize: int, pool_recycle: int, acquire_timeout: float,
+            pre_ping: bool, executor: ThreadPoolExecutor,
+    ):
+        self.dsn = dsn
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.pool_recycle = pool_recycle
+        self.acquire_timeout = acquire_timeout
+        self.pre_ping = pre_ping
+        self.executor = executor
+        self._pool: Optional[Pool] = None
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def get_pool(self) -> Pool:
+        if self._pool is None:
+            if self._lock is None:
+                self._lock = asyncio.Lock()
+            async with self._lock:
+                if self._pool is None:
+                    self._pool = await aioodbc.create_pool(
+                        dsn=self.dsn, minsize=self.minsize, maxsize=self.maxsize, pool_recycle=self.pool_recycle,
+                        executor=self.executor, autocommit=True,
+                    )
+        return self._pool
+
+    async def close(self) -> None:
+        if self._pool is None:
+            return
+        self._pool.close()
+        await self._pool.wait_closed()
+        self._pool = None
+
+    @staticmethod
+    async def ping(connection: Connection) -> bool:
+        try:
+            async with connection.cursor() as cursor:
+                await cursor.execute("SELECT 1")
+                await cursor.fetchone()
+        except Error:
+            return False
+        return True
+
+    async def acquire(self) -> Connection:
+        pool = await self.get_pool()
+        # every free connection may have gone stale, so try at most the whole pool before giving up
+        for _ in range(pool.maxsize + 1):
+            try:
+                connection = await asyncio.wait_for(pool.acquire(), timeout=self.acquire_timeout)
+            except asyncio.TimeoutError:
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="EBMS connection pool exhausted")
+            if not self.pre_ping or await self.ping(connection):
+                return connection
+            await self.release(connection, discard=True)
+        raise OperationalError("08S01", "Could not get a healthy EBMS connection from the pool")
+
+    async def release(self, connection: Connection, discard: bool = False) -> None:
+        if discard and not connection.closed:
+            try:
+                await connection.close()
+            except Error:
+                pass
+        # closed connections are dropped by the pool instead of being put back to the free list
+        await self._pool.release(connection)
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncGenerator[Connection, None]:
+        connection = await self.acquire()
+        discard = False
+        try:
+            yield connection
+        except Error:
+            # the driver error may have left the connection unusable, never hand it out again
+            discard = True
+            raise
+        finally:
+            await self.release(connection, discard=discard)
+
+    @asynccontextmanager
+    async def cursor(self) -> AsyncGenerator[Cursor, None]:
+        async with self.connection() as connection:
+            async with connection.cursor() as cursor:
+                yield cursor
+
+
+ebms_pool = EBMSConnectionPool(
+    dsn=EBMS_DSN,
+    minsize=EBMS_DB.POOL_MIN_SIZE,
+    maxsize=EBMS_DB.POOL_MAX_SIZE,
+    pool_recycle=EBMS_DB.POOL_RECYCLE,
+    acquire_timeout=EBMS_DB.POOL_ACQUIRE_TIMEOUT,
+    pre_ping=EBMS_DB.POOL_PRE_PING,
+    executor=ebms_executor,
+)
 
 
 async def get_cursor() -> Cursor:
-    driver = '{ODBC Driver 17 for SQL Server}'
-    dsn = f'Driver={driver};Server={EBMS_DB.DB_HOST},{EBMS_DB.DB_PORT};Database={EBMS_DB.DB_NAME};UID={EBMS_DB.DB_USER};PWD={EBMS_DB.DB_PASS};Trusted_Connection=no;'
     try:
-        async with aioodbc.connect(dsn=dsn, loop=loop, executor=ThreadPoolExecutor(max_workers=50)) as conn:
-            async with conn.cursor() as cur:
-                yield cur
+        async with ebms_pool.cursor() as cur:
+            yield cur
     except OperationalError:
         raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="DB connectivity failed")
-
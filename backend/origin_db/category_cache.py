@@ -0,0 +1,100 @@
+import json
+from typing import Awaitable, Callable, List, Optional, NamedTuple
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+from common.cache import TTLCache
+from database import redis_pool
+from settings import EBMS_CATEGORY_CACHE_TTL, EBMS_CATEGORY_CACHE_REDIS_TTL
+
+CATEGORY_CACHE_KEY = 'ebms:categories'
+CATEGORY_VERSION_KEY = 'ebms:categories:version'
+
+
+def normalize(value: Optional[str]) -> str:
+    # SQL Server compares PROD_TYPE case insensitive and without trailing spaces
+    return (value or '').rstrip().casefold()
+
+
+class CategoryTable(NamedTuple):
+    rows: List[dict]  # ordered by prod_type, like CategoryService.get_query
+    by_autoid: dict[str, dict]
+    by_prod_type: dict[str, dict]
+
+    @classmethod
+    def from_rows(cls, rows: List[dict]) -> "CategoryTable":
+        return cls(
+            rows=rows,
+            by_autoid={row['autoid']: row for row in rows},
+            by_prod_type={normalize(row['prod_type']): row for row in rows},
+        )
+
+
+class CategoryCache:
+    """
+    The listed INPRODTYPE rows, kept in process for EBMS_CATEGORY_CACHE_TTL seconds
+    and in redis for EBMS_CATEGORY_CACHE_REDIS_TTL seconds.
+
+    Both copies carry the version in redis they were loaded with, invalidate() increments it, so every process
+    reloads on its next read. Without redis the process copy is used until its TTL.
+    """
+
+    def __init__(self, ttl: int = EBMS_CATEGORY_CACHE_TTL, redis_ttl: int = EBMS_CATEGORY_CACHE_REDIS_TTL):
+        self.local = TTLCache(ttl=ttl, maxsize=1)
+        self.redis_ttl = redis_ttl
+
+    @staticmethod
+    def get_redis() -> aioredis.Redis:
+        return aioredis.Redis(connection_pool=redis_pool)
+
+    async def read_version(self) -> Optional[int]:
+        try:
+            return int(await self.get_redis().get(CATEGORY_VERSION_KEY) or 0)
+        except RedisError as e:
+            print(f"category cache version read failed {e}")
+            return None
+
+    async def read_redis(self, version: int) -> Optional[List[dict]]:
+        try:
+            data = await self.get_redis().get(CATEGORY_CACHE_KEY)
+        except RedisError as e:
+            print(f"category cache read failed {e}")
+            return None
+        cached = json.loads(data) if data else None
+        # rows loaded before the last invalidation aren't used
+        return cached['rows'] if isinstance(cached, dict) and cached.get('version') == version else None
+
+    async def write_redis(self, version: int, rows: List[dict]) -> None:
+        try:
+            await self.get_redis().set(
+                CATEGORY_CACHE_KEY, json.dumps({'version': version, 'rows': rows}), ex=self.redis_ttl,
+            )
+        except RedisError as e:
+            print(f"category cache write failed {e}")
+
+    async def get_table(self, load: Callable[[], Awaitable[List[dict]]]) -> CategoryTable:
+        """ The cached table, `load` reads it from EBMS when neither tier has the current version """
+        version = await self.read_version()
+        cached = self.local.get(CATEGORY_CACHE_KEY)
+        if cached is not None and (version is None or cached[0] == version):
+            return cached[1]
+        rows = await self.read_redis(version) if version is not None else None
+        if rows is None:
+            rows = await load()
+            if version is not None:
+                await self.write_redis(version, rows)
+        table = CategoryTable.from_rows(rows)
+        self.local.set(CATEGORY_CACHE_KEY, (version, table))
+        return table
+
+    async def invalidate(self) -> None:
+        self.local.invalidate()
+        try:
+            async with self.get_redis().pipeline() as pipe:
+                await pipe.incr(CATEGORY_VERSION_KEY).delete(CATEGORY_CACHE_KEY).execute()
+        except RedisError as e:
+            print(f"category cache invalidation failed {e}")
+
+
+category_cache = CategoryCache()
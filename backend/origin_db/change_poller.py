@@ -0,0 +1,259 @@
+"""
+Pushes changes made directly in EBMS to the `orders` and `items` websocket channels.
+
+EBMS has no change tracking we can use. Every EBMS_CHANGE_POLL_INTERVAL seconds only the rows in scope above the
+highest RECNO5 seen so far are read, they are the rows created since the last poll. Every
+EBMS_CHANGE_RECONCILE_INTERVAL seconds the rows in scope are grouped into RECNO5 buckets and only the CHECKSUM_AGG
+of every bucket is read, the rows of the buckets whose aggregate changed are compared with the previous snapshot.
+That sweep finds the deleted rows, and the updated ones, which don't move RECNO5 and can't be seen any sooner
+without a rowversion column. One message per channel carries the autoids created, updated and deleted since the
+last poll:
+
+    {"event": "changes", "created": [...], "updated": [...], "deleted": [...]}
+
+A line change also marks its order as updated. One worker polls at a time (redis lock), a worker which takes
+the lock over first reads a baseline and publishes nothing for that cycle.
+"""
+import asyncio
+import logging
+import time
+from typing import NamedTuple, Type, Optional, List
+
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+from sqlalchemy import select, func, Select
+
+from common.constants import OriginModelType
+from database import redis_pool
+from mssqqlserver_database import ebms_pool
+from origin_db.models import Arinv, Arinvdet
+from origin_db.services import invalidate_counts
+from origin_db.statements import statement_cache
+from settings import FILTERING_DATA_STARTING_YEAR, EBMS_CHANGE_POLL_INTERVAL, EBMS_CHANGE_RECONCILE_INTERVAL
+from websockets_connection.services_mapper import publish
+
+logger = logging.getLogger(__name__)
+
+POLL_LOCK_NAME = 'ebms_change_poller:poll'
+BUCKET_SIZE = 1000  # RECNO5 values per checksum bucket
+
+
+class WatchedTable(NamedTuple):
+    model: Type[OriginModelType]
+    subscribe: str
+    scope: tuple
+
+    @property
+    def columns(self) -> list:
+        return list(self.model.__table__.columns)
+
+    @property
+    def recno5(self):
+        return self.model.__table__.c.RECNO5
+
+
+WATCHED_TABLES = (
+    WatchedTable(Arinv, 'orders', (Arinv.status == 'U', Arinv.inv_date >= FILTERING_DATA_STARTING_YEAR)),
+    WatchedTable(Arinvdet, 'items', (Arinvdet.inv_date >= FILTERING_DATA_STARTING_YEAR,)),
+)
+
+
+class RowState(NamedTuple):
+    autoid: str
+    checksum: int
+    order: Optional[str]  # DOC_AID of a line
+
+
+class Changes:
+    def __init__(self):
+        self.created: set = set()
+        self.updated: set = set()
+        self.deleted: set = set()
+
+    def __bool__(self) -> bool:
+        return bool(self.created or self.updated or self.deleted)
+
+    def as_message(self) -> dict:
+        return {
+            "event": "changes",
+            "created": sorted(self.created),
+            "updated": sorted(self.updated - self.created - self.deleted),
+            "deleted": sorted(self.deleted),
+        }
+
+
+class EBMSChangePoller:
+    def __init__(
+            self, tables: tuple[WatchedTable, ...] = WATCHED_TABLES, interval: int = EBMS_CHANGE_POLL_INTERVAL,
+            reconcile_interval: int = EBMS_CHANGE_RECONCILE_INTERVAL,
+    ):
+        self.tables = tables
+        self.interval = interval
+        self.reconcile_interval = reconcile_interval
+        # per table: bucket -> (checksum, rows) of the last sweep, bucket -> {guid: RowState} and the highest RECNO5
+        self.buckets: dict[str, dict] = {}
+        self.rows: dict[str, dict[int, dict]] = {}
+        self.watermarks: dict[str, int] = {}
+        self.reconciled_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def fetch(self, query: Select) -> list:
+        statement = statement_cache.compile(query)
+        async with ebms_pool.cursor() as cursor:
+            await cursor.execute(statement.sql, *statement.params)
+            return await cursor.fetchall()
+
+    def get_bucket_query(self, table: WatchedTable) -> Select:
+        rows = select(
+            table.recno5.label('recno5'),
+            func.binary_checksum(*table.columns).label('checksum'),
+        ).where(*table.scope).subquery()
+        bucket = (rows.c.recno5 // BUCKET_SIZE).label('bucket')
+        return select(bucket, func.checksum_agg(rows.c.checksum), func.count(), func.max(rows.c.recno5)).group_by(bucket)
+
+    def get_rows_subquery(self, table: WatchedTable):
+        model = table.model
+        order = model.doc_aid if model is Arinvdet else None
+        return select(
+            table.recno5.label('recno5'),
+            (table.recno5 // BUCKET_SIZE).label('bucket'),
+            model.__table__.primary_key.columns[0].label('guid'),
+            model.autoid.label('autoid'),
+            func.binary_checksum(*table.columns).label('checksum'),
+            *([order.label('doc_aid')] if order is not None else []),
+        ).where(*table.scope).subquery()
+
+    def get_rows_query(self, table: WatchedTable, buckets: List[int]) -> Select:
+        rows = self.get_rows_subquery(table)
+        return select(rows).where(rows.c.bucket.in_(buckets))
+
+    def get_new_rows_query(self, table: WatchedTable, watermark: int) -> Select:
+        rows = self.get_rows_subquery(table)
+        return select(rows).where(rows.c.recno5 > watermark)
+
+    async def poll_new_rows(self, table: WatchedTable) -> tuple[Changes, set]:
+        """ The rows created since the last poll, read by RECNO5 above the watermark """
+        name = table.model.__tablename__
+        changes, orders = Changes(), set()
+        snapshot = self.rows.setdefault(name, {})
+        for row in await self.fetch(self.get_new_rows_query(table, self.watermarks[name])):
+            self.watermarks[name] = max(self.watermarks[name], row.recno5)
+            current = snapshot.setdefault(row.bucket, {})
+            if row.guid in current:
+                continue
+            # the bucket checksum is left as it was, the next sweep reads the bucket and finds the row known
+            state = RowState(row.autoid, row.checksum, getattr(row, 'doc_aid', None))
+            current[row.guid] = state
+            changes.created.add(state.autoid)
+            if state.order:
+                orders.add(state.order)
+        return changes, orders
+
+    async def poll_table(self, table: WatchedTable) -> tuple[Changes, set]:
+        """ Changed autoids of the table and the orders of the changed lines, by a checksum sweep of every bucket """
+        name = table.model.__tablename__
+        buckets, watermark = {}, self.watermarks.get(name, 0)
+        for bucket, checksum, count, max_recno5 in await self.fetch(self.get_bucket_query(table)):
+            buckets[bucket] = (checksum, count)
+            watermark = max(watermark, max_recno5)
+        previous = self.buckets.get(name)
+        changed_buckets = [
+            bucket for bucket in buckets.keys() | (previous or {}).keys()
+            if (previous or {}).get(bucket) != buckets.get(bucket)
+        ]
+
+        changes, orders = Changes(), set()
+        snapshot = self.rows.setdefault(name, {})
+        rows = {bucket: {} for bucket in changed_buckets}
+        for batch_start in range(0, len(changed_buckets), BUCKET_SIZE):
+            batch = changed_buckets[batch_start:batch_start + BUCKET_SIZE]
+            for row in await self.fetch(self.get_rows_query(table, batch)):
+                rows[row.bucket][row.guid] = RowState(row.autoid, row.checksum, getattr(row, 'doc_aid', None))
+        for bucket, current in rows.items():
+            old = snapshot.pop(bucket, {})
+            if current:
+                snapshot[bucket] = current
+            if previous is None:
+                continue
+            for guid, state in current.items():
+                if guid not in old:
+                    changes.created.add(state.autoid)
+                elif old[guid].checksum != state.checksum:
+                    changes.updated.add(state.autoid)
+                else:
+                    continue
+                if state.order:
+                    orders.add(state.order)
+            for guid in old.keys() - current.keys():
+                changes.deleted.add(old[guid].autoid)
+                if old[guid].order:
+                    orders.add(old[guid].order)
+        self.buckets[name] = buckets
+        self.watermarks[name] = watermark
+        return changes, orders
+
+    async def poll(self) -> None:
+        """ One cycle, every channel gets at most one message """
+        messages = {}
+        line_orders = set()
+        reconcile = self.reconciled_at is None or time.monotonic() - self.reconciled_at >= self.reconcile_interval
+        for table in self.tables:
+            if reconcile or table.model.__tablename__ not in self.watermarks:
+                changes, orders = await self.poll_table(table)
+            else:
+                changes, orders = await self.poll_new_rows(table)
+            line_orders |= orders
+            messages[table.subscribe] = changes
+            if changes:
+                invalidate_counts(table.model)
+        if line_orders and 'orders' in messages:
+            messages['orders'].updated |= line_orders
+        for subscribe, changes in messages.items():
+            if changes:
+                logger.info("EBMS changes on %s: %s", subscribe, changes.as_message())
+                await publish(subscribe, changes.as_message())
+        if reconcile:
+            self.reconciled_at = time.monotonic()
+
+    def reset(self) -> None:
+        self.buckets = {}
+        self.rows = {}
+        self.watermarks = {}
+        self.reconciled_at = None
+
+    async def run(self) -> None:
+        redis = aioredis.Redis(connection_pool=redis_pool)
+        lock = redis.lock(POLL_LOCK_NAME, timeout=self.interval * 3)
+        while True:
+            try:
+                if lock.local.token is None:
+                    if await lock.acquire(blocking=False):
+                        self.reset()
+                else:
+                    await lock.reacquire()
+                if lock.local.token is not None:
+                    await self.poll()
+            except LockError:
+                # another worker took over, its snapshot is the current one
+                lock.local.token = None
+                self.reset()
+            except Exception:
+                logger.exception("EBMS change poll failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+ebms_change_poller = EBMSChangePoller()
@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+from contextlib import contextmanager
+from typing import Type, AsyncIterator, Callable, Awaitable, List, Any, Iterator, get_args, get_origin
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from starlette.responses import StreamingResponse
+from starlette.types import Scope, Receive, Send
+from sqlalchemy import Select
+
+from common.constants import ExportFormat
+from origin_db.records import Record
+from origin_db.services import BaseService
+from settings import EBMS_EXPORT_BATCH_SIZE, EBMS_EXPORT_MAX_CONCURRENT
+from stages.services import ItemsService, SalesOrdersService
+
+MEDIA_TYPES = {
+    ExportFormat.csv: "text/csv",
+    ExportFormat.ndjson: "application/x-ndjson",
+}
+# seconds a client refused by ExportSlots is asked to wait
+EXPORT_RETRY_AFTER = 30
+
+
+def is_nested(annotation: Any) -> bool:
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return True
+    if get_origin(annotation) is list:
+        return True
+    return any(is_nested(arg) for arg in get_args(annotation))
+
+
+class ExportWriter:
+    """ Encodes records with the response schema, CSV has only the scalar fields, NDJSON the nested ones as well """
+
+    def __init__(self, schema: Type[BaseModel], export_format: ExportFormat, exclude: frozenset = frozenset()):
+        self.schema = schema
+        self.export_format = export_format
+        self.exclude = set(exclude)
+        self.columns = [
+            field.serialization_alias or name for name, field in schema.model_fields.items()
+            if name not in exclude and not is_nested(field.annotation)
+        ]
+
+    def header(self) -> str:
+        if self.export_format != ExportFormat.csv:
+            return ""
+        return ",".join(self.columns) + "\r\n"
+
+    def encode(self, objs: List[Record]) -> str:
+        rows = [
+            self.schema.model_validate(obj).model_dump(mode="json", by_alias=True, exclude=self.exclude)
+            for obj in objs
+        ]
+        if self.export_format == ExportFormat.ndjson:
+            return "".join(json.dumps(row) + "\n" for row in rows)
+        buffer = io.StringIO()
+        csv.DictWriter(buffer, fieldnames=self.columns, extrasaction="ignore").writerows(rows)
+        return buffer.getvalue()
+
+
+async def enrich_orders(orders: List[Record]) -> None:
+    """ The Postgres fields of the orders list, `completed` is the one of the stage statistics """
+    autoids = [order.autoid for order in orders]
+    statistics = await ItemsService().group_by_order_annotated_statistics(autoids=autoids)
+    sales_orders = await SalesOrdersService().list_by_orders(autoids=autoids)
+    statistics_data = {i.order: i for i in statistics}
+    sales_order_data = {i.order: i for i in sales_orders}
+    for order in orders:
+        if item := statistics_data.get(order.autoid):
+            order.start_date = item.min_date
+            order.end_date = item.max_date
+            order.completed = bool(item.completed)
+        if sales_order := sales_order_data.get(order.autoid):
+            order.sales_order = sales_order
+
+
+async def enrich_items(origin_items: List[Record]) -> None:
+    autoids = [origin_item.autoid for origin_item in origin_items]
+    statistics = await ItemsService().group_by_item_statistics(autoids=autoids)
+    related_items = await ItemsService().get_related_items_by_origin_items(autoids=autoids)
+    statistics_data = {i.origin_item: i for i in statistics}
+    items_data = {i.origin_item: i for i in related_items}
+    for origin_item in origin_items:
+        if item := statistics_data.get(origin_item.autoid):
+            origin_item.completed = item.completed
+        if item := items_data.get(origin_item.autoid):
+            origin_item.item = item
+
+
+async def export_rows(
+        service: BaseService, query: Select, writer: ExportWriter,
+        enrich: Callable[[List[Record]], Awaitable[None]], batch_size: int = EBMS_EXPORT_BATCH_SIZE,
+) -> AsyncIterator[str]:
+    """ The encoded rows of `query`, one chunk per batch, so only one batch is held in memory """
+    yield writer.header()
+    async for batch in service.stream_records(query, batch_size):
+        await enrich(batch)
+        yield writer.encode(batch)
+
+
+class ExportSlots:
+    """ Exports running at a time in this process, each one holds an EBMS connection until its last row is sent """
+
+    def __init__(self, limit: int = EBMS_EXPORT_MAX_CONCURRENT):
+        self.limit = limit
+        self.running = 0
+
+    def take(self) -> None:
+        if self.running >= self.limit:
+            raise HTTPException(
+                status_code=429, detail="Too many exports running, retry later",
+                headers={"Retry-After": str(EXPORT_RETRY_AFTER)},
+            )
+        self.running += 1
+
+    def release(self) -> None:
+        self.running -= 1
+
+    @contextmanager
+    def taken(self) -> Iterator[None]:
+        """ A slot for the export prepared in the block, given back here only if preparing it fails """
+        self.take()
+        try:
+            yield
+        except BaseException:
+            self.release()
+            raise
+
+
+export_slots = ExportSlots()
+
+
+class ExportResponse(StreamingResponse):
+    """
+    A streamed export, it gives back the slot of `export_slots` taken by the endpoint once sent, failed or
+    abandoned by the client.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            export_slots.release()
@@ -7,6 +7,7 @@ from pydantic import Field
 from common.filters import RenameFieldFilter
 from origin_db.models import Inprodtype, Arinvdet, Inventry, Arinv
 from origin_db.nested_filters import NestedOriginItemFilter
+from origin_db.staging import StagedKeysFilter
 
 
 class InventryFilter(RenameFieldFilter):
@@ -37,7 +38,7 @@ class CategoryFilter(RenameFieldFilter):
         }
 
 
-class OriginItemFilter(RenameFieldFilter):
+class OriginItemFilter(StagedKeysFilter):
     search: Optional[str] = None
     order_by: Optional[List[str]] = None
     ship_date: Optional[datetime] = None
@@ -79,7 +80,7 @@ class OriginItemFilter(RenameFieldFilter):
         )
 
 
-class OrderFilter(RenameFieldFilter):
+class OrderFilter(StagedKeysFilter):
     search: Optional[str] = None
     order_by: Optional[List[str]] = None
     order: Optional[str] = None
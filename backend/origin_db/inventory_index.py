@@ -0,0 +1,96 @@
+import asyncio
+import sys
+import time
+from typing import NamedTuple, Optional, List
+
+from sqlalchemy import select
+from sqlalchemy.sql.elements import ColumnElement
+
+from mssqqlserver_database import ebms_pool
+from origin_db.models import Inventry
+from origin_db.staging import staged_in
+from origin_db.statements import statement_cache
+from settings import LIST_EXCLUDED_PROD_TYPES, EBMS_INVENTORY_INDEX_REFRESH, EBMS_INVENTORY_INDEX_RELOAD
+
+
+class InventoryAttributes(NamedTuple):
+    prod_type: Optional[str]
+    rol_profil: Optional[str]
+    rol_color: Optional[str]
+
+
+def _intern(value: Optional[str]) -> Optional[str]:
+    # a few hundred distinct categories, profiles and colors are shared by every inventory id
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+class InventoryIndex:
+    """
+    INVENTRY id -> (prod_type, rol_profil, rol_color) held in process, so the item queries don't join INVENTRY.
+
+    New inventory (RECNO5 above the last loaded one) is read every EBMS_INVENTORY_INDEX_REFRESH seconds,
+    the whole table again every EBMS_INVENTORY_INDEX_RELOAD seconds to pick up edited and deleted rows.
+    """
+
+    def __init__(self, refresh: int = EBMS_INVENTORY_INDEX_REFRESH, reload: int = EBMS_INVENTORY_INDEX_RELOAD):
+        self.refresh_interval = refresh
+        self.reload_interval = reload
+        self.attributes: dict[str, InventoryAttributes] = {}
+        self.excluded_ids: frozenset[str] = frozenset()
+        self.watermark = 0
+        self.loaded_at = 0.0
+        self.refreshed_at = 0.0
+        self._lock: Optional[asyncio.Lock] = None
+
+    async def fetch(self, watermark: int = 0) -> List[tuple]:
+        query = select(
+            Inventry.recno5, Inventry.id, Inventry.prod_type, Inventry.rol_profil, Inventry.rol_color,
+        ).where(Inventry.recno5 > watermark)
+        statement = statement_cache.compile(query)
+        async with ebms_pool.cursor() as cursor:
+            await cursor.execute(statement.sql, *statement.params)
+            return await cursor.fetchall()
+
+    def apply(self, rows: List[tuple], attributes: dict[str, InventoryAttributes]) -> None:
+        for recno5, inventory_id, prod_type, rol_profil, rol_color in rows:
+            attributes[inventory_id] = InventoryAttributes(_intern(prod_type), _intern(rol_profil), _intern(rol_color))
+            self.watermark = max(self.watermark, recno5)
+        self.attributes = attributes
+        self.excluded_ids = frozenset(
+            inventory_id for inventory_id, values in attributes.items() if values.prod_type in LIST_EXCLUDED_PROD_TYPES
+        )
+
+    async def load(self) -> "InventoryIndex":
+        """ The index, reloaded or refreshed first when it is due """
+        now = time.monotonic()
+        if now - self.refreshed_at < self.refresh_interval and now - self.loaded_at < self.reload_interval:
+            return self
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            now = time.monotonic()
+            if not self.loaded_at or now - self.loaded_at >= self.reload_interval:
+                self.watermark = 0
+                self.apply(await self.fetch(), {})
+                self.loaded_at = self.refreshed_at = time.monotonic()
+            elif now - self.refreshed_at >= self.refresh_interval:
+                if rows := await self.fetch(self.watermark):
+                    self.apply(rows, dict(self.attributes))
+                self.refreshed_at = time.monotonic()
+        return self
+
+    def get(self, inventory_id: Optional[str]) -> Optional[InventoryAttributes]:
+        return self.attributes.get(inventory_id)
+
+    def listed_condition(self, column: ColumnElement) -> ColumnElement:
+        """
+        Lines whose inventory is known and not of an excluded category, through the smaller of the two id sets.
+        With the excluded ids a line pointing at an id missing from INVENTRY is kept, the INVENTRY join dropped it.
+        A long set is staged in a #temp table.
+        """
+        if len(self.excluded_ids) <= len(self.attributes) - len(self.excluded_ids):
+            return staged_in(column, sorted(self.excluded_ids), negate=True) if self.excluded_ids else column.is_not(None)
+        return staged_in(column, sorted(self.attributes.keys() - self.excluded_ids))
+
+
+inventory_index = InventoryIndex()
@@ -0,0 +1,321 @@
+"""
+Postgres copy of the open EBMS orders, their lines and the inventory.
+
+The list endpoints are read from the mirror while it is fresh enough (EBMS_MIRROR_MAX_STALENESS), so they don't
+compete with EBMS for SQL Server time. A single worker (redis lock) keeps it up to date:
+every EBMS_MIRROR_SYNC_INTERVAL seconds rows with a RECNO5 above the last synced one are upserted, every
+EBMS_MIRROR_RECONCILE_INTERVAL seconds the whole scope is compared by BINARY_CHECKSUM, changed rows are fetched
+again and rows which left the scope are deleted.
+
+The EBMS tables have no rowversion column and RECNO5 doesn't change on update, so edited rows only reach the mirror
+with the reconcile. The mirror is fresh while both the last sync and the last reconcile are recent enough, the
+staleness bound has to leave room for a reconcile interval.
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone, timedelta
+from typing import List, NamedTuple, Type, Optional, Iterable, Any, AsyncIterator
+
+import redis.asyncio as aioredis
+from redis.exceptions import LockError
+from sqlalchemy import (
+    Table, Column, MetaData, String, BigInteger, Integer, TIMESTAMP, select, func, delete, Select, Executable
+)
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.engine import Result
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.sql import operators, visitors
+from sqlalchemy.sql.elements import BinaryExpression, ClauseElement
+
+from common.cache import TTLCache
+from common.constants import OriginModelType
+from database import default_engine, redis_pool
+from mssqqlserver_database import ebms_pool
+from origin_db.models import Arinv, Arinvdet, Inventry
+from origin_db.statements import statement_cache, BufferedCursor
+from settings import (
+    FILTERING_DATA_STARTING_YEAR, EBMS_MIRROR_SCHEMA, EBMS_MIRROR_SYNC_INTERVAL, EBMS_MIRROR_RECONCILE_INTERVAL,
+    EBMS_MIRROR_MAX_STALENESS, EBMS_MIRROR_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+CHECKSUM_COLUMN = 'SYNC_CHECKSUM'
+SYNC_LOCK_NAME = 'ebms_mirror:sync'
+
+mirror_metadata = MetaData(schema=EBMS_MIRROR_SCHEMA)
+
+sync_state = Table(
+    'sync_state', mirror_metadata,
+    Column('table_name', String, primary_key=True),
+    Column('watermark', BigInteger, nullable=False, default=0),
+    Column('synced_at', TIMESTAMP(timezone=True)),
+    Column('reconciled_at', TIMESTAMP(timezone=True)),
+)
+
+
+class MirroredTable(NamedTuple):
+    model: Type[OriginModelType]
+    scope: tuple  # conditions of the EBMS rows kept in the mirror
+
+    @property
+    def name(self) -> str:
+        return self.model.__tablename__
+
+    @property
+    def columns(self) -> list:
+        return list(self.model.__table__.columns)
+
+    @property
+    def primary_key(self) -> Column:
+        return self.model.__table__.primary_key.columns[0]
+
+    @property
+    def recno5(self) -> Column:
+        return self.model.__table__.c.RECNO5
+
+
+MIRRORED_TABLES = (
+    MirroredTable(Arinv, (Arinv.status == 'U', Arinv.inv_date >= FILTERING_DATA_STARTING_YEAR)),
+    MirroredTable(Arinvdet, (Arinvdet.inv_date >= FILTERING_DATA_STARTING_YEAR,)),
+    MirroredTable(Inventry, ()),
+)
+
+
+def get_mirror_table(mirrored: MirroredTable) -> Table:
+    """ The mirror copy of an EBMS table, the same columns plus the checksum of the EBMS row """
+    key = f'{EBMS_MIRROR_SCHEMA}.{mirrored.name}'
+    if key in mirror_metadata.tables:
+        return mirror_metadata.tables[key]
+    return Table(
+        mirrored.name, mirror_metadata,
+        *[Column(column.name, column.type, primary_key=column.primary_key) for column in mirrored.columns],
+        Column(CHECKSUM_COLUMN, Integer),
+    )
+
+
+def coerce_value(value: Any) -> Any:
+    # SQL Server ignores trailing spaces of CHAR values when comparing, Postgres doesn't
+    if isinstance(value, str):
+        return value.rstrip(' ')
+    return value
+
+
+def case_insensitive_like(query: Select) -> Select:
+    """ The query with ILIKE instead of LIKE, LIKE is case insensitive in the EBMS collation and isn't in Postgres """
+
+    def replace(element: ClauseElement):
+        if isinstance(element, BinaryExpression) and element.operator in (operators.like_op, operators.not_like_op):
+            escape = element.modifiers.get('escape')
+            if element.operator is operators.like_op:
+                return element.left.ilike(element.right, escape=escape)
+            return element.left.not_ilike(element.right, escape=escape)
+
+    return visitors.replacement_traverse(query, {}, replace)
+
+
+def chunks(values: list, size: int) -> Iterable[list]:
+    for index in range(0, len(values), size):
+        yield values[index:index + size]
+
+
+class EBMSMirror:
+    def __init__(self, tables: Iterable[MirroredTable] = MIRRORED_TABLES, batch_size: int = EBMS_MIRROR_BATCH_SIZE):
+        self.tables = tuple(tables)
+        self.batch_size = batch_size
+        self.schema = EBMS_MIRROR_SCHEMA
+        self._states = TTLCache(ttl=5, maxsize=1)
+        self._task: Optional[asyncio.Task] = None
+
+    # reads
+
+    async def connect(self) -> AsyncConnection:
+        connection = await default_engine.connect()
+        # the EBMS models have no schema, run their statements on the mirror tables
+        return await connection.execution_options(schema_translate_map={None: self.schema})
+
+    async def execute_result(self, query: Select) -> Result:
+        """ Run an EBMS statement on the mirror, the rows are buffered before the connection is released """
+        connection = await self.connect()
+        try:
+            result = await connection.execute(case_insensitive_like(query))
+            return result.freeze()()
+        finally:
+            await connection.close()
+
+    async def execute(self, query: Select) -> BufferedCursor:
+        result = await self.execute_result(query)
+        return BufferedCursor([(key,) for key in result.keys()], result.all())
+
+    async def stream(self, query: Select, batch_size: int) -> AsyncIterator[BufferedCursor]:
+        """ Run an EBMS statement on the mirror with a server side cursor, `batch_size` rows at a time """
+        connection = await self.connect()
+        try:
+            result = await connection.stream(case_insensitive_like(query))
+            description = [(key,) for key in result.keys()]
+            async for rows in result.partitions(batch_size):
+                yield BufferedCursor(description, rows)
+        finally:
+            await connection.close()
+
+    async def execute_write(self, statement: Executable) -> None:
+        """ Apply a change already made in EBMS, so it is visible before the next sync """
+        connection = await self.connect()
+        try:
+            await connection.execute(statement)
+            await connection.commit()
+        finally:
+            await connection.close()
+
+    async def get_states(self) -> dict:
+        states = self._states.get('states')
+        if states is None:
+            async with default_engine.connect() as connection:
+                result = await connection.execute(
+                    select(sync_state.c.table_name, sync_state.c.synced_at, sync_state.c.reconciled_at)
+                )
+                # inserts are as old as the last sync, updates as old as the last reconcile
+                states = {
+                    table_name: min(synced_at, reconciled_at) if synced_at and reconciled_at else None
+                    for table_name, synced_at, reconciled_at in result.all()
+                }
+            self._states.set('states', states)
+        return states
+
+    async def is_fresh(self, models: Iterable[Type[OriginModelType]]) -> bool:
+        """ Every table of `models` was synced and reconciled within EBMS_MIRROR_MAX_STALENESS """
+        try:
+            states = await self.get_states()
+        except Exception:
+            logger.exception("EBMS mirror state is not readable")
+            return False
+        bound = datetime.now(timezone.utc) - timedelta(seconds=EBMS_MIRROR_MAX_STALENESS)
+        return all(states.get(model.__tablename__) and states[model.__tablename__] >= bound for model in models)
+
+    # sync
+
+    async def fetch_ebms_rows(self, query: Select) -> List[dict]:
+        statement = statement_cache.compile(query)
+        async with ebms_pool.cursor() as cursor:
+            await cursor.execute(statement.sql, *statement.params)
+            columns = [column[0] for column in cursor.description]
+            rows = await cursor.fetchall()
+        return [{column: coerce_value(value) for column, value in zip(columns, row)} for row in rows]
+
+    def get_ebms_query(self, mirrored: MirroredTable) -> Select:
+        checksum = func.binary_checksum(*mirrored.columns).label(CHECKSUM_COLUMN)
+        return select(*mirrored.columns, checksum).where(*mirrored.scope)
+
+    async def upsert(self, connection: AsyncConnection, mirrored: MirroredTable, rows: List[dict]) -> None:
+        table = get_mirror_table(mirrored)
+        for batch in chunks(rows, self.batch_size):
+            statement = pg_insert(table).values(batch)
+            statement = statement.on_conflict_do_update(
+                index_elements=[mirrored.primary_key.name],
+                set_={column.name: statement.excluded[column.name] for column in table.columns if not column.primary_key},
+            )
+            await connection.execute(statement)
+
+    async def get_state(self, connection: AsyncConnection, mirrored: MirroredTable) -> dict:
+        result = await connection.execute(select(sync_state).where(sync_state.c.table_name == mirrored.name))
+        state = result.mappings().one_or_none()
+        if state is None:
+            return {'table_name': mirrored.name, 'watermark': 0, 'synced_at': None, 'reconciled_at': None}
+        return dict(state)
+
+    async def save_state(self, connection: AsyncConnection, mirrored: MirroredTable, **values: Any) -> None:
+        statement = pg_insert(sync_state).values(table_name=mirrored.name, **values)
+        statement = statement.on_conflict_do_update(index_elements=[sync_state.c.table_name], set_=values)
+        await connection.execute(statement)
+
+    async def sync_table(self, mirrored: MirroredTable) -> int:
+        """ Upsert the EBMS rows added since the last sync, RECNO5 only grows """
+        async with default_engine.connect() as connection:
+            watermark = (await self.get_state(connection, mirrored))['watermark']
+        synced = 0
+        while True:
+            query = self.get_ebms_query(mirrored).where(mirrored.recno5 > watermark)
+            rows = await self.fetch_ebms_rows(query.order_by(mirrored.recno5).limit(self.batch_size))
+            if not rows:
+                break
+            watermark = rows[-1][mirrored.recno5.name]
+            async with default_engine.begin() as connection:
+                await self.upsert(connection, mirrored, rows)
+                await self.save_state(connection, mirrored, watermark=watermark)
+            synced += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        async with default_engine.begin() as connection:
+            await self.save_state(connection, mirrored, synced_at=datetime.now(timezone.utc))
+        return synced
+
+    async def reconcile_table(self, mirrored: MirroredTable) -> tuple[int, int]:
+        """ Fetch the rows whose checksum changed and delete the rows which left the scope """
+        reconciled_at = datetime.now(timezone.utc)
+        table = get_mirror_table(mirrored)
+        primary_key = mirrored.primary_key
+        ebms_query = select(primary_key, func.binary_checksum(*mirrored.columns).label(CHECKSUM_COLUMN)).where(*mirrored.scope)
+        ebms_checksums = {row[primary_key.name]: row[CHECKSUM_COLUMN] for row in await self.fetch_ebms_rows(ebms_query)}
+        async with default_engine.connect() as connection:
+            result = await connection.execute(select(table.c[primary_key.name], table.c[CHECKSUM_COLUMN]))
+            mirror_checksums = dict(result.all())
+        changed = [guid for guid, checksum in ebms_checksums.items() if mirror_checksums.get(guid) != checksum]
+        removed = list(mirror_checksums.keys() - ebms_checksums.keys())
+        for batch in chunks(changed, self.batch_size):
+            rows = await self.fetch_ebms_rows(self.get_ebms_query(mirrored).where(primary_key.in_(batch)))
+            async with default_engine.begin() as connection:
+                await self.upsert(connection, mirrored, rows)
+        async with default_engine.begin() as connection:
+            for batch in chunks(removed, self.batch_size):
+                await connection.execute(delete(table).where(table.c[primary_key.name].in_(batch)))
+            await self.save_state(connection, mirrored, reconciled_at=reconciled_at, synced_at=reconciled_at)
+        return len(changed), len(removed)
+
+    async def needs_reconcile(self, mirrored: MirroredTable) -> bool:
+        async with default_engine.connect() as connection:
+            reconciled_at = (await self.get_state(connection, mirrored))['reconciled_at']
+        bound = datetime.now(timezone.utc) - timedelta(seconds=EBMS_MIRROR_RECONCILE_INTERVAL)
+        return reconciled_at is None or reconciled_at < bound
+
+    async def sync(self) -> None:
+        for mirrored in self.tables:
+            synced = await self.sync_table(mirrored)
+            if synced:
+                logger.info("EBMS mirror %s: %s new rows", mirrored.name, synced)
+            if await self.needs_reconcile(mirrored):
+                changed, removed = await self.reconcile_table(mirrored)
+                logger.info("EBMS mirror %s reconciled: %s changed, %s removed", mirrored.name, changed, removed)
+
+    async def run(self) -> None:
+        redis = aioredis.Redis(connection_pool=redis_pool)
+        while True:
+            # every worker runs the loop, the one holding the lock syncs
+            lock = redis.lock(SYNC_LOCK_NAME, timeout=max(EBMS_MIRROR_RECONCILE_INTERVAL, EBMS_MIRROR_SYNC_INTERVAL * 4))
+            if await lock.acquire(blocking=False):
+                try:
+                    await self.sync()
+                except Exception:
+                    logger.exception("EBMS mirror sync failed")
+                finally:
+                    try:
+                        await lock.release()
+                    except LockError:
+                        logger.warning("EBMS mirror sync lock expired before the sync finished")
+            await asyncio.sleep(EBMS_MIRROR_SYNC_INTERVAL)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+ebms_mirror = EBMSMirror()
@@ -5,6 +5,7 @@ from fastapi_filter import FilterDepends
 
 from common.filters import RenameFieldFilter
 from origin_db.models import Arinv, Arinvdet, Inventry
+from origin_db.staging import StagedKeysFilter
 
 
 class NestedInventryFilter(RenameFieldFilter):
@@ -31,7 +32,7 @@ class NestedOrderFilter(RenameFieldFilter):
         }
 
 
-class NestedOriginItemFilter(RenameFieldFilter):
+class NestedOriginItemFilter(StagedKeysFilter):
     ship_date: Optional[date] = None
     weight: Optional[float] = None
     categories: Optional[NestedInventryFilter] = FilterDepends(NestedInventryFilter)
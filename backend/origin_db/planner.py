@@ -0,0 +1,97 @@
+"""
+Picks the database which narrows a combined /ebms/orders/ or /ebms/items/ filter first.
+
+By default the Postgres filter (items, sales orders) runs first and its autoids are pushed to EBMS. When the EBMS
+filter alone matches fewer rows, its autoids are read first and the Postgres filter only looks among them, so the
+list pushed back to EBMS is short as well. Postgres is estimated by its own planner (EXPLAIN), EBMS by the cached
+total of its count query. Without a cached total Postgres runs first, the total is counted in the background for
+the next request.
+"""
+import asyncio
+import json
+import logging
+import time
+from typing import Optional, List
+
+from sqlalchemy import Select
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.base import Executable
+from sqlalchemy.sql.elements import ClauseElement
+
+from common.constants import CountMode
+from database import default_session_maker
+from origin_db.services import BaseService
+from settings import EBMS_PLANNER_ENABLED, EBMS_PLANNER_MAX_KEYS
+
+logger = logging.getLogger(__name__)
+
+
+class Explain(Executable, ClauseElement):
+    """ EXPLAIN (FORMAT JSON) of a statement, which is planned but not run """
+    inherit_cache = False
+
+    def __init__(self, statement: Select):
+        self.statement = statement
+
+
+@compiles(Explain, "postgresql")
+def compile_explain(element: Explain, compiler, **kw) -> str:
+    return f"EXPLAIN (FORMAT JSON) {compiler.process(element.statement, **kw)}"
+
+
+class KeySetPlanner:
+    def __init__(self, enabled: bool = EBMS_PLANNER_ENABLED, max_keys: int = EBMS_PLANNER_MAX_KEYS):
+        self.enabled = enabled
+        self.max_keys = max_keys
+
+    @staticmethod
+    async def estimate_postgres(query: Select) -> int:
+        async with default_session_maker() as session:
+            plan = await session.scalar(Explain(query))
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+
+    @staticmethod
+    async def estimate_ebms(service: BaseService) -> Optional[int]:
+        """ The cached total of the EBMS filter alone, None (and a background count) if it isn't cached yet """
+        return await service.get_count(CountMode.estimate, count_query=await service.get_query_for_count())
+
+    async def read_ebms_autoids(self, service: BaseService) -> Optional[List[str]]:
+        result = await service.execute(await service.get_autoids_query(limit=self.max_keys + 1), own_connection=True)
+        autoids = [row[0] for row in await result.fetchall()]
+        # the cached total may be stale
+        return autoids if len(autoids) <= self.max_keys else None
+
+    async def plan(self, service: BaseService, postgres_query: Optional[Select]) -> Optional[List[str]]:
+        """ The EBMS autoids the Postgres filter has to look among, None when the Postgres filter runs first """
+        if not self.enabled or postgres_query is None or not service.filter or not service.filter.is_filtering_values:
+            return None
+        name = service.model.__tablename__
+        time_start = time.monotonic()
+        postgres_rows, ebms_rows = await asyncio.gather(
+            self.estimate_postgres(postgres_query), self.estimate_ebms(service),
+        )
+        estimated = time.monotonic() - time_start
+        if ebms_rows is None or ebms_rows > self.max_keys or ebms_rows >= postgres_rows:
+            logger.info(
+                "%s: postgres first, estimated postgres %s ebms %s rows in %.3fs", name, postgres_rows, ebms_rows, estimated,
+            )
+            return None
+        time_start = time.monotonic()
+        autoids = await self.read_ebms_autoids(service)
+        read = time.monotonic() - time_start
+        if autoids is None:
+            logger.info(
+                "%s: postgres first, ebms matched more than %s rows (estimated %s) in %.3fs",
+                name, self.max_keys, ebms_rows, read,
+            )
+            return None
+        logger.info(
+            "%s: ebms first, estimated postgres %s ebms %s rows in %.3fs, read %s ebms autoids in %.3fs",
+            name, postgres_rows, ebms_rows, estimated, len(autoids), read,
+        )
+        return autoids
+
+
+key_set_planner = KeySetPlanner()
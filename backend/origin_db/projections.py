@@ -0,0 +1,36 @@
+from typing import Optional, Iterable, Type, List
+
+from pydantic import BaseModel
+from sqlalchemy.orm import InstrumentedAttribute
+
+from common.constants import OriginModelType
+
+
+class Projection:
+    """
+    Columns of an EBMS model needed to serialize a response schema.
+
+    Without `fields` every schema field is selected, with `fields` (serialization names, e.g. "id,quantity")
+    only the requested ones, the rest of the schema is returned empty.
+    """
+
+    def __init__(self, model: Type[OriginModelType], schema: Type[BaseModel], fields: Optional[Iterable[str] | str] = None):
+        self.model = model
+        self.schema = schema
+        if isinstance(fields, str):
+            fields = [field.strip() for field in fields.split(",") if field.strip()]
+        self.fields = set(fields) if fields else None
+        self.attributes = []
+        for name, field in schema.model_fields.items():
+            if self.fields is None or name in self.fields or field.serialization_alias in self.fields:
+                self.attributes.append(field.alias or name)
+
+    def includes(self, attribute: str) -> bool:
+        return attribute in self.attributes
+
+    def get_columns(self, required: Iterable[str] = (), extra: Iterable[InstrumentedAttribute] = ()) -> List[InstrumentedAttribute]:
+        """ Mapped columns of the projection, `required` names and `extra` columns are always selected """
+        mapped = self.model.__mapper__.column_attrs.keys()
+        columns = [getattr(self.model, name) for name in (*self.attributes, *required) if name in mapped]
+        columns += [column for column in extra if isinstance(column, InstrumentedAttribute) and column.class_ is self.model]
+        return list(dict.fromkeys(columns))
@@ -1,10 +1,92 @@
-from select import select
+from typing import List, Optional
 
-from users.models import User
+from sqlalchemy import select, and_, exists, Select
+from sqlalchemy.orm import InstrumentedAttribute
+from sqlalchemy.sql.elements import ColumnElement
 
+from origin_db.models import Arinvdet, Arinv, Inventry
+from settings import FILTERING_DATA_STARTING_YEAR, LIST_EXCLUDED_PROD_TYPES
 
-async def get_list_of_orders(session):
-    stmt = select(User).where(User.username == "admin")
-    await session.execute(stmt)
-    await session.commit()
-    return {"message": "inserted"}
+ITEM_QUERY_GROUP_BY = "group_by"
+ITEM_QUERY_LOOKUP = "lookup"
+ITEM_QUERY_INDEX = "index"
+ITEM_QUERY_STRATEGIES = (ITEM_QUERY_GROUP_BY, ITEM_QUERY_LOOKUP, ITEM_QUERY_INDEX)
+
+# extra columns of an item row, by the attribute name they are loaded into
+ITEM_RELATED_COLUMNS = {
+    'category': Inventry.prod_type,
+    'profile': Inventry.rol_profil,
+    'color': Inventry.rol_color,
+    'customer': Arinv.name,
+    'order_status': Arinv.status,
+}
+
+
+def get_items_conditions() -> List:
+    return [
+        Arinvdet.inv_date >= FILTERING_DATA_STARTING_YEAR,
+        Arinvdet.par_time == '',
+        Arinvdet.inven != None,
+        Arinvdet.inven != '',
+        Arinv.status == 'U',
+    ]
+
+
+def build_items_group_by_query(columns: List, related_columns: dict[str, InstrumentedAttribute]) -> Select:
+    """ Joins ARINV and INVENTRY and collapses the duplicated rows with a GROUP BY over every selected column """
+    return select(
+        *columns,
+        *[column.label(name) for name, column in related_columns.items()],
+    ).where(
+        and_(
+            *get_items_conditions(),
+            Inventry.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES),
+        ),
+    ).join(Arinv, Arinvdet.doc_aid == Arinv.autoid).join(Inventry, Arinvdet.inven == Inventry.id).group_by(
+        *columns, *related_columns.values()
+    )
+
+
+def build_items_lookup_query(columns: List, related_columns: dict[str, InstrumentedAttribute]) -> Select:
+    """
+    Joins only ARINV (one row per line), INVENTRY is read with TOP 1 lookups and filtered with EXISTS,
+    so no row can be duplicated and the query doesn't need the GROUP BY.
+    """
+    selected_related = []
+    for name, column in related_columns.items():
+        if column.class_ is Inventry:
+            column = select(column).where(Inventry.id == Arinvdet.inven).correlate(Arinvdet).limit(1).scalar_subquery()
+        selected_related.append(column.label(name))
+    return select(*columns, *selected_related).where(
+        and_(
+            *get_items_conditions(),
+            exists().where(Inventry.id == Arinvdet.inven, Inventry.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES)),
+        ),
+    ).join(Arinv, Arinvdet.doc_aid == Arinv.autoid)
+
+
+def build_items_index_query(
+        columns: List, related_columns: dict[str, InstrumentedAttribute], listed_condition: ColumnElement,
+) -> Select:
+    """
+    Joins only ARINV, the category exclusion is `listed_condition` on INVEN from the inventory index
+    and the INVENTRY attributes are filled from the index after the rows are fetched.
+    """
+    selected_related = [column.label(name) for name, column in related_columns.items() if column.class_ is not Inventry]
+    return select(*columns, *selected_related).where(
+        and_(
+            *get_items_conditions(),
+            listed_condition,
+        ),
+    ).join(Arinv, Arinvdet.doc_aid == Arinv.autoid)
+
+
+def build_items_query(
+        strategy: str, columns: List, related_columns: dict[str, InstrumentedAttribute],
+        listed_condition: Optional[ColumnElement] = None,
+) -> Select:
+    if strategy == ITEM_QUERY_INDEX and listed_condition is not None:
+        return build_items_index_query(columns, related_columns, listed_condition)
+    if strategy == ITEM_QUERY_LOOKUP:
+        return build_items_lookup_query(columns, related_columns)
+    return build_items_group_by_query(columns, related_columns)
@@ -0,0 +1,76 @@
+from functools import lru_cache
+from typing import Type, Sequence, Any, Optional
+
+from pydantic import BaseModel
+from sqlalchemy import inspect
+from sqlalchemy.ext.hybrid import HybridExtensionType
+
+from common.constants import OriginModelType
+
+
+class Record:
+    """
+    Read only EBMS row without the SQLAlchemy instance state, the response schemas read it with from_attributes.
+
+    Like on a mapped instance, a column or hybrid attribute which wasn't selected reads as None,
+    any other attribute which wasn't set falls back to the schema default.
+    """
+    __slots__ = ()
+    model: Type[OriginModelType] = None
+    nullable: frozenset = frozenset()
+
+    def __init__(self, **values: Any):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for the slots which were never set
+        if name in self.nullable:
+            return None
+        raise AttributeError(f"{type(self).__name__} has no attribute {name}")
+
+    def __repr__(self) -> str:
+        values = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if hasattr(self, name))
+        return f"{type(self).__name__}({values})"
+
+
+@lru_cache(maxsize=None)
+def record_type(model: Type[OriginModelType], *schemas: Type[BaseModel], extra: tuple[str, ...] = ()) -> Type[Record]:
+    """ Record class with a slot for every column of `model` and every attribute the `schemas` read """
+    mapper = inspect(model)
+    columns = list(mapper.column_attrs.keys())
+    hybrids = [
+        name for name, descriptor in mapper.all_orm_descriptors.items()
+        if descriptor.extension_type is HybridExtensionType.HYBRID_PROPERTY
+    ]
+    fields = [field.alias or name for schema in schemas for name, field in schema.model_fields.items()]
+    slots = tuple(dict.fromkeys([*columns, *hybrids, *fields, *extra]))
+    return type(f"{model.__name__}Record", (Record,), {
+        "__slots__": slots,
+        "model": model,
+        "nullable": frozenset([*columns, *hybrids]),
+    })
+
+
+class RowHydrator:
+    """ Turns the rows of one statement into records, the column map is resolved once from the cursor description """
+
+    def __init__(self, record: Type[Record], description: Sequence[tuple], skip: int = 0):
+        self.record = record
+        names = [column[0].lower() for column in description]
+        slots = set(record.__slots__)
+        # `skip` trailing helper columns (e.g. the keyset values) are left out of the record
+        self.columns = [(index, name) for index, name in enumerate(names[:len(names) - skip]) if name in slots]
+        self.skip = skip
+
+    def __call__(self, row: Sequence[Any], **values: Any) -> Record:
+        obj = self.record.__new__(self.record)
+        for index, name in self.columns:
+            setattr(obj, name, row[index])
+        for name, value in values.items():
+            setattr(obj, name, value)
+        return obj
+
+    def tail(self, row: Sequence[Any]) -> Optional[list]:
+        """ Values of the skipped helper columns """
+        return list(row[len(row) - self.skip:]) if self.skip else None
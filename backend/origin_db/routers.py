@@ -1,48 +1,55 @@
 import time
 from datetime import datetime, timezone
+from typing import Optional, Iterable, Type, Union
 
-from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, BackgroundTasks, Query
 from fastapi_filter import FilterDepends
-from sqlalchemy import case
-from starlette.responses import JSONResponse
+from sqlalchemy.sql.elements import ColumnElement
+from starlette.responses import JSONResponse, StreamingResponse
 
+from common.constants import CountMode, Role, ExportFormat, SchemaType
 from common.utils import DateValidator
 from ebms_api.client import ArinvClient
+from ebms_api.outbox import ebms_outbox
 from mssqqlserver_database import get_cursor
+from origin_db.category_cache import category_cache
+from origin_db.export import (
+    ExportWriter, export_rows, enrich_orders, enrich_items, MEDIA_TYPES, ExportResponse, export_slots,
+)
 from origin_db.filters import CategoryFilter, OriginItemFilter, OrderFilter
 from origin_db.models import Arinvdet, Arinv
+from origin_db.planner import key_set_planner
+from origin_db.projections import Projection
 from origin_db.schemas import (
     ArinvRelatedArinvDetSchema, ArinPaginateSchema, ArinvDetPaginateSchema, CategoryPaginateSchema,
-    CategorySchema, ChangeShipDateSchema
+    CategorySchema, ChangeShipDateSchema, ArinvDetSchema, NormalizedArinPaginateSchema, NormalizedArinvDetPaginateSchema,
 )
 from origin_db.services import CategoryService, OriginOrderService, OriginItemService, InventryService
+from origin_db.staging import staged_positions
 from stages.filters import ItemFilter, SalesOrderFilter
+from stages.models import Item
 from stages.services import FlowsService, ItemsService, CapacitiesService, SalesOrdersService
 from stages.utils import send_data_to_ws
-from users.mixins import active_user_with_permission
+from users.mixins import active_user_with_permission, IsAuthenticatedAs
 from users.models import User
 
 router = APIRouter(prefix="/ebms", tags=["ebms"])
 
 
-@router.get("/orders/", response_model=ArinPaginateSchema)
-async def orders(
-        limit: int = 10, offset: int = 0,
-        ordering: str = None,
-        origin_order_filter: OrderFilter = FilterDepends(OrderFilter),
-        sales_order_filter: SalesOrderFilter = FilterDepends(SalesOrderFilter),
-        user: User = Depends(active_user_with_permission),
-
-):
-    print('orders')
-    time_start = time.time()
-
+async def apply_sales_order_filter(
+        origin_order_filter: OrderFilter, sales_order_filter: SalesOrderFilter, ordering: Optional[str],
+) -> Optional[ColumnElement]:
+    """ Narrows the orders by the sales order filter, returns the ordering by the sales order fields if requested """
     if ordering:
         sales_order_filter.order_by = sales_order_filter.remove_invalid_fields(ordering)
         origin_order_filter.order_by = origin_order_filter.remove_invalid_fields(ordering)
+    within = await key_set_planner.plan(
+        OriginOrderService(list_filter=origin_order_filter),
+        SalesOrdersService(list_filter=sales_order_filter).get_filtering_origin_orders_query(),
+    )
     filtering_sales_orders = await SalesOrdersService(
         list_filter=sales_order_filter
-    ).get_filtering_origin_orders_autoids()
+    ).get_filtering_origin_orders_autoids(within=within)
     extra_ordering = None
     ordering_orders = None
     if filtering_sales_orders:
@@ -50,7 +57,7 @@ async def orders(
             origin_order_filter.autoid__not_in = filtering_sales_orders
             ordering_orders = await SalesOrdersService(
                 list_filter=sales_order_filter
-            ).get_filtering_origin_orders_autoids(not_excluded=True)
+            ).get_filtering_origin_orders_autoids(not_excluded=True, within=within)
         else:
             origin_order_filter.autoid__in = filtering_sales_orders
 
@@ -64,9 +71,84 @@ async def orders(
         default_position = -1
         if ordering_filds.startswith('-'):
             default_position = len(ordering_orders) + 2
-        data_for_ordering = {v: i for i, v in enumerate(ordering_orders, 1)}
-        extra_ordering = case(data_for_ordering, value=Arinv.autoid, else_=default_position)
-    result = await OriginOrderService(list_filter=origin_order_filter).list(limit=limit, offset=offset, extra_ordering=extra_ordering)
+        extra_ordering = staged_positions(Arinv.autoid, ordering_orders, default_position, name='#order_positions')
+    return extra_ordering
+
+
+async def apply_item_filter(
+        origin_item_filter: OriginItemFilter, item_filter: ItemFilter, ordering: Optional[str],
+) -> Optional[ColumnElement]:
+    """ Narrows the origin items by the item filter, returns the ordering by the item fields if requested """
+    if ordering:
+        item_filter.order_by = item_filter.remove_invalid_fields(ordering)
+        origin_item_filter.order_by = origin_item_filter.remove_invalid_fields(ordering)
+    within = await key_set_planner.plan(
+        OriginItemService(list_filter=origin_item_filter),
+        ItemsService(list_filter=item_filter).get_filtering_origin_items_query(),
+    )
+    filtering_items = await ItemsService(list_filter=item_filter).get_filtering_origin_items_autoids(within=within)
+    extra_ordering = None
+    ordering_items = None
+    if filtering_items:
+        if item_filter.is_exclude:
+            print("excluded")
+            origin_item_filter.autoid__not_in = filtering_items
+            ordering_items = await ItemsService(
+                list_filter=item_filter
+            ).get_filtering_origin_items_autoids(not_excluded=True, within=within)
+        else:
+            print("included")
+            origin_item_filter.autoid__in = filtering_items
+    if not item_filter.is_filtering_values and item_filter.order_by:
+        filtering_items = await ItemsService(list_filter=item_filter).get_filtering_origin_items_autoids(do_ordering=True)
+    if item_filter.order_by:
+        ordering_items = filtering_items if not ordering_items else ordering_items
+        ordering_fields = ''.join(item_filter.order_by)
+        default_position = -1
+        if ordering_fields.startswith('-'):
+            default_position = len(ordering_items) + 2
+        extra_ordering = staged_positions(Arinvdet.autoid, ordering_items, default_position, name='#item_positions')
+    return extra_ordering
+
+
+def export_response(rows, name: str, export_format: ExportFormat) -> StreamingResponse:
+    return ExportResponse(
+        rows, media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{export_format.value}"'},
+    )
+
+
+def normalized_response(schema: Type[SchemaType], result: dict, items: Iterable[Item]) -> SchemaType:
+    """ `result` with the flows and stages of `items` once, the items reference them by id """
+    flows, stages = {}, {}
+    for item in items:
+        if item.flow_node is not None:
+            flows[item.flow_node.id] = item.flow_node
+            stages.update((stage.id, stage) for stage in item.flow_node.stages)
+        if item.stage_node is not None:
+            stages[item.stage_node.id] = item.stage_node
+    return schema.model_validate({**result, "flows": flows, "stages": stages})
+
+
+# the plain schema first, a dict result would validate as the normalized one as well
+@router.get("/orders/", response_model=Union[ArinPaginateSchema, NormalizedArinPaginateSchema])
+async def orders(
+        limit: int = 10, offset: int = 0,
+        ordering: str = None, cursor: str = None, count: CountMode = CountMode.exact, fields: str = None,
+        normalized: bool = False,
+        origin_order_filter: OrderFilter = FilterDepends(OrderFilter),
+        sales_order_filter: SalesOrderFilter = FilterDepends(SalesOrderFilter),
+        user: User = Depends(active_user_with_permission),
+        session=Depends(get_cursor),
+):
+    """ With `normalized` the flows and stages are returned once in `flows` and `stages`, items reference them by id """
+    print('orders')
+    time_start = time.time()
+    extra_ordering = await apply_sales_order_filter(origin_order_filter, sales_order_filter, ordering)
+    projection = Projection(Arinv, ArinvRelatedArinvDetSchema, fields=fields)
+    result = await OriginOrderService(list_filter=origin_order_filter, db_session=session, projection=projection).list(
+        limit=limit, offset=offset, cursor=cursor, count_mode=count, extra_ordering=extra_ordering
+    )
     print('connected to ebms', time.time() - time_start)
     autoids = [i.autoid for i in result["results"]]
     items_dates = await ItemsService().group_by_order_annotated_statistics(autoids=autoids)
@@ -85,7 +167,7 @@ async def orders(
             i.sales_order = order
         for detail in i.details:
             if item := items.get(detail.autoid):
-                detail.completed = True if item.stage and item.stage.name == 'Done' else False
+                detail.completed = True if item.stage_node and item.stage_node.name == 'Done' else False
                 detail.item = item
                 completed.append(detail.completed)
             else:
@@ -94,9 +176,30 @@ async def orders(
     origin_order_filter.reset_constants()
     sales_order_filter.reset_constants()
     print(time.time() - time_start)
+    if normalized:
+        return normalized_response(NormalizedArinPaginateSchema, result, items.values())
     return result
 
 
+@router.get("/orders/export/", response_class=StreamingResponse)
+async def export_orders(
+        ordering: str = None, export_format: ExportFormat = Query(default=ExportFormat.csv, alias="format"),
+        origin_order_filter: OrderFilter = FilterDepends(OrderFilter),
+        sales_order_filter: SalesOrderFilter = FilterDepends(SalesOrderFilter),
+        user: User = Depends(active_user_with_permission),
+):
+    """ Every filtered order without its lines, streamed in batches of EBMS_EXPORT_BATCH_SIZE """
+    # the slot is taken before any query, a request over the limit costs no EBMS time
+    with export_slots.taken():
+        extra_ordering = await apply_sales_order_filter(origin_order_filter, sales_order_filter, ordering)
+        service = OriginOrderService(list_filter=origin_order_filter)
+        query = await service.get_query(extra_ordering=extra_ordering)
+        origin_order_filter.reset_constants()
+        sales_order_filter.reset_constants()
+        writer = ExportWriter(ArinvRelatedArinvDetSchema, export_format, exclude=frozenset({'origin_items'}))
+        return export_response(export_rows(service, query, writer, enrich_orders), "orders", export_format)
+
+
 @router.get("/orders/{autoid}/", response_model=ArinvRelatedArinvDetSchema)
 async def order_retrieve(
         autoid: str,
@@ -120,7 +223,7 @@ async def order_retrieve(
         result.sales_order = order
     for detail in result.details:
         if item := items_data.get(detail.autoid):
-            detail.completed = True if item.stage and item.stage.name == 'Done' else False
+            detail.completed = True if item.stage_node and item.stage_node.name == 'Done' else False
             detail.item = item
             completed.append(detail.completed)
         else:
@@ -162,6 +265,18 @@ async def get_categories(
     return result
 
 
+@router.delete("/categories/cache/", response_model=dict)
+async def invalidate_categories_cache(user: User = Depends(IsAuthenticatedAs(Role.ADMIN))):
+    await category_cache.invalidate()
+    return {"message": "Categories cache cleared"}
+
+
+@router.get("/outbox/metrics/", response_model=dict)
+async def get_outbox_metrics(user: User = Depends(IsAuthenticatedAs(Role.ADMIN))):
+    """ Queue depth and drain rate of the EBMS API outbox """
+    return await ebms_outbox.get_metrics()
+
+
 @router.get("/categories/all/", response_model=list[CategorySchema])
 async def get_categories_all(
         item_filter: ItemFilter = FilterDepends(ItemFilter),
@@ -191,42 +306,23 @@ async def get_categories_all(
     return result
 
 
-@router.get("/items/", response_model=ArinvDetPaginateSchema)
+# the plain schema first, a dict result would validate as the normalized one as well
+@router.get("/items/", response_model=Union[ArinvDetPaginateSchema, NormalizedArinvDetPaginateSchema])
 async def get_items(
-        limit: int = 10, offset: int = 0, ordering: str = None,
+        limit: int = 10, offset: int = 0, ordering: str = None, cursor: str = None, count: CountMode = CountMode.exact,
+        fields: str = None, normalized: bool = False,
         origin_item_filter: OriginItemFilter = FilterDepends(OriginItemFilter),
         item_filter: ItemFilter = FilterDepends(ItemFilter),
         user: User = Depends(active_user_with_permission),
         session=Depends(get_cursor),
 ):
+    """ With `normalized` the flows and stages are returned once in `flows` and `stages`, items reference them by id """
     time_start = time.time()
-    if ordering:
-        item_filter.order_by = item_filter.remove_invalid_fields(ordering)
-        origin_item_filter.order_by = origin_item_filter.remove_invalid_fields(ordering)
-    filtering_items = await ItemsService(list_filter=item_filter).get_filtering_origin_items_autoids()
-    extra_ordering = None
-    ordering_items = None
-    if filtering_items:
-        if item_filter.is_exclude:
-            print("excluded")
-            origin_item_filter.autoid__not_in = filtering_items
-            ordering_items = await ItemsService(
-                list_filter=item_filter
-            ).get_filtering_origin_items_autoids(not_excluded=True)
-        else:
-            print("included")
-            origin_item_filter.autoid__in = filtering_items
-    if not item_filter.is_filtering_values and item_filter.order_by:
-        filtering_items = await ItemsService(list_filter=item_filter).get_filtering_origin_items_autoids(do_ordering=True)
-    if item_filter.order_by:
-        ordering_items = filtering_items if not ordering_items else ordering_items
-        ordering_fields = ''.join(item_filter.order_by)
-        default_position = -1
-        if ordering_fields.startswith('-'):
-            default_position = len(ordering_items) + 2
-        data_for_ordering = {v: i for i, v in enumerate(ordering_items, 1)}
-        extra_ordering = case(data_for_ordering, value=Arinvdet.autoid, else_=default_position)
-    result = await OriginItemService(list_filter=origin_item_filter, db_session=session).list(limit=limit, offset=offset, extra_ordering=extra_ordering)
+    extra_ordering = await apply_item_filter(origin_item_filter, item_filter, ordering)
+    projection = Projection(Arinvdet, ArinvDetSchema, fields=fields)
+    result = await OriginItemService(list_filter=origin_item_filter, db_session=session, projection=projection).list(
+        limit=limit, offset=offset, cursor=cursor, count_mode=count, extra_ordering=extra_ordering
+    )
     print('connected to ebms', time.time() - time_start)
     autoids = [i.autoid for i in result["results"]]
     items_statistic = await ItemsService().group_by_item_statistics(autoids=autoids)
@@ -241,9 +337,30 @@ async def get_items(
     origin_item_filter.reset_constants()
     item_filter.reset_constants()
     print(time.time() - time_start)
+    if normalized:
+        return normalized_response(NormalizedArinvDetPaginateSchema, result, related_items)
     return result
 
 
+@router.get("/items/export/", response_class=StreamingResponse)
+async def export_items(
+        ordering: str = None, export_format: ExportFormat = Query(default=ExportFormat.csv, alias="format"),
+        origin_item_filter: OriginItemFilter = FilterDepends(OriginItemFilter),
+        item_filter: ItemFilter = FilterDepends(ItemFilter),
+        user: User = Depends(active_user_with_permission),
+):
+    """ Every filtered item, streamed in batches of EBMS_EXPORT_BATCH_SIZE """
+    # the slot is taken before any query, a request over the limit costs no EBMS time
+    with export_slots.taken():
+        extra_ordering = await apply_item_filter(origin_item_filter, item_filter, ordering)
+        service = OriginItemService(list_filter=origin_item_filter)
+        query = await service.get_query(extra_ordering=extra_ordering)
+        origin_item_filter.reset_constants()
+        item_filter.reset_constants()
+        writer = ExportWriter(ArinvDetSchema, export_format)
+        return export_response(export_rows(service, query, writer, enrich_items), "items", export_format)
+
+
 @router.get("/calendar/{year}/{month}/", name="capacities_by_month", response_model=dict[str, dict])
 async def get_capacities_calendar(
         year: int, month: int, category_filter: CategoryFilter = FilterDepends(CategoryFilter),
@@ -283,7 +400,7 @@ async def partial_update_order(
     instance = await OriginOrderService(db_session=session).get_object_or_404(autoid=autoid)
     data_to_send = {key.upper(): value for key, value in origin_order.model_dump().items()}
     ebms_api_client = ArinvClient()
-    response = ebms_api_client.patch(ebms_api_client.retrieve_url(instance.autoid), data=data_to_send)
+    response = await ebms_api_client.patch(ebms_api_client.retrieve_url(instance.autoid), data=data_to_send)
     if response.status_code != 200:
         raise HTTPException(status_code=response.status_code, detail=response.text)
     date = datetime.strptime(origin_order.ship_date, "%m/%d/%Y")
@@ -295,5 +412,5 @@ async def partial_update_order(
 @router.get("/orders-api/{autoid}/", response_model=dict)
 async def get_item_by_ebms_api(autoid: str):
     ebms_api_client = ArinvClient()
-    response = ebms_api_client.get(ebms_api_client.retrieve_url(autoid))
+    response = await ebms_api_client.get(ebms_api_client.retrieve_url(autoid))
     return {"data": response.json()}
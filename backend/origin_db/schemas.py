@@ -1,10 +1,10 @@
 from datetime import date
 from decimal import Decimal
-from typing import List, Optional, Annotated
+from typing import List, Optional, Annotated, Dict
 
 from pydantic import BaseModel, Field, field_validator
 
-from stages.schemas import ItemSchema, SalesOrderSchema
+from stages.schemas import ItemSchema, SalesOrderSchema, NormalizedItemSchema, NormalizedFlowSchema, StageSchema
 
 
 class CategorySchema(BaseModel):
@@ -37,17 +37,17 @@ class ArinvDetSchema(BaseModel):
     id: str = Field(default=None, alias="autoid", serialization_alias="id")
     category: str | None = Field(default=None)
     description: str | None = Field(default=None, serialization_alias="description", alias="descr")
-    quantity: float = Field(default=0, serialization_alias='quantity', alias="quan")
-    shipped: float = Field(default=0, serialization_alias="shipped", alias="ship")
+    quantity: float | None = Field(default=0, serialization_alias='quantity', alias="quan")
+    shipped: float | None = Field(default=0, serialization_alias="shipped", alias="ship")
     ship_date: date | None | str = Field(default=None, serialization_alias="ship_date")
-    width: float = Field(default=0, serialization_alias="width", alias="widthd")
-    weight: float = Field(default=0, serialization_alias="weight")
-    length: float = Field(default=0, serialization_alias="length", alias="heightd")
-    bends: float = Field(default=0, serialization_alias="bends", alias="demd")
+    width: float | None = Field(default=0, serialization_alias="width", alias="widthd")
+    weight: float | None = Field(default=0, serialization_alias="weight")
+    length: float | None = Field(default=0, serialization_alias="length", alias="heightd")
+    bends: float | None = Field(default=0, serialization_alias="bends", alias="demd")
     customer: str | None = Field(default=None)
-    order: str = Field(default=None, serialization_alias="order", alias="invoice",)
-    id_inven: str = Field(default=None, serialization_alias="id_inven", alias="inven")
-    origin_order: str = Field(default=None, serialization_alias="origin_order", alias="doc_aid")
+    order: str | None = Field(default=None, serialization_alias="order", alias="invoice",)
+    id_inven: str | None = Field(default=None, serialization_alias="id_inven", alias="inven")
+    origin_order: str | None = Field(default=None, serialization_alias="origin_order", alias="doc_aid")
     completed: bool = Field(default=False)  # TODO: check this
     profile: str | None = Field(default=False)
     color: str | None = Field(default=None)
@@ -61,7 +61,7 @@ class ArinvDetSchema(BaseModel):
     @field_validator('order')
     @classmethod
     def validate_order(cls, v: str):
-        return v.strip()
+        return v.strip() if v else v
 
     @field_validator('ship_date')
     @classmethod
@@ -73,18 +73,18 @@ class ArinvDetSchema(BaseModel):
 
 class ArinvSchema(BaseModel):
     id: str = Field(default=None, alias="autoid", serialization_alias="id")
-    customer: str = Field(default=None, serialization_alias="customer", alias="name")
-    invoice: str = Field(default=None)
+    customer: str | None = Field(default=None, serialization_alias="customer", alias="name")
+    invoice: str | None = Field(default=None)
     ship_date: date | None | str = Field(default=None, serialization_alias="ship_date")
-    c_name: str = Field(default=None, serialization_alias="c_name")
-    c_city: str = Field(default=None, serialization_alias="c_city")
+    c_name: str | None = Field(default=None, serialization_alias="c_name")
+    c_city: str | None = Field(default=None, serialization_alias="c_city")
     start_date: date | None | str = Field(default=None, serialization_alias="start_date")
     end_date: date | None | str = Field(default=None, serialization_alias="end_date")
 
     @field_validator('invoice')
     @classmethod
     def validate_invoice(cls, v: str):
-        return v.strip()
+        return v.strip() if v else v
 
     @field_validator('start_date', 'end_date', 'ship_date')
     @classmethod
@@ -95,10 +95,10 @@ class ArinvSchema(BaseModel):
 
 
 class ArinvRelatedArinvDetSchema(ArinvSchema):
-    count_items: int = Field(default=0, serialization_alias="count_items")
+    count_items: int | None = Field(default=0, serialization_alias="count_items")
     completed: bool = Field(default=False)
     sales_order: SalesOrderSchema | None = Field(default=None)
-    origin_items: List[ArinvDetSchema] = Field(default=None, alias="details", serialization_alias="origin_items")
+    origin_items: List[ArinvDetSchema] | None = Field(default=None, alias="details", serialization_alias="origin_items")
 
     class Config:
         orm_mode = True
@@ -107,15 +107,43 @@ class ArinvRelatedArinvDetSchema(ArinvSchema):
 
 
 class ArinPaginateSchema(BaseModel):
-    count: int
+    count: Optional[int] = None
+    has_more: Optional[bool] = None
+    next_cursor: Optional[str] = None
     results: List[ArinvRelatedArinvDetSchema]
 
 
 class ArinvDetPaginateSchema(BaseModel):
-    count: int
+    count: Optional[int] = None
+    has_more: Optional[bool] = None
+    next_cursor: Optional[str] = None
     results: List[ArinvDetSchema]
 
 
+class NormalizedArinvDetSchema(ArinvDetSchema):
+    item: NormalizedItemSchema | None = Field(default=None)
+
+
+class NormalizedArinvRelatedArinvDetSchema(ArinvRelatedArinvDetSchema):
+    origin_items: List[NormalizedArinvDetSchema] | None = Field(
+        default=None, alias="details", serialization_alias="origin_items"
+    )
+
+
+class NormalizedArinPaginateSchema(ArinPaginateSchema):
+    """ ArinPaginateSchema with the flows and stages of the items once, the items reference them by id """
+    results: List[NormalizedArinvRelatedArinvDetSchema]
+    flows: Dict[int, NormalizedFlowSchema] = Field(default_factory=dict)
+    stages: Dict[int, StageSchema] = Field(default_factory=dict)
+
+
+class NormalizedArinvDetPaginateSchema(ArinvDetPaginateSchema):
+    """ ArinvDetPaginateSchema with the flows and stages of the items once, the items reference them by id """
+    results: List[NormalizedArinvDetSchema]
+    flows: Dict[int, NormalizedFlowSchema] = Field(default_factory=dict)
+    stages: Dict[int, StageSchema] = Field(default_factory=dict)
+
+
 class InventrySchema(BaseModel):
     autoid: str = Field(default=None)
     prod_type: str = Field(default=None)
@@ -0,0 +1,43 @@
+"""
+Order search backed by the trigram indexes of the Postgres mirror.
+
+SQL Server can only answer the `search` filter (LIKE '%value%' on the customer name and the invoice) with a scan
+of ARINV. While the mirror is fresh the matching autoids are read from its GIN trigram indexes instead, and the
+EBMS query gets them as `ARINV.AUTOID IN (...)`. Values shorter than a trigram, or matching more than
+EBMS_SEARCH_MAX_MATCHES orders, keep the LIKE filter.
+"""
+from typing import Optional, List
+
+from sqlalchemy import select, or_
+
+from origin_db.mirror import ebms_mirror
+from origin_db.models import Arinv
+from settings import EBMS_MIRROR_ENABLED, EBMS_SEARCH_MAX_MATCHES, FILTERING_DATA_STARTING_YEAR
+
+MIN_TRIGRAM_LENGTH = 3
+
+
+class OrderSearch:
+    def __init__(self, max_matches: int = EBMS_SEARCH_MAX_MATCHES):
+        self.max_matches = max_matches
+
+    async def search(self, value: str) -> Optional[List[str]]:
+        """ Autoids of the open orders whose name or invoice contains `value`, None if the mirror can't answer """
+        value = value.strip()
+        if not EBMS_MIRROR_ENABLED or len(value) < MIN_TRIGRAM_LENGTH:
+            return None
+        if not await ebms_mirror.is_fresh((Arinv,)):
+            return None
+        query = select(Arinv.autoid).where(
+            or_(Arinv.name.ilike(f"%{value}%"), Arinv.invoice.ilike(f"%{value}%")),
+            Arinv.status == 'U',
+            Arinv.inv_date >= FILTERING_DATA_STARTING_YEAR,
+        ).limit(self.max_matches + 1)
+        autoids = [autoid for autoid, in (await ebms_mirror.execute_result(query)).all()]
+        if len(autoids) > self.max_matches:
+            # an IN list this long costs more than the scan
+            return None
+        return autoids
+
+
+order_search = OrderSearch()
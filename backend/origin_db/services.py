@@ -1,55 +1,198 @@
+import asyncio
 import time
 from collections import defaultdict
 from datetime import datetime
-from typing import Generic, Type, Optional, List, NamedTuple
+from typing import Generic, Type, Optional, List, NamedTuple, Hashable, Any, AsyncIterator
 
-import sqlalchemy
+from aioodbc.cursor import Cursor
 from fastapi import HTTPException
 from fastapi_filter.contrib.sqlalchemy import Filter
-from sqlalchemy import select, ScalarResult, func, and_, case, Result, Sequence, union_all, literal, text, literal_column, Select, update
+from pyodbc import Error
+from sqlalchemy import select, ScalarResult, func, and_, case, Result, Sequence, union_all, literal, literal_column, Select, update, CursorResult, String, Integer, column
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import selectinload, Query, contains_eager
+from sqlalchemy.sql.elements import ColumnElement
+from sqlalchemy.sql.selectable import Subquery
 
-from common.constants import InputSchemaType, OriginModelType
+from common.cache import TTLCache
+from common.constants import InputSchemaType, OriginModelType, CountMode
 from common.filters import RenameFieldFilter
+from common.pagination import KEYSET_COLUMN_PREFIX, KeysetCursor, keyset_predicate
 from database import get_ebms_session, ebms_engine, get_ebms_engine, ebms_session_maker
+from mssqqlserver_database import ebms_pool
+from origin_db.category_cache import CategoryTable, category_cache, normalize
 from origin_db.filters import CategoryFilter
+from origin_db.mirror import ebms_mirror
 from origin_db.models import Inprodtype, Arinvdet, Arinv, Inventry
+from origin_db.projections import Projection
+from origin_db.inventory_index import inventory_index
+from origin_db.queries import build_items_query, ITEM_RELATED_COLUMNS, ITEM_QUERY_INDEX, ITEM_QUERY_LOOKUP
+from origin_db.records import Record, RowHydrator, record_type
 from origin_db.schemas import CategorySchema, ArinvDetSchema, ArinvRelatedArinvDetSchema, InventrySchema
-from settings import FILTERING_DATA_STARTING_YEAR, LIST_EXCLUDED_PROD_TYPES
+from origin_db.search import order_search
+from origin_db.staging import StagedKeys, load_staged_keys, inline_staged_keys, get_staged_rows, staged_in
+from origin_db.statements import statement_cache, BufferedCursor
+from settings import (
+    FILTERING_DATA_STARTING_YEAR, LIST_EXCLUDED_PROD_TYPES, EBMS_COUNT_CACHE_TTL, EBMS_COUNT_CACHE_MAXSIZE,
+    EBMS_ITEM_QUERY_STRATEGY, EBMS_MIRROR_ENABLED, EBMS_ORDER_DETAILS_BATCH, EBMS_STAGING_THRESHOLD,
+)
+
+# totals of the filtered lists keyed by (table name, fingerprint of the compiled count statement)
+count_cache = TTLCache(ttl=EBMS_COUNT_CACHE_TTL, maxsize=EBMS_COUNT_CACHE_MAXSIZE)
+count_refreshes: dict[Hashable, asyncio.Task] = {}
+
+
+async def get_items_listed_condition() -> Optional[ColumnElement]:
+    """ With the index item query strategy, the INVENTRY category exclusion as a condition on ARINVDET.INVEN """
+    if EBMS_ITEM_QUERY_STRATEGY != ITEM_QUERY_INDEX:
+        return None
+    return (await inventory_index.load()).listed_condition(Arinvdet.inven)
+
+
+def invalidate_counts(*models: Type[OriginModelType]) -> None:
+    """ Drop cached totals after EBMS data changed, all of them if no model is given """
+    if not models:
+        count_cache.invalidate()
+    for model in models:
+        count_cache.invalidate(model.__tablename__)
 
 
 class BaseService(Generic[OriginModelType, InputSchemaType]):
     default_ordering_field = 'recno5'
+    keyset_pagination = False
+    projection_required_fields = ('autoid', 'recno5')  # always selected by a projection
+    mirror_tables = ()  # EBMS tables the queries read, the service uses the mirror while all of them are fresh
+    record: Optional[Type[Record]] = None  # rows are hydrated into these, see origin_db/records.py
 
     def __init__(
             self, model: Type[OriginModelType],
             list_filter: Optional[RenameFieldFilter] = None,
-            db_session: Optional[AsyncSession] = None
+            db_session: Optional[AsyncSession] = None,
+            projection: Optional[Projection] = None,
     ):
         self.model = model
         self.filter = list_filter
         self.db_session = db_session
+        self.projection = projection
 
-    async def check_autoids_exist(self, autoid: [str]) -> None:
+    async def check_autoids_exist(self, autoid: [str]) -> Record:
         query = await self.get_query()
-        query = query.where(self.model.autoid == autoid)
-        sql_text = await self.to_sql(query)
-        async with ebms_session_maker.begin() as session:
-            obj = await session.scalars(text(sql_text))
-            try:
-                result = obj.one()
-            except NoResultFound:
-                raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
-            return result
+        objs = await self.fetch_records(query.where(self.model.autoid == autoid), own_connection=True)
+        if not objs:
+            raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
+        return objs[0]
 
-    async def to_sql(self, query: Select | Query) -> str:
-        return str(query.compile(compile_kwargs={"literal_binds": True}, dialect=sqlalchemy.dialects.mssql.dialect()))
+    def get_probe_query(self, autoids: List[str]) -> Select:
+        """ Only the keys of the rows in the scope of the service, for existence checks """
+        return select(self.model.autoid).where(
+            self.model.inv_date >= FILTERING_DATA_STARTING_YEAR,
+            self.model.autoid.in_(autoids),
+        )
+
+    async def probe_autoids(self, autoids: List[str]) -> List[Record]:
+        """ The rows of `autoids` which exist, with the columns of get_probe_query """
+        return await self.fetch_records(self.get_probe_query(autoids), own_connection=True)
+
+    async def use_mirror(self) -> bool:
+        return EBMS_MIRROR_ENABLED and bool(self.mirror_tables) and await ebms_mirror.is_fresh(self.mirror_tables)
+
+    async def execute(self, query: Select | Query, own_connection: bool = False) -> Cursor | BufferedCursor:
+        """ Run the query with bound parameters on the mirror, the request cursor or a separate pooled connection """
+        if await self.use_mirror():
+            return await ebms_mirror.execute(inline_staged_keys(query))
+        statement = statement_cache.compile(query)
+        if not own_connection:
+            await load_staged_keys(self.db_session, query)
+            return await self.db_session.execute(statement.sql, *statement.params)
+        async with ebms_pool.cursor() as cursor:
+            await load_staged_keys(cursor, query)
+            await cursor.execute(statement.sql, *statement.params)
+            return BufferedCursor(cursor.description, await cursor.fetchall())
+
+    async def execute_batch(self, *queries: Select | Query, own_connection: bool = False) -> List[BufferedCursor]:
+        """ The queries sent as one batch, their result sets are read one after the other from the same cursor """
+        if await self.use_mirror():
+            return [await ebms_mirror.execute(inline_staged_keys(query)) for query in queries]
+        statement = statement_cache.compile_batch(queries)
+        if own_connection or self.db_session is None:
+            async with ebms_pool.cursor() as cursor:
+                await load_staged_keys(cursor, *queries)
+                return await self.read_result_sets(cursor, statement.sql, statement.params, len(queries))
+        await load_staged_keys(self.db_session, *queries)
+        return await self.read_result_sets(self.db_session, statement.sql, statement.params, len(queries))
+
+    @staticmethod
+    async def read_result_sets(cursor: Cursor, sql: str, params: tuple, count: int) -> List[BufferedCursor]:
+        await cursor.execute(sql, *params)
+        results = []
+        for index in range(count):
+            if index:
+                await cursor.nextset()
+            results.append(BufferedCursor(cursor.description, await cursor.fetchall()))
+        return results
+
+    async def stream_records(self, query: Select | Query, batch_size: int) -> AsyncIterator[List[Record]]:
+        """
+        Records of the query in batches of `batch_size`, for results too big to buffer.
+        The rows are read with fetchmany from a pooled connection which is held until the iteration ends.
+        """
+        if await self.use_mirror():
+            async for result in ebms_mirror.stream(inline_staged_keys(query), batch_size):
+                yield await self.hydrate_result(result)
+            return
+        statement = statement_cache.compile(query)
+        async with ebms_pool.cursor() as cursor:
+            await load_staged_keys(cursor, query)
+            await cursor.execute(statement.sql, *statement.params)
+            hydrate = self.get_hydrator(cursor.description)
+            while rows := await cursor.fetchmany(batch_size):
+                yield self.prepare_objects([hydrate(row) for row in rows])
+
+    async def execute_with_sqlalchemy(self, session: AsyncSession, query: Select | Query) -> CursorResult | Result:
+        """ Run the query through the SQLAlchemy engine pool with bound parameters """
+        if await self.use_mirror():
+            return await ebms_mirror.execute_result(inline_staged_keys(query))
+        # the SQLAlchemy pool connection has no staged tables
+        query = inline_staged_keys(query)
+        statement = statement_cache.compile(query)
+        connection = await session.connection()
+        return await connection.exec_driver_sql(statement.sql, statement.params)
+
+    async def resolve_search(self) -> None:
+        """ The orders matched by `search`, from the mirror trigram indexes when the query itself runs on EBMS """
+        search = getattr(self.filter, 'search', None)
+        if not search or self.filter.search_resolved or await self.use_mirror():
+            return
+        autoids = await order_search.search(search)
+        if autoids is not None:
+            # up to EBMS_SEARCH_MAX_MATCHES autoids, staged apart from an autoid filter of the same statement
+            self.filter.resolve_search(staged_in(Arinv.autoid, autoids or ['-1'], name='#arinv_search'))
+
+    def get_projection_columns(self, **kwargs: Optional[dict]) -> list:
+        """ The whole entity, or only the projected columns plus the ones the ordering needs for GROUP BY """
+        if not self.projection:
+            return [self.model]
+        ordering = [expression for expression, _ in self.get_keyset_ordering(**kwargs)]
+        return self.projection.get_columns(required=self.projection_required_fields, extra=ordering)
 
     def dict_keys_to_lowercase(self, obj: dict) -> dict:
         return {k.lower(): v for k, v in obj.items()}
 
+    def get_hydrator(self, description: Sequence[tuple], skip: int = 0) -> RowHydrator:
+        return RowHydrator(self.record or record_type(self.model), description, skip=skip)
+
+    def prepare_objects(self, objs: list) -> list:
+        """ Hook to fill attributes which are not read by the query """
+        return objs
+
+    async def hydrate_result(self, result: Cursor | BufferedCursor) -> List[Record]:
+        hydrate = self.get_hydrator(result.description)
+        return self.prepare_objects([hydrate(row) for row in await result.fetchall()])
+
+    async def fetch_records(self, query: Select | Query, own_connection: bool = False) -> List[Record]:
+        return await self.hydrate_result(await self.execute(query, own_connection=own_connection))
+
     async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
         query = select(self.model).where(and_(self.model.inv_date >= FILTERING_DATA_STARTING_YEAR))
         if self.filter:
@@ -61,44 +204,143 @@ class BaseService(Generic[OriginModelType, InputSchemaType]):
             query = query.offset(offset)
         return query
 
+    async def get_autoids_query(self, limit: Optional[int] = None, **kwargs: Optional[dict]) -> Query:
+        """ Only the autoids of the filtered list, unordered """
+        query = await self.get_query(**kwargs)
+        query = query.with_only_columns(self.model.autoid, maintain_column_froms=True).order_by(None)
+        return query.limit(limit) if limit else query
+
     async def get_query_for_count(self, **kwargs: Optional[dict]) -> Query:
         query = await self.get_query(**kwargs)
         query = query.order_by(None).alias()
-        query = select(func.count('*')).select_from(query)
+        query = select(func.count()).select_from(query)
         return query
 
+    async def fetch_count(self, count_query: Query, own_connection: bool = False) -> int:
+        result = await self.execute(count_query, own_connection=own_connection)
+        return (await result.fetchone())[0]
+
+    async def refresh_count(self, key: Hashable, count_query: Query) -> None:
+        try:
+            count_cache.set(key, await self.fetch_count(count_query, own_connection=True))
+        except Error as e:
+            print(f"count refresh failed {e}")
+        finally:
+            count_refreshes.pop(key, None)
+
+    async def get_count(
+            self, count_mode: CountMode = CountMode.exact, count_query: Optional[Query] = None,
+            own_connection: bool = False, **kwargs: Optional[dict]
+    ) -> Optional[int]:
+        """ Total of the filtered list, cached by the compiled count statement """
+        if count_mode == CountMode.none:
+            return None
+        if count_query is None:
+            count_query = await self.get_query_for_count(**kwargs)
+        statement = statement_cache.compile(count_query)
+        key = (
+            self.model.__tablename__,
+            count_cache.fingerprint(statement.sql, statement.params, get_staged_rows(count_query)),
+        )
+        if count_mode == CountMode.estimate:
+            if not count_cache.is_fresh(key) and key not in count_refreshes:
+                count_refreshes[key] = asyncio.create_task(self.refresh_count(key, count_query))
+            return count_cache.get(key, allow_stale=True)
+        count = count_cache.get(key)
+        if count is None:
+            count = await self.fetch_count(count_query, own_connection=own_connection)
+            count_cache.set(key, count)
+        return count
+
     async def get_object_or_404(self, autoid: str) -> OriginModelType:
         obj = await self.get(autoid)
         return obj
 
-    async def paginated_list(self, limit: int = 10, offset: int = 0, **kwargs: Optional[dict],) -> dict:
+    def get_keyset_ordering(self, **kwargs: Optional[dict]) -> List[tuple]:
+        if self.filter:
+            return self.filter.get_ordering_expressions(**kwargs)
+        return [(getattr(self.model, self.default_ordering_field), False)]
+
+    async def get_keyset_query(
+            self, limit: int, offset: int = 0, cursor: Optional[str] = None, **kwargs: Optional[dict]
+    ) -> tuple[Query, int]:
+        """
+        Page query which also selects the sort values of every row, recno5 is the unique tie breaker.
+        With a cursor the page starts right after the encoded row instead of skipping `offset` rows.
+        """
+        ordering = self.get_keyset_ordering(**kwargs)
+        query = await self.get_query(**kwargs)
+        tie_breaker = getattr(self.model, self.default_ordering_field)
+        if not any(expression is tie_breaker for expression, _ in ordering):
+            ordering.append((tie_breaker, False))
+            query = query.order_by(tie_breaker)
+        query = query.add_columns(
+            *[expression.label(f"{KEYSET_COLUMN_PREFIX}{index}") for index, (expression, _) in enumerate(ordering)]
+        )
+        if cursor:
+            query = query.where(keyset_predicate(ordering, KeysetCursor.decode(cursor, len(ordering))))
+        elif offset:
+            query = query.offset(offset)
+        # one extra row tells if there is a next page
+        return query.limit(limit + 1), len(ordering)
+
+    async def get_page(
+            self, limit: int, offset: int = 0, cursor: Optional[str] = None, **kwargs: Optional[dict]
+    ) -> tuple[List[dict], Optional[str]]:
+        query, keyset_size = await self.get_keyset_query(limit=limit, offset=offset, cursor=cursor, **kwargs)
+        return await self.fetch_page(query, keyset_size, limit)
+
+    async def fetch_page(self, query: Query, keyset_size: int, limit: int) -> tuple[List[Record], Optional[str]]:
+        """ Records of the page and the cursor of the next page """
+        return await self.read_page(await self.execute(query), keyset_size, limit)
+
+    async def read_page(
+            self, data: Cursor | BufferedCursor, keyset_size: int, limit: int
+    ) -> tuple[List[Record], Optional[str]]:
+        data_all = await data.fetchall()
+        # the keyset_N columns are the last ones of the page query
+        hydrate = self.get_hydrator(data.description, skip=keyset_size)
+        list_objs = self.prepare_objects([hydrate(row) for row in data_all[:limit]])
+        next_cursor = KeysetCursor.encode(hydrate.tail(data_all[limit - 1])) if len(data_all) > limit else None
+        return list_objs, next_cursor
+
+    async def paginated_list(
+            self, limit: int = 10, offset: int = 0, cursor: Optional[str] = None,
+            count_mode: CountMode = CountMode.exact, **kwargs: Optional[dict],
+    ) -> dict:
 
-        count = await self.db_session.execute(await self.to_sql(await self.get_query_for_count(**kwargs)))
-        count = await count.fetchone()
-        query = await self.to_sql(await self.get_query(limit=limit, offset=offset, **kwargs))
-        data = await self.db_session.execute(await self.to_sql(await self.get_query(limit=limit, offset=offset, **kwargs)))
         time_start = time.time()
-        data_all = await data.fetchall()
-        columns = [column[0].lower() for column in data.description]
-        list_objs = [dict(zip(columns, data)) for data in data_all]
-        list_objs_as_model = []
-        for obj in list_objs:
-            list_objs_as_model.append(self.model(**obj))
+        next_cursor = None
+        if self.keyset_pagination:
+            count_query = await self.get_query_for_count(**kwargs) if count_mode != CountMode.none else None
+            page_query, keyset_size = await self.get_keyset_query(limit=limit, offset=offset, cursor=cursor, **kwargs)
+            count, (list_objs, next_cursor) = await asyncio.gather(
+                self.get_count(count_mode, count_query=count_query, own_connection=True),
+                self.fetch_page(page_query, keyset_size, limit),
+            )
+        else:
+            count = await self.get_count(count_mode, **kwargs)
+            list_objs = await self.fetch_records(await self.get_query(limit=limit, offset=offset, **kwargs))
         print(time.time() - time_start)
+        if self.keyset_pagination:
+            has_more = next_cursor is not None
+        else:
+            has_more = count is not None and offset + len(list_objs) < count
         return {
-            "count": count[0],
-            "results": list_objs_as_model,
+            "count": count,
+            "has_more": has_more,
+            "next_cursor": next_cursor,
+            "results": list_objs,
         }
 
     async def get_with_sqlalchemy(self, autoid: str) -> Optional[OriginModelType]:
         query = await self.get_query()
         query = query.where(self.model.autoid == autoid)
-        sql_text = await self.to_sql(query)
         async with ebms_session_maker() as session:
-            result = await session.execute(text(sql_text))
+            result = await self.execute_with_sqlalchemy(session, query)
         try:
             result = result.one()
-            return self.model(**self.dict_keys_to_lowercase(result._asdict()))
+            return self.prepare_objects([self.model(**self.dict_keys_to_lowercase(result._asdict()))])[0]
         except NoResultFound:
             raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
 
@@ -107,26 +349,19 @@ class BaseService(Generic[OriginModelType, InputSchemaType]):
             return await self.get_with_sqlalchemy(autoid)
         query = await self.get_query()
         query = query.where(self.model.autoid == autoid)
-        sql_text = await self.to_sql(query)
-        result = await self.db_session.execute(sql_text)
-        columns = [column[0].lower() for column in result.description]
-        try:
-            result = result.one()
-            return self.model(**zip(columns, result))
-        except NoResultFound:
+        result = await self.execute(query)
+        obj = await result.fetchone()
+        if not obj:
             raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
+        return self.prepare_objects([self.get_hydrator(result.description)(obj)])[0]
 
-    async def list(self, kwargs: Optional[dict] = None) -> Sequence[OriginModelType]:
+    async def list(self, kwargs: Optional[dict] = None) -> Sequence[Record]:
         query = await self.get_query()
-        objs: ScalarResult[OriginModelType] = await self.db_session.execute(await self.to_sql(query))
-        columns = [column[0].lower() for column in objs.description]
-        objs = await objs.fetchall()
-        list_objs = [self.model(**dict(zip(columns, data))) for data in objs]
-        return list_objs
+        return await self.fetch_records(query)
 
     async def get_listy_by_autoids(self, autoids: List[str] | set) -> Sequence[OriginModelType]:
-            query = await self.to_sql(select(self.model).where(self.model.autoid.in_(autoids)))
-            objs: ScalarResult[OriginModelType] = await self.db_session.execute(query)
+            query = select(self.model).where(self.model.autoid.in_(autoids))
+            objs: ScalarResult[OriginModelType] = await self.execute(query)
             columns = [column[0].lower() for column in objs.description]
             objs = await objs.fetchall()
             list_objs = [dict(zip(columns, data)) for data in objs]
@@ -150,19 +385,25 @@ class BaseService(Generic[OriginModelType, InputSchemaType]):
 
 
 class CategoryService(BaseService[Inprodtype, CategorySchema]):
+    record = record_type(Inprodtype, CategorySchema)
+
     def __init__(
             self, model: Type[Inprodtype] = Inprodtype,
             list_filter: Optional[CategoryFilter] = None,
-            db_session: Optional[AsyncSession] = None
+            db_session: Optional[AsyncSession] = None,
+            projection: Optional[Projection] = None,
     ):
-        super().__init__(model=model, list_filter=list_filter, db_session=db_session)
+        super().__init__(model=model, list_filter=list_filter, db_session=db_session, projection=projection)
 
-    async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
-        query = select(self.model).where(
+    def get_categories_query(self) -> Query:
+        return select(self.model).where(
             and_(
                 self.model.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES),
             )
         ).order_by(self.model.prod_type)
+
+    async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
+        query = self.get_categories_query()
         if self.filter:
             query = self.filter.filter(query, **kwargs)
         if limit:
@@ -171,10 +412,68 @@ class CategoryService(BaseService[Inprodtype, CategorySchema]):
             query = query.offset(offset)
         return query
 
-    async def get_category_autoid_by_name(self, name: str) -> Inprodtype:
+    async def load_categories(self) -> List[dict]:
+        result = await self.execute(self.get_categories_query(), own_connection=True)
+        columns = [column[0].lower() for column in result.description]
+        return [dict(zip(columns, row)) for row in await result.fetchall()]
+
+    async def get_categories(self) -> CategoryTable:
+        return await category_cache.get_table(self.load_categories)
+
+    def filter_categories(self, rows: List[dict]) -> List[dict]:
+        """ CategoryFilter applied to the cached rows """
+        if not self.filter:
+            return rows
+        if self.filter.name is not None:
+            rows = [row for row in rows if normalize(row['prod_type']) == normalize(self.filter.name)]
+        if self.filter.categories is not None:
+            names = {normalize(name) for name in self.filter.categories.split(",")}
+            rows = [row for row in rows if normalize(row['prod_type']) in names]
+        return rows
+
+    async def paginated_list(
+            self, limit: int = 10, offset: int = 0, cursor: Optional[str] = None,
+            count_mode: CountMode = CountMode.exact, **kwargs: Optional[dict],
+    ) -> dict:
+        rows = self.filter_categories((await self.get_categories()).rows)
+        page = rows[offset:offset + limit]
+        return {
+            "count": len(rows),
+            "has_more": offset + len(page) < len(rows),
+            "next_cursor": None,
+            "results": [self.record(**row) for row in page],
+        }
+
+    async def list(self, kwargs: Optional[dict] = None) -> Sequence[Record]:
+        rows = self.filter_categories((await self.get_categories()).rows)
+        return [self.record(**row) for row in rows]
+
+    async def get(self, autoid: str) -> Optional[Record]:
+        if row := (await self.get_categories()).by_autoid.get(autoid):
+            return self.record(**row)
+        # not cached yet, or really missing
+        return await super().get(autoid)
+
+    async def check_autoids_exist(self, autoid: [str]) -> Record | Inprodtype:
+        if row := (await self.get_categories()).by_autoid.get(autoid):
+            return self.record(**row)
+        return await super().check_autoids_exist(autoid)
+
+    async def probe_autoids(self, autoids: List[str]) -> List[Record]:
+        by_autoid = (await self.get_categories()).by_autoid
+        objs = [self.record(**by_autoid[autoid]) for autoid in autoids if autoid in by_autoid]
+        if missing := [autoid for autoid in autoids if autoid not in by_autoid]:
+            # not cached yet, or really missing
+            query = self.get_categories_query().order_by(None).where(self.model.autoid.in_(missing))
+            objs += await self.fetch_records(query, own_connection=True)
+        return objs
+
+    async def get_category_autoid_by_name(self, name: str) -> Record | Inprodtype:
+        if row := (await self.get_categories()).by_prod_type.get(normalize(name)):
+            return self.record(**row)
         smtp = await self.get_query()
         smtp = smtp.where(self.model.prod_type == name)
-        result = await self.db_session.execute(await self.to_sql(smtp))
+        result = await self.execute(smtp)
         obj = await result.fetchone()
         columns = [column[0].lower() for column in result.description]
         obj = dict(zip(columns, obj))
@@ -184,34 +483,44 @@ class CategoryService(BaseService[Inprodtype, CategorySchema]):
 
 
 class OriginItemService(BaseService[Arinvdet, ArinvDetSchema]):
+    keyset_pagination = True
+    mirror_tables = (Arinvdet, Arinv, Inventry)
+    record = record_type(Arinvdet, ArinvDetSchema)
+    # the INVENTRY based sort expressions are correlated on INVEN
+    projection_required_fields = ('autoid', 'recno5', 'doc_aid', 'inven')
+
     def __init__(
             self, model: Type[Arinvdet] = Arinvdet,
             list_filter: Optional[Filter] = None,
-            db_session: Optional[AsyncSession] = None
+            db_session: Optional[AsyncSession] = None,
+            projection: Optional[Projection] = None,
     ):
-        super().__init__(model=model, list_filter=list_filter, db_session=db_session)
+        super().__init__(model=model, list_filter=list_filter, db_session=db_session, projection=projection)
+
+    def get_related_columns(self) -> dict:
+        if self.projection:
+            return {name: column for name, column in ITEM_RELATED_COLUMNS.items() if self.projection.includes(name)}
+        return dict(ITEM_RELATED_COLUMNS)
+
+    def prepare_objects(self, objs: list) -> list:
+        """ With the index strategy the INVENTRY attributes of the lines come from the inventory index """
+        if EBMS_ITEM_QUERY_STRATEGY != ITEM_QUERY_INDEX:
+            return objs
+        related = {name: column.key for name, column in self.get_related_columns().items() if column.class_ is Inventry}
+        for obj in objs:
+            attributes = inventory_index.get(obj.inven)
+            for name, key in related.items():
+                setattr(obj, name, getattr(attributes, key) if attributes else None)
+        return objs
 
     async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
-        query = select(
-            self.model,
-            Inventry.prod_type.label('category'),
-            Inventry.rol_profil.label('profile'),
-            Inventry.rol_color.label('color'),
-            Arinv.name.label('customer'),
-            Arinv.status.label('order_status'),
-        ).where(
-            and_(
-                self.model.inv_date >= FILTERING_DATA_STARTING_YEAR,
-                Inventry.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES),
-                self.model.par_time == '',
-                self.model.inven != None,
-                self.model.inven != '',
-                Arinv.status == 'U'
-            ),
-        ).join(Arinv, Arinvdet.doc_aid == Arinv.autoid).join(Inventry, Arinvdet.inven == Inventry.id).group_by(
-            self.model, Inventry.prod_type, Inventry.rol_profil, Inventry.rol_color, Arinv.name, Arinv.status
-        )
+        columns = self.get_projection_columns(**kwargs)
+        related_columns = self.get_related_columns()
+        listed_condition = await get_items_listed_condition()
+        query = build_items_query(EBMS_ITEM_QUERY_STRATEGY, columns, related_columns, listed_condition)
         if self.filter:
+            # every item query strategy joins ARINV
+            await self.resolve_search()
             query = self.filter.filter(query, **kwargs)
             query = self.filter.sort(query, **kwargs)
         else:
@@ -222,24 +531,41 @@ class OriginItemService(BaseService[Arinvdet, ArinvDetSchema]):
             query = query.offset(offset)
         return query
 
-    async def list(self, limit: int = 10, offset: int = 0, **kwargs: Optional[dict]) -> dict:
-        return await self.paginated_list(limit=limit, offset=offset, **kwargs)
+    def get_probe_query(self, autoids: List[str], listed_condition: Optional[ColumnElement] = None) -> Select:
+        # one row per line without the GROUP BY, INVENTRY is only tested for the category exclusion
+        strategy = ITEM_QUERY_INDEX if listed_condition is not None else ITEM_QUERY_LOOKUP
+        columns = [self.model.autoid, self.model.doc_aid, self.model.inven]
+        return build_items_query(strategy, columns, {}, listed_condition).where(self.model.autoid.in_(autoids))
+
+    async def probe_autoids(self, autoids: List[str]) -> List[Record]:
+        query = self.get_probe_query(autoids, await get_items_listed_condition())
+        return await self.fetch_records(query, own_connection=True)
+
+    async def list(
+            self, limit: int = 10, offset: int = 0, cursor: Optional[str] = None,
+            count_mode: CountMode = CountMode.exact, **kwargs: Optional[dict]
+    ) -> dict:
+        return await self.paginated_list(limit=limit, offset=offset, cursor=cursor, count_mode=count_mode, **kwargs)
 
-    async def list_by_orders(self, autoids: List[str]):
+    async def list_by_orders(self, autoids: List[str]) -> List[Record]:
         query = await self.get_query()
-        stmt = query.where(self.model.doc_aid.in_(autoids))
-        objs = await self.db_session.execute(await self.to_sql(stmt))
-        columns = [column[0].lower() for column in objs.description]
-        objs = await objs.fetchall()
-        list_objs = [self.model(**dict(zip(columns, data))) for data in objs]
-        return list_objs
+        return await self.fetch_records(query.where(self.model.doc_aid.in_(autoids)))
+
+    async def get_by_orders_query(self, orders_query: Query) -> Query:
+        """ Details of the orders selected by `orders_query` """
+        query = await self.get_query()
+        orders = orders_query.subquery()
+        return query.where(self.model.doc_aid.in_(select(orders.corresponding_column(Arinv.autoid.expression))))
+
+    async def list_by_orders_query(self, orders_query: Query) -> List[Record]:
+        """ Details of the orders selected by `orders_query`, fetched on a separate pooled connection """
+        return await self.fetch_records(await self.get_by_orders_query(orders_query), own_connection=True)
 
     async def list_by_orders_with_sqlalchemy(self, autoids: List[str]):
         stmt = await self.get_query()
         stmt = stmt.where(self.model.doc_aid.in_(autoids))
-        sql_text = await self.to_sql(stmt)
         async with ebms_session_maker() as session:
-            objs = await session.execute(text(sql_text))
+            objs = await self.execute_with_sqlalchemy(session, stmt)
         return objs.all()
 
     async def get_origin_item_with_item(self, autoid: str):
@@ -248,57 +574,103 @@ class OriginItemService(BaseService[Arinvdet, ArinvDetSchema]):
     async def get_list_by_autoids_with_sqlalchemy(self, autoids: List[str] | set) -> Sequence[OriginModelType]:
         stmt = await self.get_query()
         stmt = stmt.where(self.model.autoid.in_(autoids))
-        sql_text = await self.to_sql(stmt)
         async with ebms_session_maker() as session:
-            result = await session.execute(text(sql_text))
+            result = await self.execute_with_sqlalchemy(session, stmt)
         list_objs = [self.model(**self.dict_keys_to_lowercase(data._asdict())) for data in result.all()]
-        return list_objs
+        return self.prepare_objects(list_objs)
 
     async def get_listy_by_autoids(self, autoids: List[str] | set) -> Sequence[OriginModelType]:
         if not self.db_session:
             return await self.get_list_by_autoids_with_sqlalchemy(autoids)
         stmt = await self.get_query()
-        stmt = stmt.where(self.model.autoid.in_(autoids))
-        result = await self.db_session.execute(await self.to_sql(stmt))
-        columns = [column[0].lower() for column in result.description]
-        objs = await result.fetchall()
-        list_objs = [self.model(**dict(zip(columns, data))) for data in objs]
-        return list_objs
+        return await self.fetch_records(stmt.where(self.model.autoid.in_(autoids)))
 
 
 class OriginOrderService(BaseService[Arinv, ArinvRelatedArinvDetSchema]):
+    keyset_pagination = True
+    mirror_tables = (Arinv, Arinvdet, Inventry)
+    record = record_type(Arinv, ArinvRelatedArinvDetSchema)
+    line_counts: Optional[Subquery] = None  # grouped line counts, joined while the list is sorted by count_items
+
     def __init__(
             self, model: Type[Arinv] = Arinv,
             list_filter: Optional[Filter] = None,
-            db_session: Optional[AsyncSession] = None
-
+            db_session: Optional[AsyncSession] = None,
+            projection: Optional[Projection] = None,
     ):
-        super().__init__(model=model, list_filter=list_filter, db_session=db_session)
+        super().__init__(model=model, list_filter=list_filter, db_session=db_session, projection=projection)
 
-    async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
+    def get_line_counts_query(self, listed_condition: Optional[ColumnElement] = None) -> Select:
+        """ Count of the listed lines, per order with a correlation or a GROUP BY on DOC_AID """
         query = select(
-            self.model,
-            select(
-                func.count(Arinvdet.doc_aid).label('count_items'),
-            ).join(Inventry, Arinvdet.inven == Inventry.id).where(
-                Arinvdet.doc_aid == self.model.autoid,
-                Arinvdet.inv_date >= FILTERING_DATA_STARTING_YEAR,
-                Inventry.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES),
-                Arinvdet.par_time == '',
-                Arinvdet.inven != None,
-                Arinvdet.inven != '',
-            ).correlate_except(
-                Arinvdet
-            ).scalar_subquery().label('count_items')
-        ).where(
+            func.count(Arinvdet.doc_aid).label('count_items'),
+        )
+        if listed_condition is None:
+            query = query.join(Inventry, Arinvdet.inven == Inventry.id)
+            listed_condition = Inventry.prod_type.notin_(LIST_EXCLUDED_PROD_TYPES)
+        return query.where(
+            Arinvdet.inv_date >= FILTERING_DATA_STARTING_YEAR,
+            listed_condition,
+            Arinvdet.par_time == '',
+            Arinvdet.inven != None,
+            Arinvdet.inven != '',
+        )
+
+    def get_count_items_column(self, listed_condition: Optional[ColumnElement] = None):
+        return self.get_line_counts_query(listed_condition).where(
+            Arinvdet.doc_aid == self.model.autoid,
+        ).correlate_except(
+            Arinvdet
+        ).scalar_subquery().label('count_items')
+
+    async def annotate_count_items(self) -> None:
+        """
+        Sorting by count_items needs the count of every order, so the line counts are grouped once and joined
+        instead of running the correlated count per order (and again for ORDER BY and the keyset column).
+        """
+        if self.line_counts is not None or not self.filter or not self.filter.is_ordering_by('count_items'):
+            return
+        self.line_counts = self.get_line_counts_query(await get_items_listed_condition()).add_columns(
+            Arinvdet.doc_aid.label('doc_aid'),
+        ).group_by(
+            Arinvdet.doc_aid,
+        ).subquery('line_counts')
+        self.filter.annotate(count_items=self.get_line_count_column())
+
+    def get_line_count_column(self) -> ColumnElement:
+        # the 0 is inlined, the expression is repeated in SELECT, ORDER BY and the keyset predicate of a grouped query
+        return func.coalesce(self.line_counts.c.count_items, literal_column('0'))
+
+    async def get_keyset_query(
+            self, limit: int, offset: int = 0, cursor: Optional[str] = None, **kwargs: Optional[dict]
+    ) -> tuple[Query, int]:
+        await self.annotate_count_items()
+        return await super().get_keyset_query(limit=limit, offset=offset, cursor=cursor, **kwargs)
+
+    async def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
+        await self.annotate_count_items()
+        columns = self.get_projection_columns(**kwargs)
+        count_items = []
+        group_by = []
+        if self.line_counts is not None:
+            # the orders without listed lines are kept by the outer join
+            count_items.append(self.get_line_count_column().label('count_items'))
+            group_by.append(self.line_counts.c.count_items)
+        elif not self.projection or self.projection.includes('count_items'):
+            count_items.append(self.get_count_items_column(await get_items_listed_condition()))
+        query = select(*columns, *count_items).where(
             and_(
                 self.model.inv_date >= FILTERING_DATA_STARTING_YEAR,
                 self.model.status == 'U',
             )
-        ).group_by(
-            self.model,
+        )
+        if self.line_counts is not None:
+            query = query.select_from(self.model).outerjoin(self.line_counts, self.line_counts.c.doc_aid == self.model.autoid)
+        query = query.group_by(
+            *columns, *group_by,
         )
         if self.filter:
+            await self.resolve_search()
             query = self.filter.filter(query, **kwargs)
             query = self.filter.sort(query, **kwargs)
         else:
@@ -309,54 +681,110 @@ class OriginOrderService(BaseService[Arinv, ArinvRelatedArinvDetSchema]):
             query = query.offset(offset)
         return query
 
+    def get_probe_query(self, autoids: List[str]) -> Select:
+        return super().get_probe_query(autoids).where(self.model.status == 'U')
+
     async def update_ship_date(self, autoids: List[str], ship_date: datetime) -> None:
         stmt = update(self.model).where(self.model.autoid.in_(autoids)).values(ship_date=ship_date)
         async with ebms_session_maker.begin() as session:
             await session.execute(stmt)
             await session.commit()
-
-    async def list(self, limit: int = 10, offset: int = 0, **kwargs: Optional[dict]) -> dict:
-        return await self.paginated_list(limit=limit, offset=offset, **kwargs)
-
-    async def paginated_list(self, limit: int = 10, offset: int = 0, **kwargs: Optional[dict],) -> dict:
+        if EBMS_MIRROR_ENABLED:
+            try:
+                await ebms_mirror.execute_write(stmt)
+            except Exception as e:
+                # the next reconcile picks the change up
+                print(f"mirror ship date update failed {e}")
+        invalidate_counts(Arinv, Arinvdet)
+
+    async def list(
+            self, limit: int = 10, offset: int = 0, cursor: Optional[str] = None,
+            count_mode: CountMode = CountMode.exact, **kwargs: Optional[dict]
+    ) -> dict:
+        return await self.paginated_list(limit=limit, offset=offset, cursor=cursor, count_mode=count_mode, **kwargs)
+
+    async def paginated_list(
+            self, limit: int = 10, offset: int = 0, cursor: Optional[str] = None,
+            count_mode: CountMode = CountMode.exact, **kwargs: Optional[dict],
+    ) -> dict:
         # async with ebms_session_maker.begin() as session:
         start_time = time.time()
-        count = await self.db_session.execute(await self.to_sql(await self.get_query_for_count(**kwargs)))
-        count = await count.fetchone()
-        query = await self.to_sql(await self.get_query(limit=limit, offset=offset, **kwargs))
-        data = await self.db_session.execute(query)
-        data_all = await data.fetchall()
-
-        columns = [column[0].lower() for column in data.description]
-        list_objs = [dict(zip(columns, data)) for data in data_all]
-        print("get orders as dict", time.time() - start_time)
-        orders_details = await OriginItemService(db_session=self.db_session).list_by_orders(autoids=[data['autoid'] for data in list_objs])
-        print("get orders details", time.time() - start_time)
+        # build every statement first, the filter keeps its join state between calls
+        count_query = await self.get_query_for_count(**kwargs) if count_mode != CountMode.none else None
+        page_query, keyset_size = await self.get_keyset_query(limit=limit, offset=offset, cursor=cursor, **kwargs)
+        details_service = None
+        if not self.projection:
+            details_service = OriginItemService()
+        elif self.projection.includes('details'):
+            details_service = OriginItemService(projection=Projection(Arinvdet, ArinvDetSchema))
+        count, (list_objs, next_cursor, orders_details) = await asyncio.gather(
+            self.get_count(count_mode, count_query=count_query, own_connection=True),
+            self.fetch_page_with_details(page_query, keyset_size, limit, details_service),
+        )
+        print("get orders with details", time.time() - start_time)
         time_start = time.time()
-        details = defaultdict(list)
-        for order_detail in orders_details:
-            details[order_detail.doc_aid].append(order_detail)
-        list_objs_as_model = []
-        for obj in list_objs:
-            list_objs_as_model.append(self.model(**self.dict_keys_to_lowercase(obj), details=details.get(obj['autoid'], [])))
+        self.attach_details(list_objs, orders_details)
         print(time.time() - time_start)
         return {
-            "count": count[0],
-            "results": list_objs_as_model,
+            "count": count,
+            "has_more": next_cursor is not None,
+            "next_cursor": next_cursor,
+            "results": list_objs,
         }
 
+    @staticmethod
+    def attach_details(orders: list, orders_details: list) -> None:
+        details = defaultdict(list)
+        for order_detail in orders_details:
+            details[order_detail.doc_aid].append(order_detail)
+        for obj in orders:
+            obj.details = details.get(obj.autoid, [])
+
+    async def fetch_page_with_details(
+            self, page_query: Query, keyset_size: int, limit: int, details_service: Optional["OriginItemService"],
+    ) -> tuple[List[Record], Optional[str], List[Record]]:
+        """ The page, its cursor and the details of its orders, with EBMS_ORDER_DETAILS_BATCH from one batch """
+        if details_service is None:
+            return *await self.fetch_page(page_query, keyset_size, limit), []
+        if not EBMS_ORDER_DETAILS_BATCH:
+            # the details don't wait for the page autoids, they select the same page as a subquery
+            (list_objs, next_cursor), details = await asyncio.gather(
+                self.fetch_page(page_query, keyset_size, limit),
+                details_service.list_by_orders_query(page_query),
+            )
+            return list_objs, next_cursor, details
+        details_query = await details_service.get_by_orders_query(page_query)
+        page, details = await self.execute_batch(page_query, details_query)
+        list_objs, next_cursor = await self.read_page(page, keyset_size, limit)
+        return list_objs, next_cursor, await details_service.hydrate_result(details)
+
+    async def get_with_details(self, autoid: str, own_connection: bool = False) -> Record:
+        """ The order and its details, from one batch with two result sets """
+        query = await self.get_query()
+        query = query.where(self.model.autoid == autoid)
+        details_service = OriginItemService()
+        details_query = await details_service.get_query()
+        details_query = details_query.where(details_service.model.doc_aid == autoid)
+        order, details = await self.execute_batch(query, details_query, own_connection=own_connection)
+        obj = await order.fetchone()
+        if not obj:
+            raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
+        return self.get_hydrator(order.description)(obj, details=await details_service.hydrate_result(details))
+
     async def get_with_sqlalchemy(self, autoid: str) -> Optional[OriginModelType]:
         print(f"get_by_sqlalchemy {autoid}")
+        if EBMS_ORDER_DETAILS_BATCH:
+            return await self.get_with_details(autoid, own_connection=True)
         query = await self.get_query()
         query = query.where(self.model.autoid == autoid)
-        sql_text = await self.to_sql(query)
         async with ebms_session_maker() as session:
-            result = await session.execute(text(sql_text))
+            result = await self.execute_with_sqlalchemy(session, query)
             print(result)
             details = await OriginItemService().list_by_orders_with_sqlalchemy(autoids=[autoid])
         try:
             result = result.one()
             data_details = [Arinvdet(**self.dict_keys_to_lowercase(detail._asdict())) for detail in details]
+            data_details = OriginItemService().prepare_objects(data_details)
             print(data_details)
             order = self.model(**self.dict_keys_to_lowercase(result._asdict()))
             order.details_data = data_details
@@ -367,9 +795,8 @@ class OriginOrderService(BaseService[Arinv, ArinvRelatedArinvDetSchema]):
     async def get_origin_order_by_autoids_with_sqlalchemy(self, autoids: List[str] | set) -> Sequence[str] | None:
         query = await self.get_query()
         query = query.where(self.model.autoid.in_(autoids))
-        sql_text = await self.to_sql(query)
         async with ebms_session_maker() as session:
-            result = await session.execute(text(sql_text))
+            result = await self.execute_with_sqlalchemy(session, query)
             list_objs = [self.model(**self.dict_keys_to_lowercase(data._asdict())) for data in result.all()]
         return list_objs
 
@@ -377,45 +804,45 @@ class OriginOrderService(BaseService[Arinv, ArinvRelatedArinvDetSchema]):
         if self.db_session is None:
             return await self.get_with_sqlalchemy(autoid)
         print(self.db_session)
+        if EBMS_ORDER_DETAILS_BATCH:
+            return await self.get_with_details(autoid)
         query = await self.get_query()
         query = query.where(self.model.autoid == autoid)
-        sql_text = await self.to_sql(query)
-        result = await self.db_session.execute(sql_text)
+        result = await self.execute(query)
         obj = await result.fetchone()
         if not obj:
             raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
-        columns = [column[0].lower() for column in result.description]
-
         details = await OriginItemService(db_session=self.db_session).list_by_orders(autoids=[autoid])
-        try:
-
-            result = dict(zip(columns, obj))
-            data_details = details
-            return self.model(**result, details=data_details)
-        except NoResultFound:
-            raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {autoid} not found")
+        return self.get_hydrator(result.description)(obj, details=details)
 
     async def get_origin_order_by_autoids(self, autoids: List[str] | set) -> Sequence[str] | None:
+        if self.db_session is None:
+            return await self.get_origin_order_by_autoids_with_sqlalchemy(autoids)
         query = await self.get_query()
         query = query.where(self.model.autoid.in_(autoids))
-        sql_text = await self.to_sql(query)
-        result = await self.db_session.execute(text(sql_text))
-        objs = await result.fetchall()
-        columns = [column[0].lower() for column in result.description]
-        list_objs = [self.model(**dict(zip(columns, obj))) for obj in objs]
-        return list_objs
+        return await self.fetch_records(query)
+
+
+class CategoryCapacity(NamedTuple):
+    prod_type: str
+    total_capacity: Any
 
 
 class InventryService(BaseService[Inventry, InventrySchema]):
+    record = record_type(Inventry, InventrySchema)
+
     def __init__(
             self, model: Type[Inventry] = Inventry,
             list_filter: Optional[Filter] = None,
-            db_session: Optional[AsyncSession] = None
+            db_session: Optional[AsyncSession] = None,
+            projection: Optional[Projection] = None,
     ):
-        super().__init__(model=model, list_filter=list_filter, db_session=db_session)
+        super().__init__(model=model, list_filter=list_filter, db_session=db_session, projection=projection)
 
-    async def count_capacity(self, autoids: list[str]) -> Result:
+    async def count_capacity(self, autoids: list[str]) -> Result | List[CategoryCapacity]:
         """  Return total capacity for an inventory group by prod type """
+        if EBMS_ITEM_QUERY_STRATEGY == ITEM_QUERY_INDEX:
+            return await self.count_capacity_with_index(autoids)
         stmt = select(
             self.model.prod_type.label("prod_type"),
             func.sum(case(
@@ -431,7 +858,29 @@ class InventryService(BaseService[Inventry, InventrySchema]):
             self.model.prod_type
         )
         async with ebms_session_maker.begin() as session:
-            return await session.execute(text(await self.to_sql(stmt)))
+            return await self.execute_with_sqlalchemy(session, stmt)
+
+    async def count_capacity_with_index(self, autoids: list[str]) -> List[CategoryCapacity]:
+        """ count_capacity grouped by INVEN, the categories of the inventory ids come from the inventory index """
+        stmt = select(
+            Arinvdet.inven.label("inven"),
+            func.sum(Arinvdet.demd).label("trim_capacity"),
+            func.sum(case(
+                (Arinvdet.heightd != 0, ((Arinvdet.heightd / 12) * Arinvdet.quan)),
+                else_=Arinvdet.quan
+            )).label("capacity"),
+        ).where(
+            Arinvdet.autoid.in_(autoids), await get_items_listed_condition(), Arinvdet.par_time == '',
+        ).group_by(
+            Arinvdet.inven
+        )
+        # a pooled connection, the long id set of the listed condition is staged on it
+        result = await self.execute(stmt, own_connection=True)
+        totals = defaultdict(int)
+        for row in await result.fetchall():
+            if attributes := inventory_index.get(row.inven):
+                totals[attributes.prod_type] += (row.trim_capacity if attributes.prod_type == 'Trim' else row.capacity) or 0
+        return [CategoryCapacity(prod_type, total) for prod_type, total in totals.items()]
 
     async def count_capacity_by_days(self, items_data: dict, list_categories = None) -> Sequence[Result]:
         """  Return total capacity for an inventory group by prod type with count arinv"""
@@ -439,6 +888,8 @@ class InventryService(BaseService[Inventry, InventrySchema]):
         list_categories = list_categories or []
         for autoid, date in items_data.items():
             compair_data[date.strftime('%Y-%m-%d')].append(autoid)
+        if len(items_data) >= EBMS_STAGING_THRESHOLD:
+            return await self.count_capacity_by_staged_days(compair_data, list_categories)
         list_subqueries = []
         for production_date, autoids in compair_data.items():
             stmt = select(
@@ -465,8 +916,43 @@ class InventryService(BaseService[Inventry, InventrySchema]):
             list_subqueries_alias.c.production_date, list_subqueries_alias.c.total_capacity, list_subqueries_alias.c.prod_type,
             list_subqueries_alias.c.count_orders,
         )
-        result = await self.db_session.execute(await self.to_sql(stmt))
+        result = await self.execute(stmt)
         objs = await result.fetchall()
         columns = [column[0].lower() for column in result.description]
         result = [dict(zip(columns, obj)) for obj in objs]
         return result
+
+    async def count_capacity_by_staged_days(self, autoids_by_day: dict, list_categories: list) -> List[dict]:
+        """ count_capacity_by_days with the items staged with the number of their day, one grouped query for all days """
+        days = list(autoids_by_day)
+        staged = StagedKeys(
+            '#capacity_days',
+            [(autoid, index) for index, day in enumerate(days) for autoid in autoids_by_day[day]],
+            column('AUTOID', String), column('POSITION', Integer),
+        )
+        stmt = select(
+            self.model.prod_type.label('prod_type'),
+            staged.c.POSITION.label('day'),
+            func.count(Arinvdet.doc_aid).label("count_orders"),
+            func.sum(case(
+                (self.model.prod_type == 'Trim', Arinvdet.demd),
+                (Arinvdet.heightd != 0, ((Arinvdet.heightd / 12) * Arinvdet.quan)),
+                else_=Arinvdet.quan
+            )).label("total_capacity"),
+        ).join(
+            self.model.arinvdet,
+        ).join(
+            staged, staged.c.AUTOID == Arinvdet.autoid,
+        ).where(
+            Inventry.prod_type.in_(list_categories), Arinvdet.par_time == '',
+        ).group_by(
+            self.model.prod_type, staged.c.POSITION,
+        )
+        result = await self.execute(stmt)
+        return [
+            {
+                'production_date': days[row.day], 'total_capacity': row.total_capacity,
+                'prod_type': row.prod_type, 'count_orders': row.count_orders,
+            }
+            for row in await result.fetchall()
+        ]
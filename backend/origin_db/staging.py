@@ -0,0 +1,151 @@
+"""
+Key sets staged in temp tables of the EBMS connection.
+
+Orders and items are filtered and sorted by Postgres data, which reaches SQL Server as lists of autoids. A list of
+at least EBMS_STAGING_THRESHOLD keys is not written into the statement (one IN value or CASE branch per key, inlined
+once the statement has more than 2000 parameters), it is loaded into a #temp table of the connection running the
+statement right before it runs, and the statement reads the table. The mirror gets the statement with the inline
+form instead.
+"""
+from typing import List, Sequence, Iterable, TypeVar, Any, Optional
+
+from aioodbc.cursor import Cursor
+from sqlalchemy import Integer, String, select, func, case, literal_column
+from sqlalchemy.sql import visitors
+from sqlalchemy.sql.elements import ColumnElement, ClauseElement
+from sqlalchemy.sql.expression import TableClause, column
+
+from common.filters import RenameFieldFilter
+from origin_db.category_cache import normalize
+from origin_db.statements import MAX_STATEMENT_PARAMS
+from settings import EBMS_STAGING_THRESHOLD
+
+# SQL Server accepts at most 1000 rows in one VALUES list
+MAX_INSERT_ROWS = 1000
+
+StatementType = TypeVar("StatementType", bound=ClauseElement)
+
+
+class StagedKeys(TableClause):
+    """
+    A #temp table with the rows it is loaded with.
+
+    The rows are not part of the cache key, statements which differ only by them share the compiled SQL.
+    `inline` keeps the expression to send instead of each one reading the table, for connections without it.
+    """
+    inherit_cache = True
+
+    def __init__(self, name: str, rows: Sequence[tuple], *columns: ColumnElement):
+        super().__init__(name, *columns)
+        # the first column is the primary key, SQL Server compares it without trailing spaces and case insensitive
+        unique = {}
+        for row in rows:
+            unique.setdefault(normalize(row[0]), row)
+        self.rows = list(unique.values())
+        self.inline: dict[int, ColumnElement] = {}  # id() of the expression reading the table -> inline form
+
+    def get_create_sql(self) -> str:
+        # DATABASE_DEFAULT, a temp table gets the collation of tempdb otherwise and can't be compared with AUTOID
+        definitions = ", ".join(
+            f"{key.name} VARCHAR(64) COLLATE DATABASE_DEFAULT NOT NULL PRIMARY KEY" if index == 0
+            else f"{key.name} INT NOT NULL"
+            for index, key in enumerate(self.columns)
+        )
+        return (
+            f"IF OBJECT_ID('tempdb..{self.name}') IS NOT NULL DROP TABLE {self.name};\n"
+            f"CREATE TABLE {self.name} ({definitions})"
+        )
+
+    def get_insert_sql(self, size: int) -> str:
+        values = ", ".join(["(" + ", ".join("?" * len(self.columns)) + ")"] * size)
+        return f"INSERT INTO {self.name} ({', '.join(key.name for key in self.columns)}) VALUES {values}"
+
+    async def load(self, cursor: Cursor) -> None:
+        """ (Re)create the table on the connection of `cursor`, a pooled connection may still have the last one """
+        await cursor.execute(self.get_create_sql())
+        size = min(MAX_INSERT_ROWS, MAX_STATEMENT_PARAMS // len(self.columns))
+        for index in range(0, len(self.rows), size):
+            chunk = self.rows[index:index + size]
+            await cursor.execute(self.get_insert_sql(len(chunk)), *[value for row in chunk for value in row])
+
+
+def staged_positions(
+        key_column: ColumnElement, autoids: Iterable[str], default_position: int, name: str,
+) -> ColumnElement:
+    """ Position of `key_column` in `autoids` counted from 1, `default_position` for the rows not in it """
+    positions = {autoid: index for index, autoid in enumerate(autoids, 1)}
+    inline = case(positions, value=key_column, else_=default_position)
+    if len(positions) < EBMS_STAGING_THRESHOLD:
+        return inline
+    staged = StagedKeys(name, list(positions.items()), column('AUTOID', String), column('POSITION', Integer))
+    # the default is inlined, the expression is repeated in SELECT, ORDER BY and the keyset predicate of a grouped query
+    expression = func.coalesce(
+        select(staged.c.POSITION).where(staged.c.AUTOID == key_column).scalar_subquery(),
+        literal_column(str(int(default_position))),
+    )
+    staged.inline[id(expression)] = inline
+    return expression
+
+
+def staged_in(
+        key_column: ColumnElement, autoids: Iterable[str], negate: bool = False, name: Optional[str] = None,
+) -> ColumnElement:
+    """
+    `key_column` IN (or NOT IN) `autoids`, read from `name` (#<table>_<column>_in or _not_in by default) for long
+    lists. A statement with two staged sets on the same column needs another name for one of them.
+    """
+    autoids = list(autoids)
+    inline = key_column.not_in(autoids) if negate else key_column.in_(autoids)
+    if len(autoids) < EBMS_STAGING_THRESHOLD:
+        return inline
+    name = name or f"#{key_column.table.name}_{key_column.name}_{'not_in' if negate else 'in'}".lower()
+    staged = StagedKeys(name, [(autoid,) for autoid in autoids], column('AUTOID', String))
+    keys = select(staged.c.AUTOID)
+    # AUTOID is NOT NULL, NOT IN the subquery gives the same rows as NOT IN the list
+    expression = key_column.not_in(keys) if negate else key_column.in_(keys)
+    staged.inline[id(expression)] = inline
+    return expression
+
+
+class StagedKeysFilter(RenameFieldFilter):
+    """ Filter of EBMS tables, long `in` / `not_in` lists are staged """
+
+    def get_condition(self, model_field: Any, operator: str, value: Any) -> Any:
+        if operator in ("in_", "not_in") and isinstance(value, (list, tuple, set)):
+            return staged_in(model_field, value, negate=operator == "not_in")
+        return super().get_condition(model_field, operator, value)
+
+
+def get_staged_keys(*statements: ClauseElement) -> List[StagedKeys]:
+    """ The staged key sets the statements read, each one once """
+    found = {}
+    for statement in statements:
+        for element in visitors.iterate(statement):
+            if isinstance(element, StagedKeys):
+                found.setdefault(id(element), element)
+    return list(found.values())
+
+
+def get_staged_rows(*statements: ClauseElement) -> tuple:
+    """ The rows of the staged key sets, they aren't in the compiled statement keying a cached result """
+    return tuple((staged.name, tuple(staged.rows)) for staged in get_staged_keys(*statements))
+
+
+async def load_staged_keys(cursor: Cursor, *statements: ClauseElement) -> None:
+    for staged in get_staged_keys(*statements):
+        await staged.load(cursor)
+
+
+def inline_staged_keys(statement: StatementType) -> StatementType:
+    """ The statement with the inline form of its staged key sets, for a connection which doesn't have the tables """
+    staged_keys = get_staged_keys(statement)
+    if not staged_keys:
+        return statement
+    inline = {}
+    for staged in staged_keys:
+        inline.update(staged.inline)
+
+    def replace(element: ClauseElement):
+        return inline.get(id(element))
+
+    return visitors.replacement_traverse(statement, {}, replace)
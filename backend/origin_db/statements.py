@@ -0,0 +1,103 @@
+from collections import OrderedDict
+from threading import Lock
+from typing import NamedTuple, Any, Sequence
+
+from sqlalchemy import Select
+from sqlalchemy.dialects import mssql
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.compiler import SQLCompiler
+
+# SQL Server rejects requests with more than 2100 parameters, keep some room for the rest of the statement
+MAX_STATEMENT_PARAMS = 2000
+
+
+class CompiledStatement(NamedTuple):
+    sql: str
+    params: tuple
+
+
+class BufferedCursor:
+    """ Already fetched rows behind the part of the aioodbc cursor interface the services use """
+
+    def __init__(self, description: Sequence[tuple], rows: Sequence[Any]):
+        self.description = description
+        self.rows = list(rows)
+
+    async def fetchall(self) -> list:
+        return self.rows
+
+    async def fetchone(self) -> Any:
+        return self.rows[0] if self.rows else None
+
+
+class StatementCache:
+    """
+    Compiles EBMS statements to qmark SQL with bound parameters.
+
+    Statements are cached by their SQLAlchemy cache key, i.e. by query shape, so the same page of
+    /ebms/orders/ with another autoid or date reuses both the Python compile and the server side plan.
+    IN lists are padded to the next power of two to keep the number of distinct SQL texts small.
+    """
+
+    def __init__(self, dialect=None, maxsize: int = 500):
+        self.dialect = dialect or mssql.dialect(paramstyle="qmark")
+        self.maxsize = maxsize
+        self._cache: OrderedDict[Any, SQLCompiler] = OrderedDict()
+        self._lock = Lock()
+
+    def _get_compiled(self, statement: Select | Query, cache_key) -> SQLCompiler:
+        with self._lock:
+            compiled = self._cache.get(cache_key.key)
+            if compiled is not None:
+                self._cache.move_to_end(cache_key.key)
+                return compiled
+        compiled = statement.compile(dialect=self.dialect, cache_key=cache_key)
+        with self._lock:
+            self._cache[cache_key.key] = compiled
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+        return compiled
+
+    @staticmethod
+    def pad_in_list(values: list | tuple) -> list:
+        size = 1
+        while size < len(values):
+            size *= 2
+        # duplicated values don't change the result of IN / NOT IN
+        return list(values) + [values[-1]] * (size - len(values))
+
+    def compile(self, statement: Select | Query) -> CompiledStatement:
+        cache_key = statement._generate_cache_key()
+        if cache_key is None:
+            return self.literal(statement)
+        compiled = self._get_compiled(statement, cache_key)
+        params = compiled.construct_params(extracted_parameters=cache_key.bindparams)
+        for name, value in params.items():
+            bind = compiled.binds.get(name)
+            if bind is not None and bind.expanding and value:
+                params[name] = self.pad_in_list(value)
+        expanded = compiled.construct_expanded_state(params)
+        if len(expanded.positiontup) > MAX_STATEMENT_PARAMS:
+            return self.literal(statement)
+        return CompiledStatement(expanded.statement, tuple(expanded.parameters[name] for name in expanded.positiontup))
+
+    def compile_batch(self, statements: Sequence[Select | Query]) -> CompiledStatement:
+        """ One batch running the statements in order, each of them returns its own result set """
+        compiled = [self.compile(statement) for statement in statements]
+        if sum(len(statement.params) for statement in compiled) > MAX_STATEMENT_PARAMS:
+            compiled = [self.literal(statement) for statement in statements]
+        return CompiledStatement(
+            ";\n".join(statement.sql for statement in compiled),
+            tuple(param for statement in compiled for param in statement.params),
+        )
+
+    def literal(self, statement: Select | Query) -> CompiledStatement:
+        """ Fallback for statements which can't be sent with bound parameters, values are inlined """
+        return CompiledStatement(str(statement.compile(dialect=self.dialect, compile_kwargs={"literal_binds": True})), ())
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+statement_cache = StatementCache()
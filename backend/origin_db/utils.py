@@ -1,4 +1,4 @@
-from ebms_api.client import ArinvClient
+from ebms_api.outbox import ebms_outbox
 from origin_db.services import OriginOrderService
 from stages.utils import send_data_to_ws
 
@@ -11,9 +11,9 @@ async def send_new_ship_date_to_ebms(model_dump: dict):
     origin_orders = await OriginOrderService().get_origin_order_by_autoids(autoids=autoids)
     await OriginOrderService().update_ship_date(autoids=autoids, ship_date=ship_date)
     await send_data_to_ws('orders', list_autoids=autoids)
-    ebms_api_client = ArinvClient()
-    for instance in origin_orders:
-        response = ebms_api_client.patch(ebms_api_client.retrieve_url(instance.autoid), {"SHIP_DATE": ship_date})
-        if response.status_code != 200:
-            await OriginOrderService().update_ship_date(autoids=autoids, ship_date=instance.ship_date)
-            await send_data_to_ws('orders', autoid=instance.autoid)
+    # failed writes stay in the outbox and are retried, the ship date is rolled back once they are given up
+    await ebms_outbox.enqueue_ship_dates(
+        {instance.autoid: ship_date for instance in origin_orders},
+        previous={instance.autoid: instance.ship_date for instance in origin_orders},
+    )
+    await ebms_outbox.drain()
@@ -0,0 +1,85 @@
+import asyncio
+from collections import defaultdict
+from contextvars import ContextVar
+from typing import Type, Optional, Dict, Set
+
+from fastapi import HTTPException
+
+from common.constants import OriginModelType
+from origin_db.category_cache import normalize
+from origin_db.models import Inprodtype, Arinv, Arinvdet
+from origin_db.records import Record
+from origin_db.services import BaseService, CategoryService, OriginOrderService, OriginItemService
+
+
+class AutoidValidator:
+    """
+    Existence checks of the EBMS autoids a request refers to.
+
+    expect() collects autoids, the next get() resolves everything collected so far with one probe per table
+    (the tables in parallel) and the answers, found or missing, are kept for the rest of the request.
+    """
+    services: Dict[Type[OriginModelType], Type[BaseService]] = {
+        Inprodtype: CategoryService,
+        Arinv: OriginOrderService,
+        Arinvdet: OriginItemService,
+    }
+
+    def __init__(self):
+        self.pending: Dict[Type[OriginModelType], Set[str]] = defaultdict(set)
+        # autoids are compared like SQL Server does, without trailing spaces and case insensitive
+        self.resolved: Dict[Type[OriginModelType], Dict[str, Optional[Record]]] = defaultdict(dict)
+
+    def get_service(self, model: Type[OriginModelType]) -> BaseService:
+        service = self.services.get(model)
+        return service() if service else BaseService(model=model)
+
+    def expect(self, model: Type[OriginModelType], *autoids: str) -> "AutoidValidator":
+        for autoid in autoids:
+            if autoid and normalize(autoid) not in self.resolved[model]:
+                self.pending[model].add(autoid)
+        return self
+
+    async def resolve_model(self, model: Type[OriginModelType], autoids: Set[str]) -> None:
+        objs = await self.get_service(model).probe_autoids(sorted(autoids))
+        found = {normalize(obj.autoid): obj for obj in objs}
+        for autoid in autoids:
+            self.resolved[model][normalize(autoid)] = found.get(normalize(autoid))
+
+    async def resolve(self) -> None:
+        pending, self.pending = self.pending, defaultdict(set)
+        await asyncio.gather(*(self.resolve_model(model, autoids) for model, autoids in pending.items() if autoids))
+
+    async def get(self, model: Type[OriginModelType], autoid: str) -> Record:
+        """ The probed row of `autoid`, 404 when it doesn't exist """
+        self.expect(model, autoid)
+        if self.pending:
+            await self.resolve()
+        obj = self.resolved[model].get(normalize(autoid))
+        if obj is None:
+            raise HTTPException(status_code=404, detail=f"{model.__name__} with id {autoid} not found")
+        return obj
+
+
+_request_validator: ContextVar[Optional[AutoidValidator]] = ContextVar("autoid_validator", default=None)
+
+
+def get_autoid_validator() -> AutoidValidator:
+    """ The validator of the current HTTP request, outside of a request every call gets a new one """
+    return _request_validator.get() or AutoidValidator()
+
+
+class AutoidValidationMiddleware:
+    """ Gives every HTTP request its own AutoidValidator, websocket connections don't keep one """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token = _request_validator.set(AutoidValidator())
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            _request_validator.reset(token)
@@ -1,4 +1,6 @@
-from decouple import config
+from datetime import datetime
+
+from decouple import config, Choices
 from pydantic import Field
 from pydantic_settings import BaseSettings
 
@@ -6,9 +8,51 @@ SECRET_KEY = config("SECRET_KEY", cast=str)
 
 TOKEN_CREDENTIAL = config("TOKEN_CREDENTIAL", cast=str)
 
-FILTERING_DATA_STARTING_YEAR = config('FILTERING_DATA_STARTING_YEAR', default='2023-01-01', cast=str)
+FILTERING_DATA_STARTING_YEAR = config(
+    'FILTERING_DATA_STARTING_YEAR', default='2023-01-01', cast=lambda value: datetime.strptime(value, '%Y-%m-%d')
+)
 LIST_EXCLUDED_PROD_TYPES = ("", "Vents")
 
+EBMS_COUNT_CACHE_TTL = config('EBMS_COUNT_CACHE_TTL', default=30, cast=int)  # seconds
+EBMS_COUNT_CACHE_MAXSIZE = config('EBMS_COUNT_CACHE_MAXSIZE', default=1024, cast=int)
+# group_by: join INVENTRY and deduplicate with GROUP BY, lookup: TOP 1 INVENTRY lookups without grouping,
+# index: no INVENTRY access, categories come from the in process inventory index (origin_db/inventory_index.py)
+EBMS_ITEM_QUERY_STRATEGY = config(
+    'EBMS_ITEM_QUERY_STRATEGY', default='group_by', cast=Choices(['group_by', 'lookup', 'index'])
+)
+EBMS_INVENTORY_INDEX_REFRESH = config('EBMS_INVENTORY_INDEX_REFRESH', default=30, cast=int)  # seconds, new inventory
+EBMS_INVENTORY_INDEX_RELOAD = config('EBMS_INVENTORY_INDEX_RELOAD', default=3600, cast=int)  # seconds, whole table
+# True: an order and its lines are read with one batch of two SELECTs, False: two statements on separate connections
+EBMS_ORDER_DETAILS_BATCH = config('EBMS_ORDER_DETAILS_BATCH', default=True, cast=bool)
+# the `search` filter reads matching orders from the mirror trigram indexes, above this many matches it keeps LIKE
+EBMS_SEARCH_MAX_MATCHES = config('EBMS_SEARCH_MAX_MATCHES', default=1000, cast=int)
+EBMS_EXPORT_BATCH_SIZE = config('EBMS_EXPORT_BATCH_SIZE', default=500, cast=int)  # rows per fetch of /orders/export/ and /items/export/
+# exports streamed at a time per process, each one holds an EBMS pool connection, more are answered 429
+EBMS_EXPORT_MAX_CONCURRENT = config('EBMS_EXPORT_MAX_CONCURRENT', default=4, cast=int)
+# autoid lists (in / not_in filters, sort positions) of at least this many keys are loaded into #temp tables, see origin_db/staging.py
+EBMS_STAGING_THRESHOLD = config('EBMS_STAGING_THRESHOLD', default=200, cast=int)
+# combined Postgres and EBMS filters start with EBMS when it matches fewer rows, see origin_db/planner.py
+EBMS_PLANNER_ENABLED = config('EBMS_PLANNER_ENABLED', default=True, cast=bool)
+EBMS_PLANNER_MAX_KEYS = config('EBMS_PLANNER_MAX_KEYS', default=2000, cast=int)  # most EBMS autoids read to drive the Postgres filter
+# INPRODTYPE rows, kept in process and in redis, see origin_db/category_cache.py
+EBMS_CATEGORY_CACHE_TTL = config('EBMS_CATEGORY_CACHE_TTL', default=60, cast=int)  # seconds
+EBMS_CATEGORY_CACHE_REDIS_TTL = config('EBMS_CATEGORY_CACHE_REDIS_TTL', default=3600, cast=int)  # seconds
+# flows and stages shared by the items of a process, see stages/flow_graph.py
+FLOW_GRAPH_CACHE_TTL = config('FLOW_GRAPH_CACHE_TTL', default=300, cast=int)  # seconds, then checked against redis
+
+# Postgres copy of the open EBMS orders, lines and inventory, see origin_db/mirror.py
+EBMS_MIRROR_ENABLED = config('EBMS_MIRROR_ENABLED', default=False, cast=bool)
+EBMS_MIRROR_SCHEMA = config('EBMS_MIRROR_SCHEMA', default='ebms_mirror', cast=str)
+EBMS_MIRROR_SYNC_INTERVAL = config('EBMS_MIRROR_SYNC_INTERVAL', default=15, cast=int)  # seconds
+EBMS_MIRROR_RECONCILE_INTERVAL = config('EBMS_MIRROR_RECONCILE_INTERVAL', default=300, cast=int)  # seconds
+EBMS_MIRROR_MAX_STALENESS = config('EBMS_MIRROR_MAX_STALENESS', default=420, cast=int)  # seconds since the last sync and reconcile, older mirror is not read
+EBMS_MIRROR_BATCH_SIZE = config('EBMS_MIRROR_BATCH_SIZE', default=500, cast=int)
+
+# websocket `changes` events for edits made directly in EBMS, see origin_db/change_poller.py
+EBMS_CHANGE_POLLER_ENABLED = config('EBMS_CHANGE_POLLER_ENABLED', default=False, cast=bool)
+EBMS_CHANGE_POLL_INTERVAL = config('EBMS_CHANGE_POLL_INTERVAL', default=10, cast=int)  # seconds
+EBMS_CHANGE_RECONCILE_INTERVAL = config('EBMS_CHANGE_RECONCILE_INTERVAL', default=300, cast=int)  # seconds, checksum sweep for updated and deleted rows
+
 ALGORITHM = "SHA256"
 ACCESS_TOKEN_LIFETIME_SECONDS = config("ACCESS_TOKEN_LIFETIME_SECONDS", cast=int, default=3600)
 
@@ -20,6 +64,20 @@ FRONTEND_HOST = config('FRONTEND_HOST', default='dev-embs.com', cast=str)
 EBMS_API_PASSWORD = config("EBMS_API_PASSWORD", cast=str)
 EBMS_API_LOGIN = config("EBMS_API_LOGIN", cast=str)
 EBMS_API_URL = config("EBMS_API_URL", cast=str)
+# EBMS REST API client, see ebms_api/client.py
+EBMS_API_TIMEOUT = config("EBMS_API_TIMEOUT", default=30, cast=float)  # seconds
+EBMS_API_MAX_CONNECTIONS = config("EBMS_API_MAX_CONNECTIONS", default=20, cast=int)  # kept alive by the process
+EBMS_API_HOST_CONCURRENCY = config("EBMS_API_HOST_CONCURRENCY", default=8, cast=int)  # requests in flight per host
+EBMS_API_RETRIES = config("EBMS_API_RETRIES", default=3, cast=int)
+EBMS_API_RETRY_BACKOFF = config("EBMS_API_RETRY_BACKOFF", default=0.5, cast=float)  # seconds, doubled per attempt
+EBMS_API_BATCH_SIZE = config("EBMS_API_BATCH_SIZE", default=50, cast=int)  # PATCHes per OData $batch, 1 sends them one by one
+# outbox of EBMS API writes, see ebms_api/outbox.py
+EBMS_OUTBOX_ENABLED = config("EBMS_OUTBOX_ENABLED", default=True, cast=bool)
+EBMS_OUTBOX_POLL_INTERVAL = config("EBMS_OUTBOX_POLL_INTERVAL", default=5, cast=int)  # seconds
+EBMS_OUTBOX_BATCH_SIZE = config("EBMS_OUTBOX_BATCH_SIZE", default=100, cast=int)  # writes claimed per drain
+EBMS_OUTBOX_MAX_ATTEMPTS = config("EBMS_OUTBOX_MAX_ATTEMPTS", default=8, cast=int)  # then the write is rolled back
+EBMS_OUTBOX_BACKOFF = config("EBMS_OUTBOX_BACKOFF", default=10, cast=int)  # seconds, doubled per attempt
+EBMS_OUTBOX_MAX_BACKOFF = config("EBMS_OUTBOX_MAX_BACKOFF", default=1800, cast=int)  # seconds
 
 
 class EBMSDatabase(BaseSettings):
@@ -28,6 +86,12 @@ class EBMSDatabase(BaseSettings):
     DB_HOST: str = Field(alias="EBMS_DB_HOST", default="localhost")
     DB_PORT: int = Field(alias="EBMS_DB_PORT", default=1433)
     DB_NAME: str = Field(alias="EBMS_DB_NAME", default="mssql")
+    POOL_MIN_SIZE: int = Field(alias="EBMS_POOL_MIN_SIZE", default=2)
+    POOL_MAX_SIZE: int = Field(alias="EBMS_POOL_MAX_SIZE", default=20)
+    POOL_RECYCLE: int = Field(alias="EBMS_POOL_RECYCLE", default=1800)  # seconds, -1 disables recycling
+    POOL_ACQUIRE_TIMEOUT: float = Field(alias="EBMS_POOL_ACQUIRE_TIMEOUT", default=10.0)  # seconds
+    POOL_PRE_PING: bool = Field(alias="EBMS_POOL_PRE_PING", default=True)
+    EXECUTOR_MAX_WORKERS: int = Field(alias="EBMS_EXECUTOR_MAX_WORKERS", default=20)
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,322 @@
+"""
+Flows with their ordered stages, shared by all the items of a process.
+
+Items are read with their scalar columns and comments only, `FlowGraphCache.attach` sets their `flow_node` and
+`stage_node`, plain attributes which the item schemas read instead of the `flow` and `stage` relationships.
+The graph is loaded once per process and dropped when a session commits a change of a flow or a stage. The change
+also increments the version in redis and is published on FLOW_GRAPH_CHANNEL, so the other workers drop their graph
+too. A graph older than FLOW_GRAPH_CACHE_TTL seconds is reused only while the version in redis is still the one it
+was loaded with, in case a message was missed.
+
+The ids of the items which went through every stage (`StageNode.item_ids`) change with every used stage, they are
+kept apart from the graph. A committed used stage is added in place and published on STAGE_ITEMS_CHANNEL for the
+other workers, a removed one makes every worker reload the ids. They are reloaded after FLOW_GRAPH_CACHE_TTL
+seconds as well, in case a message was missed.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime
+from typing import NamedTuple, Optional, Iterable, Dict, Tuple, Set, List
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session, ORMExecuteState
+
+from database import default_session_maker, redis_pool
+from settings import FLOW_GRAPH_CACHE_TTL
+from stages.models import Flow, Stage, UsedStage, Item
+
+logger = logging.getLogger(__name__)
+
+FLOW_GRAPH_VERSION_KEY = 'stages:flow_graph:version'
+FLOW_GRAPH_CHANNEL = 'stages:flow_graph'
+STAGE_ITEMS_CHANNEL = 'stages:stage_items'
+GRAPH_MODELS = (Flow, Stage)
+CHANGED_KEY = 'flow_graph_changed'
+ADDED_USED_STAGES_KEY = 'flow_graph_added_used_stages'
+REMOVED_USED_STAGES_KEY = 'flow_graph_removed_used_stages'
+
+
+class StageNode(NamedTuple):
+    id: int
+    name: str
+    description: Optional[str]
+    position: int
+    default: bool
+    color: str
+    flow_id: Optional[int]
+
+    @property
+    def item_ids(self) -> Set[int]:
+        return flow_graph_cache.stage_items.get(self.id, set())
+
+
+class FlowNode(NamedTuple):
+    id: int
+    name: str
+    description: Optional[str]
+    position: int
+    color: str
+    need_manager: bool
+    category_autoid: Optional[str]
+    created_at: datetime
+    stages: Tuple[StageNode, ...]
+
+
+class FlowGraph(NamedTuple):
+    version: int
+    loaded_at: float
+    flows: Dict[int, FlowNode]
+    stages: Dict[int, StageNode]
+
+    def attach(self, items: Iterable[Item]) -> None:
+        for item in items:
+            # not the relationships, the nodes are not ORM objects
+            item.flow_node = self.flows.get(item.flow_id)
+            item.stage_node = self.stages.get(item.stage_id)
+
+
+class FlowGraphCache:
+    def __init__(self, ttl: int = FLOW_GRAPH_CACHE_TTL):
+        self.ttl = ttl
+        self.graph: Optional[FlowGraph] = None
+        self.generation = 0  # incremented by every invalidation, a graph loaded meanwhile isn't kept
+        self.stage_items: Dict[int, Set[int]] = {}
+        self.stage_items_loaded_at: Optional[float] = None
+        self.stage_items_generation = 0
+        self.stage_items_added: Optional[List[Tuple[int, int]]] = None  # added while the ids are loaded
+        self.origin = uuid.uuid4().hex  # the messages of this process are skipped
+        self._lock = asyncio.Lock()
+        self._stage_items_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._publishing: Set[asyncio.Task] = set()
+
+    @staticmethod
+    def get_redis() -> aioredis.Redis:
+        return aioredis.Redis(connection_pool=redis_pool)
+
+    async def read_version(self) -> int:
+        try:
+            return int(await self.get_redis().get(FLOW_GRAPH_VERSION_KEY) or 0)
+        except RedisError as e:
+            logger.warning("flow graph version read failed %s", e)
+            return -1
+
+    async def load(self) -> FlowGraph:
+        version = await self.read_version()
+        async with default_session_maker() as session:
+            flows = (await session.scalars(select(Flow))).all()
+            stages = (await session.scalars(select(Stage).order_by(Stage.position, Stage.id))).all()
+        stage_nodes = {
+            stage.id: StageNode(
+                stage.id, stage.name, stage.description, stage.position, stage.default, stage.color, stage.flow_id,
+            )
+            for stage in stages
+        }
+        flow_stages = {}
+        for stage in stage_nodes.values():
+            flow_stages.setdefault(stage.flow_id, []).append(stage)
+        flow_nodes = {
+            flow.id: FlowNode(
+                flow.id, flow.name, flow.description, flow.position, flow.color, flow.need_manager,
+                flow.category_autoid, flow.created_at, tuple(flow_stages.get(flow.id, ())),
+            )
+            for flow in flows
+        }
+        return FlowGraph(version, time.monotonic(), flow_nodes, stage_nodes)
+
+    async def get(self) -> FlowGraph:
+        graph = self.graph
+        if graph is not None and time.monotonic() - graph.loaded_at < self.ttl:
+            return graph
+        async with self._lock:
+            if self.graph is not None and self.graph is not graph:
+                return self.graph
+            if graph is not None and graph.version >= 0 and await self.read_version() == graph.version:
+                self.graph = graph._replace(loaded_at=time.monotonic())
+                return self.graph
+            generation = self.generation
+            graph = await self.load()
+            if generation == self.generation:
+                self.graph = graph
+            return graph
+
+    async def load_stage_items(self) -> None:
+        generation = self.stage_items_generation
+        self.stage_items_added = []
+        try:
+            async with default_session_maker() as session:
+                used_stages = (await session.execute(select(UsedStage.stage_id, UsedStage.item_id).distinct())).all()
+            if generation != self.stage_items_generation:
+                return
+            stage_items = {}
+            # a used stage committed meanwhile may be missing from the result
+            for stage_id, item_id in (*used_stages, *self.stage_items_added):
+                stage_items.setdefault(stage_id, set()).add(item_id)
+            self.stage_items, self.stage_items_loaded_at = stage_items, time.monotonic()
+        finally:
+            self.stage_items_added = None
+
+    async def refresh_stage_items(self) -> None:
+        """ Loads the item ids of the stages when they were dropped or are older than the TTL """
+        loaded_at = self.stage_items_loaded_at
+        if loaded_at is not None and time.monotonic() - loaded_at < self.ttl:
+            return
+        async with self._stage_items_lock:
+            if self.stage_items_loaded_at == loaded_at:
+                await self.load_stage_items()
+
+    def add_stage_items(self, used_stages: Iterable[Tuple[int, int]]) -> None:
+        for stage_id, item_id in used_stages:
+            self.stage_items.setdefault(stage_id, set()).add(item_id)
+            if self.stage_items_added is not None:
+                self.stage_items_added.append((stage_id, item_id))
+
+    def drop_stage_items(self) -> None:
+        self.stage_items_loaded_at = None
+        self.stage_items_generation += 1
+
+    async def attach(self, items: Iterable[Item]) -> None:
+        await self.refresh_stage_items()
+        (await self.get()).attach(items)
+
+    def drop(self) -> None:
+        self.graph = None
+        self.generation += 1
+
+    async def publish(self) -> None:
+        try:
+            redis = self.get_redis()
+            version = await redis.incr(FLOW_GRAPH_VERSION_KEY)
+            await redis.publish(FLOW_GRAPH_CHANNEL, version)
+        except RedisError as e:
+            logger.warning("flow graph invalidation failed %s", e)
+
+    async def invalidate(self) -> None:
+        self.drop()
+        await self.publish()
+
+    def invalidate_soon(self) -> None:
+        """ invalidate() from sync code, this process drops its graph at once """
+        self.drop()
+        self.publish_soon(self.publish())
+
+    async def publish_stage_items(self, message: dict) -> None:
+        try:
+            await self.get_redis().publish(STAGE_ITEMS_CHANNEL, json.dumps({"origin": self.origin, **message}))
+        except RedisError as e:
+            logger.warning("stage items publish failed %s", e)
+
+    def update_stage_items_soon(self, added: List[Tuple[int, int]], removed: bool) -> None:
+        """ Apply the committed used stages here at once, publish them for the other workers """
+        if removed:
+            self.drop_stage_items()
+            self.publish_soon(self.publish_stage_items({"reload": True}))
+        elif added:
+            self.add_stage_items(added)
+            self.publish_soon(self.publish_stage_items({"added": added}))
+
+    def publish_soon(self, coroutine) -> None:
+        try:
+            task = asyncio.get_running_loop().create_task(coroutine)
+        except RuntimeError:
+            coroutine.close()
+            return
+        self._publishing.add(task)
+        task.add_done_callback(self._publishing.discard)
+
+    def receive_stage_items(self, data) -> None:
+        message = json.loads(data)
+        if message.get("origin") == self.origin:
+            return
+        if message.get("reload"):
+            self.drop_stage_items()
+        else:
+            self.add_stage_items(tuple(used_stage) for used_stage in message.get("added", ()))
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self.get_redis().pubsub() as pubsub:
+                    await pubsub.subscribe(FLOW_GRAPH_CHANNEL, STAGE_ITEMS_CHANNEL)
+                    # messages may have been missed while not subscribed
+                    self.drop()
+                    self.drop_stage_items()
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        channel = message["channel"]
+                        if (channel.decode() if isinstance(channel, bytes) else channel) == STAGE_ITEMS_CHANNEL:
+                            self.receive_stage_items(message["data"])
+                        # a graph loaded after the change was published is current
+                        elif self.graph is None or self.graph.version < int(message["data"]):
+                            self.drop()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("flow graph subscription failed")
+            await asyncio.sleep(5)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+
+flow_graph_cache = FlowGraphCache()
+
+
+@event.listens_for(Session, "after_flush")
+def mark_flushed_changes(session: Session, flush_context) -> None:
+    if any(isinstance(instance, GRAPH_MODELS) for instance in (*session.new, *session.dirty, *session.deleted)):
+        session.info[CHANGED_KEY] = True
+    for instance in session.new:
+        if isinstance(instance, UsedStage):
+            session.info.setdefault(ADDED_USED_STAGES_KEY, []).append((instance.stage_id, instance.item_id))
+    # the used stages of a deleted item are deleted by the database
+    if any(isinstance(instance, UsedStage) for instance in session.dirty) \
+            or any(isinstance(instance, (UsedStage, Item)) for instance in session.deleted):
+        session.info[REMOVED_USED_STAGES_KEY] = True
+
+
+@event.listens_for(Session, "do_orm_execute")
+def mark_bulk_changes(orm_execute_state: ORMExecuteState) -> None:
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert):
+        return
+    mapper = orm_execute_state.bind_mapper
+    if mapper is None:
+        return
+    if issubclass(mapper.class_, GRAPH_MODELS) and not orm_execute_state.is_insert:
+        orm_execute_state.session.info[CHANGED_KEY] = True
+    elif mapper.class_ is UsedStage or (orm_execute_state.is_delete and mapper.class_ is Item):
+        orm_execute_state.session.info[REMOVED_USED_STAGES_KEY] = True
+
+
+@event.listens_for(Session, "after_commit")
+def invalidate_after_commit(session: Session) -> None:
+    if session.info.pop(CHANGED_KEY, False):
+        # this process reads the change right away, the other ones once the message arrives
+        flow_graph_cache.invalidate_soon()
+    added = session.info.pop(ADDED_USED_STAGES_KEY, [])
+    removed = session.info.pop(REMOVED_USED_STAGES_KEY, False)
+    flow_graph_cache.update_stage_items_soon(added, removed)
+
+
+@event.listens_for(Session, "after_rollback")
+def forget_rolled_back_changes(session: Session) -> None:
+    session.info.pop(CHANGED_KEY, None)
+    session.info.pop(ADDED_USED_STAGES_KEY, None)
+    session.info.pop(REMOVED_USED_STAGES_KEY, None)
@@ -1,7 +1,7 @@
 from datetime import datetime, date, time as datetime_time
 from typing import List, Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, Field, field_validator, AliasChoices
 
 from users.schemas import UserReadShortSchema
 
@@ -162,13 +162,14 @@ class ItemSchema(BaseModel):
     id: int = Field(default=None)
     order: str | None = Field(default=None)
     origin_item: str | None = Field(default=None)
-    flow: FlowSchema | None = Field(default=None)
+    # the node of the flow graph, the relationship for an item it wasn't attached to
+    flow: FlowSchema | None = Field(default=None, validation_alias=AliasChoices("flow_node", "flow"))
     priority: int = Field(default=None)
     production_date: date | None | str = Field(default=None)
     time: datetime_time | None | str = Field(default=None)
     packages: int | None = Field(default=None)
     location: int | None = Field(default=None)
-    stage: StageSchema | None = Field(default=None)
+    stage: StageSchema | None = Field(default=None, validation_alias=AliasChoices("stage_node", "stage"))
     comments: List[CommentSchemaOut] | None
     completed: bool = Field(default=False)
 
@@ -198,6 +199,22 @@ class ItemSchema(BaseModel):
         return v.strftime("%H:%M:%S")
 
 
+class NormalizedFlowSchema(FlowSchema):
+    """ FlowSchema with the ids of its stages """
+    stages: List[int] | None
+
+    @field_validator('stages', mode='before')
+    @classmethod
+    def validate_stages(cls, v):
+        return [getattr(stage, 'id', stage) for stage in v] if v is not None else v
+
+
+class NormalizedItemSchema(ItemSchema):
+    """ ItemSchema with the ids of its flow and stage """
+    flow: int | None = Field(default=None, validation_alias="flow_id")
+    stage: int | None = Field(default=None, validation_alias="stage_id")
+
+
 class PaginatedItemSchema(BaseModel):
     count: int
     results: List[ItemSchema]
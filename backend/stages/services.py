@@ -17,8 +17,10 @@ from common.filters import RenameFieldFilter
 from database import default_session_maker
 from mssqqlserver_database import get_cursor
 from origin_db.models import Inprodtype, Arinv, Arinvdet
-from origin_db.services import OriginItemService, BaseService as BaseEbmsBaseService, OriginOrderService, CategoryService
+from origin_db.services import OriginItemService, OriginOrderService, CategoryService
+from origin_db.validation import get_autoid_validator
 from profiles.models import CompanyProfile
+from stages.flow_graph import flow_graph_cache
 from stages.models import Flow, Capacity, Stage, Comment, Item, SalesOrder, UsedStage
 from stages.schemas import (
     FlowSchemaIn, CapacitySchemaIn, StageSchemaIn, CommentSchemaIn, ItemSchemaIn, SalesOrderSchemaIn, MultiUpdateItemSchema,
@@ -45,12 +47,18 @@ class BaseService(Generic[ModelType, InputSchemaType]):
             raise HTTPException(status_code=400, detail=f"Failed to {doing} {self.model.__name__} {e}")
 
     async def root_validator(self, obj: InputSchemaType) -> InputSchemaType:
+        autoids = []
         if getattr(obj, "category_autoid", None) and issubclass(self.model, (Flow, Capacity)):
-            await self.validate_autoid(obj.category_autoid, Inprodtype)
+            autoids.append((Inprodtype, obj.category_autoid))
         if getattr(obj, "order", None) and issubclass(self.model, (SalesOrder, Item)):
-            await self.validate_autoid(obj.order, Arinv)
+            autoids.append((Arinv, obj.order))
         if getattr(obj, "origin_item", None) and issubclass(self.model, Item):
-            await self.validate_autoid(obj.origin_item, Arinvdet)
+            autoids.append((Arinvdet, obj.origin_item))
+        validator = get_autoid_validator()
+        for model, autoid in autoids:
+            validator.expect(model, autoid)
+        for model, autoid in autoids:
+            await validator.get(model, autoid)
         if data := getattr(obj, "production_date", None):
             await self.validate_production_date(data)
         return obj
@@ -81,14 +89,11 @@ class BaseService(Generic[ModelType, InputSchemaType]):
         return query
 
     async def validate_autoid(self, autoid: str, model):
-        if issubclass(model, Inprodtype):
-            return await CategoryService().check_autoids_exist(autoid)
-        if issubclass(model, Arinvdet):
-            return await OriginItemService().check_autoids_exist(autoid)
-        if issubclass(model, Arinv):
-            return await OriginOrderService().check_autoids_exist(autoid)
-        result = await BaseEbmsBaseService(model=model).check_autoids_exist(autoid)
-        return result
+        return await get_autoid_validator().get(model, autoid)
+
+    async def prepare_objects(self, objs: Sequence[ModelType]) -> Sequence[ModelType]:
+        """ Hook to fill attributes which are not read by the query """
+        return objs
 
     async def count_query_objs(self, query) -> int:
         async with default_session_maker() as session:
@@ -100,7 +105,7 @@ class BaseService(Generic[ModelType, InputSchemaType]):
             objs: ScalarResult[OriginModelType] = await session.scalars(self.get_query(limit=limit, offset=offset, **kwargs))
             return {
                 "count": count,
-                "results": objs.all(),
+                "results": await self.prepare_objects(objs.all()),
             }
 
     async def get(self, id: int) -> Optional[ModelType]:
@@ -108,14 +113,15 @@ class BaseService(Generic[ModelType, InputSchemaType]):
         async with default_session_maker() as session:
             result = await session.scalars(stmt)
             try:
-                return result.one()
+                instance = result.one()
             except NoResultFound:
                 raise HTTPException(status_code=404, detail=f"{self.model.__name__} with id {id} not found")
+        return (await self.prepare_objects([instance]))[0]
 
     async def list(self, **kwargs: Optional[dict]) -> Sequence[OriginModelType]:
         async with default_session_maker() as session:
             objs: ScalarResult[OriginModelType] = await session.scalars(self.get_query(**kwargs))
-            return objs.all()
+            return await self.prepare_objects(objs.all())
 
     async def get_filtering_origin_items_autoids(self) -> Sequence[str] | None:
         async with default_session_maker() as session:
@@ -375,12 +381,13 @@ class ItemsService(BaseService[Item, ItemSchemaIn]):
                     setattr(input_obj, "stage_id", None)
             return instance, input_obj
 
+    async def prepare_objects(self, objs: Sequence[Item]) -> Sequence[Item]:
+        """ The flow and the stage of the items come from the flow graph """
+        await flow_graph_cache.attach(objs)
+        return objs
+
     def get_query(self, limit: int = None, offset: int = None, **kwargs: Optional[dict]) -> Query:
-        query = select(self.model).options(
-            selectinload(self.model.stage),
-            selectinload(self.model.comments),
-            selectinload(self.model.flow).selectinload(Flow.stages).selectinload(Stage.used_stages),
-        )
+        query = select(self.model).options(selectinload(self.model.comments))
         if self.filter:
             query = self.filter.filter(query, **kwargs)
             query = self.filter.sort(query)
@@ -535,40 +542,44 @@ class ItemsService(BaseService[Item, ItemSchemaIn]):
             return objs.all()
 
     async def get_related_items_by_order(self, autoids: list[str]):
-        stmt = select(self.model).where(self.model.order.in_(autoids)).options(
-            selectinload(self.model.stage),
-            selectinload(self.model.comments),
-            selectinload(self.model.flow).selectinload(Flow.stages).selectinload(Stage.used_stages),
-        )
+        stmt = select(self.model).where(self.model.order.in_(autoids)).options(selectinload(self.model.comments))
         async with default_session_maker() as session:
             objs = await session.scalars(stmt)
-            return objs.all()
+            return await self.prepare_objects(objs.all())
 
     async def get_related_items_by_origin_items(self, autoids: list[str]):
-        stmt = select(self.model).where(self.model.origin_item.in_(autoids)).options(
-            selectinload(self.model.stage),
-            selectinload(self.model.comments),
-            selectinload(self.model.flow).selectinload(Flow.stages).selectinload(Stage.used_stages),
-        )
+        stmt = select(self.model).where(self.model.origin_item.in_(autoids)).options(selectinload(self.model.comments))
         async with default_session_maker() as session:
             objs = await session.scalars(stmt)
-            return objs.all()
+            return await self.prepare_objects(objs.all())
 
     async def list(self, **kwargs: Optional[dict]) -> Sequence[ModelType]:
         stmt = self.get_query(**kwargs)
         async with default_session_maker() as session:
             objs: ScalarResult[ModelType] = await session.scalars(stmt)
-            return objs.all()
+            return await self.prepare_objects(objs.all())
+
+    def get_filtering_origin_items_query(self, within: Optional[Sequence[str]] = None, **kwargs) -> Optional[Query]:
+        """ Origin items matched by the filter, only among `within` if given, None if the filter has no values """
+        if not self.filter or not self.filter.is_filtering_values:
+            return None
+        query = self.filter.filter(select(self.model.origin_item).where(self.model.origin_item != None), **kwargs)
+        if within is not None:
+            query = query.where(self.model.origin_item.in_(within))
+        return self.filter.sort(query, **kwargs)
 
-    async def get_filtering_origin_items_autoids(self, do_ordering: bool = False, **kwargs) -> Sequence[str] | None:
+    async def get_filtering_origin_items_autoids(
+            self, do_ordering: bool = False, within: Optional[Sequence[str]] = None, **kwargs
+    ) -> Sequence[str] | None:
         async with default_session_maker() as session:
-            if self.filter and self.filter.is_filtering_values:
-                query = self.filter.filter(select(self.model.origin_item).where(self.model.origin_item != None), **kwargs)
-                query = self.filter.sort(query, **kwargs)
+            query = self.get_filtering_origin_items_query(within=within, **kwargs)
+            if query is not None:
                 objs: ScalarResult[str] = await session.scalars(query)
                 return objs.all() or ['-1']
             if do_ordering:
                 query = self.filter.sort(select(self.model.origin_item))
+                if within is not None:
+                    query = query.where(self.model.origin_item.in_(within))
                 objs: ScalarResult[str] = await session.scalars(query)
                 return objs.all()
             return None
@@ -630,7 +641,18 @@ class SalesOrdersService(BaseService[SalesOrder, SalesOrderSchemaIn]):
             objs = await session.scalars(stmt)
             return objs.all()
 
-    async def get_filtering_origin_orders_autoids(self, do_ordering: bool = False, **kwargs) -> Sequence[str] | None:
+    def get_filtering_origin_orders_query(self, within: Optional[Sequence[str]] = None, **kwargs) -> Optional[Query]:
+        """ Origin orders matched by the filter, only among `within` if given, None if the filter has no values """
+        if not self.filter or not self.filter.is_filtering_values:
+            return None
+        query = self.filter.filter(select(self.model.order), **kwargs)
+        if within is not None:
+            query = query.where(self.model.order.in_(within))
+        return self.filter.sort(query, **kwargs)
+
+    async def get_filtering_origin_orders_autoids(
+            self, do_ordering: bool = False, within: Optional[Sequence[str]] = None, **kwargs
+    ) -> Sequence[str] | None:
         # subq = select(self.model.order).where(
         #     and_(
         #         self.model.production_date != None,
@@ -639,15 +661,16 @@ class SalesOrdersService(BaseService[SalesOrder, SalesOrderSchemaIn]):
         #     )
         # ).join(Stage)
         query = select(self.model.order)
+        filtering_query = None if do_ordering else self.get_filtering_origin_orders_query(within=within, **kwargs)
         async with default_session_maker() as session:
-            if not do_ordering and self.filter and self.filter.is_filtering_values:
-                query = self.filter.filter(query, **kwargs)
-                query = self.filter.sort(query, **kwargs)
-                objs: ScalarResult[str] = await session.scalars(query)
+            if filtering_query is not None:
+                objs: ScalarResult[str] = await session.scalars(filtering_query)
                 return objs.all() or ['-1']
             if do_ordering:
                 print("do_ordering")
                 query = self.filter.sort(query)
+                if within is not None:
+                    query = query.where(self.model.order.in_(within))
                 objs: ScalarResult[str] = await session.scalars(query, **kwargs)
                 return objs.all()
             return None